@@ -1,4 +1,5 @@
 # Part of NHClinical. See LICENSE file for full copyright and licensing details
 # -*- coding: utf-8 -*-
+from . import pagination
 from . import activity
 from .tests import test_model
@@ -78,6 +78,7 @@ class nh_activity(orm.Model):
     also named activity type.
     """
     _name = 'nh.activity'
+    _inherit = ['nh.keyset.pagination']
     _rec_name = 'summary'
     _states = [('new', 'New'), ('scheduled', 'Scheduled'),
                ('started', 'Started'), ('completed', 'Completed'),
@@ -137,6 +138,16 @@ class nh_activity(orm.Model):
         'assign_locked': fields.boolean("Assign Locked")
     }
 
+    _keyset_orders = {
+        'id': ('asc', ['{alias}id']),
+        'id desc': ('desc', ['{alias}id']),
+        'sequence': ('asc', ['coalesce({alias}sequence, 0)', '{alias}id']),
+        'date_scheduled': ('asc', [
+            "coalesce({alias}date_scheduled, "
+            "'9999-12-31 23:59:59'::timestamp)",
+            '{alias}id'])
+    }
+
     _sql_constraints = [('data_ref_unique', 'unique(data_ref)',
                          'Data reference must be unique!')]
 
@@ -789,22 +800,55 @@ class nh_activity_data(orm.AbstractModel):
             ('parent_id', '=', spell_activity_id)
         ]
         activity_model = self.env['nh.activity']
-        recordset = activity_model.search(domain)
-        if recordset:
-            return recordset[-1]
-        return recordset
+        page = activity_model.search_page(domain, order='id desc', limit=1,
+                                          fields=['id'])
+        return activity_model.browse([r['id'] for r in page['records']])
 
     @api.model
-    def get_open_activities(self, spell_activity_id=None):
+    def get_open_activities(self, spell_activity_id=None, order=None,
+                            after_key=None, limit=None):
         """
         Get open activity(s) for one spell or all spells.
+
+        Pass ``limit`` to get them one page at a time (see
+        :meth:`search_page<pagination.nh_keyset_pagination.search_page>`),
+        ``after_key`` being the key of the last activity of the previous
+        page as returned by :meth:`get_open_activities_page`.
+
         :return: list of activities
         :rtype: list
         """
+        if limit:
+            page = self.get_open_activities_page(
+                spell_activity_id=spell_activity_id, order=order,
+                after_key=after_key, limit=limit)
+            return self.env['nh.activity'].browse(
+                [r['id'] for r in page['records']])
+        return self.env['nh.activity'].search(
+            self._get_open_activities_domain(spell_activity_id))
+
+    @api.model
+    def get_open_activities_page(self, spell_activity_id=None, order=None,
+                                 after_key=None, limit=80, fields=None):
+        """
+        Get one page of the open activity(s) for one spell or all spells
+        with keyset pagination.
+
+        :returns: ``records`` and ``next_key``, see
+            :meth:`search_page<pagination.nh_keyset_pagination.search_page>`
+        :rtype: dict
+        """
+        return self.env['nh.activity'].search_page(
+            self._get_open_activities_domain(spell_activity_id),
+            order=order or 'sequence', after_key=after_key, limit=limit,
+            fields=fields or ['id'])
+
+    @api.model
+    def _get_open_activities_domain(self, spell_activity_id=None):
         domain = [
             ('state', 'not in', ['completed', 'cancelled']),
             ('data_model', '=', self._name)
         ]
         if spell_activity_id:
             domain.append(('spell_activity_id', '=', spell_activity_id))
-        return self.env['nh.activity'].search(domain)
+        return domain
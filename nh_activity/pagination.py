@@ -0,0 +1,153 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+"""
+``pagination.py`` defines a keyset pagination mixin for models that
+external clients page through.
+"""
+import logging
+from datetime import date, datetime
+
+from openerp.osv import orm, osv
+
+_logger = logging.getLogger(__name__)
+
+
+class nh_keyset_pagination(orm.AbstractModel):
+    """
+    Keyset ("seek") pagination for large tables.
+
+    Instead of skipping ``offset`` rows, every page after the first one
+    starts right after the key of the last row of the previous page, so
+    fetching a page costs the same however deep the client is.
+
+    Models inheriting this mixin list the orderings they support in
+    ``_keyset_orders``: the order name maps to its direction and the
+    SQL expressions the rows are sorted by, which must end with ``id``
+    so keys are unique. ``{alias}`` in the expressions is replaced by
+    the table alias, or removed to build the matching index. Nullable
+    columns must be wrapped in ``coalesce`` with a finite value so the
+    keys are comparable and can be sent back as they were returned.
+    Keys are returned as strings when their values are not numbers.
+    """
+    _name = 'nh.keyset.pagination'
+
+    _keyset_orders = {
+        'id': ('asc', ['{alias}id']),
+        'id desc': ('desc', ['{alias}id'])
+    }
+
+    def init(self, cr):
+        """
+        Creates an index for every supported ordering not served by the
+        primary key. The index columns are kept as the index comment so
+        the index is rebuilt when the expressions of its ordering
+        change.
+        """
+        if not self._auto or self._abstract:
+            return
+        for order, (direction, expressions) in self._keyset_orders.items():
+            if expressions == ['{alias}id']:
+                continue
+            index = '{table}_{order}_keyset_idx'.format(
+                table=self._table, order='_'.join(order.split()))
+            columns = ', '.join(e.format(alias='') for e in expressions)
+            cr.execute("""
+                select obj_description(index.oid, 'pg_class')
+                from pg_class index
+                where index.relname = %s and index.relkind = 'i'
+            """, (index,))
+            row = cr.fetchone()
+            if row and row[0] == columns:
+                continue
+            if row:
+                cr.execute("drop index {index}".format(index=index))
+            cr.execute("create index {index} on {table} ({columns})"
+                       .format(index=index, table=self._table,
+                               columns=columns))
+            cr.execute("comment on index {index} is %s".format(index=index),
+                       (columns,))
+
+    def search_page(self, cr, uid, domain, order='id', after_key=None,
+                    limit=80, fields=None, context=None):
+        """
+        Gets one page of the records matching ``domain``.
+
+        :param domain: search domain
+        :type domain: list
+        :param order: one of the orderings in ``_keyset_orders``
+        :type order: str
+        :param after_key: ``next_key`` returned with the previous page.
+            ``None`` for the first page
+        :type after_key: list
+        :param limit: maximum number of records in the page
+        :type limit: int
+        :param fields: fields to read. All of them if ``None``
+        :type fields: list
+        :returns: ``records`` (list of dicts as returned by
+            :meth:`read<openerp.models.Model.read>`) and ``next_key``
+            (key to get the next page with or ``False`` if this is the
+            last page)
+        :rtype: dict
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if the
+            ordering is not supported
+        """
+        if order not in self._keyset_orders:
+            raise osv.except_osv(
+                'Pagination Error!',
+                'Ordering %s is not supported for %s, use one of: %s' % (
+                    order, self._name,
+                    ', '.join(sorted(self._keyset_orders))))
+        direction, expressions = self._keyset_orders[order]
+        alias = '"%s".' % self._table
+        keys = [e.format(alias=alias) for e in expressions]
+        if after_key is not None and len(after_key) != len(keys):
+            raise osv.except_osv('Pagination Error!',
+                                 'Invalid key: %s' % (after_key,))
+
+        self.check_access_rights(cr, uid, 'read')
+        query = self._where_calc(cr, uid, domain or [], context=context)
+        self._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, params = query.get_sql()
+        where = [where_clause] if where_clause else []
+        if after_key is not None:
+            where.append('({keys}) {operator} ({values})'.format(
+                keys=', '.join(keys),
+                operator='>' if direction == 'asc' else '<',
+                values=', '.join(['%s'] * len(keys))))
+            params = params + list(after_key)
+        sql = """
+            select {alias}id, {keys}
+            from {from_clause}
+            {where}
+            order by {order}
+            limit %s
+        """.format(alias=alias, keys=', '.join(keys), from_clause=from_clause,
+                   where='where ' + ' and '.join(where) if where else '',
+                   order=', '.join('%s %s' % (k, direction) for k in keys))
+        cr.execute(sql, params + [limit])
+        rows = cr.fetchall()
+        ids = [row[0] for row in rows]
+        records = dict((r['id'], r) for r in self.read(
+            cr, uid, ids, fields, context=context))
+        next_key = False
+        if limit and len(rows) == limit:
+            next_key = [self._serialise_key_value(value)
+                        for value in rows[-1][1:]]
+        return {
+            'records': [records[record_id] for record_id in ids],
+            'next_key': next_key
+        }
+
+    def _serialise_key_value(self, value):
+        """
+        Converts a key value to a type XML-RPC and JSON clients can send
+        back: numbers are kept, anything else (e.g. datetimes) becomes a
+        string PostgreSQL casts back to the type of the expression.
+        """
+        if isinstance(value, (int, long, float)):
+            return value
+        if isinstance(value, datetime):
+            return value.isoformat(' ')
+        if isinstance(value, date):
+            return value.isoformat()
+        return unicode(value)
@@ -1,3 +1,4 @@
 # Part of NHClinical. See LICENSE file for full copyright and licensing details
 # -*- coding: utf-8 -*-
 from . import test_activity
+from . import test_pagination
@@ -0,0 +1,71 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.osv.orm import except_orm
+from openerp.tests.common import TransactionCase
+
+
+class TestKeysetPagination(TransactionCase):
+    """
+    Test paging through activities with
+    :meth:`search_page<pagination.nh_keyset_pagination.search_page>`.
+    """
+
+    def setUp(self):
+        super(TestKeysetPagination, self).setUp()
+        self.activity_pool = self.registry('nh.activity')
+        self.test_model_pool = self.registry('test.activity.data.model')
+        self.activity_ids = [
+            self.test_model_pool.create_activity(self.cr, self.uid, {}, {})
+            for _ in range(5)]
+        for activity_id in self.activity_ids[:3]:
+            self.activity_pool.schedule(
+                self.cr, self.uid, activity_id,
+                date_scheduled='2020-01-0%s 00:00:00' % (
+                    5 - self.activity_ids.index(activity_id)))
+        self.domain = [('id', 'in', self.activity_ids)]
+
+    def get_all_pages(self, order, limit=2):
+        ids, after_key = [], None
+        while True:
+            page = self.activity_pool.search_page(
+                self.cr, self.uid, self.domain, order=order,
+                after_key=after_key, limit=limit, fields=['id'])
+            ids += [r['id'] for r in page['records']]
+            after_key = page['next_key']
+            if not after_key:
+                return ids
+
+    def test_pages_follow_id_desc(self):
+        self.assertEqual(self.get_all_pages('id desc'),
+                         sorted(self.activity_ids, reverse=True))
+
+    def test_pages_follow_sequence(self):
+        expected = self.activity_pool.search(
+            self.cr, self.uid, self.domain, order='sequence, id')
+        activities = self.activity_pool.read(
+            self.cr, self.uid, expected, ['sequence'])
+        expected = [a['id'] for a in sorted(
+            activities, key=lambda a: (a['sequence'] or 0, a['id']))]
+        self.assertEqual(self.get_all_pages('sequence'), expected)
+
+    def test_pages_follow_date_scheduled_with_unscheduled_last(self):
+        ids = self.get_all_pages('date_scheduled', limit=3)
+        self.assertEqual(ids[:3], list(reversed(self.activity_ids[:3])))
+        self.assertEqual(ids[3:], self.activity_ids[3:])
+
+    def test_unsupported_order_raises(self):
+        with self.assertRaises(except_orm):
+            self.activity_pool.search_page(self.cr, self.uid, self.domain,
+                                           order='summary')
+
+    def test_page_boundary_inside_the_unscheduled_tail(self):
+        ids = self.get_all_pages('date_scheduled', limit=4)
+        self.assertEqual(ids, list(reversed(self.activity_ids[:3])) +
+                         self.activity_ids[3:])
+
+    def test_keys_are_strings_or_numbers(self):
+        page = self.activity_pool.search_page(
+            self.cr, self.uid, self.domain, order='date_scheduled', limit=4,
+            fields=['id'])
+        self.assertTrue(isinstance(page['next_key'][0], basestring))
+        self.assertEqual(page['next_key'][1], page['records'][-1]['id'])
@@ -13,6 +13,8 @@ from . import api
 from . import spell
 from . import operations
 from . import adt
+from . import adt_inbox
+from . import tracing
 from . import devices
 from . import wizard
 from . import auditing
@@ -12,6 +12,12 @@
     'depends': ['nh_activity', 'hr'],
     'data': ['data/data.xml',
              'data/nh_cancel_reasons.xml',
+             'data/transferred_access_cron.xml',
+             'data/adt_inbox_cron.xml',
+             'data/adt_message_ledger_cron.xml',
+             'data/adt_trace_cron.xml',
+             'data/adt_noop_spell_update_cron.xml',
+             'data/ward_version_cron.xml',
              'views/pos_view.xml',
              'views/location_view.xml',
              'views/patient_view.xml',
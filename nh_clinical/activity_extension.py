@@ -8,12 +8,60 @@ information on their representative classes.
 import logging
 from datetime import datetime as dt, timedelta as td
 
+import psycopg2
 from openerp import SUPERUSER_ID
 from openerp.osv import orm, fields
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT as DTF
 
+from .tracing import traced
+
 _logger = logging.getLogger(__name__)
 
+#: Activities whose state or location changes the ward bed boards
+WARD_SNAPSHOT_MODELS = [
+    'nh.clinical.spell', 'nh.clinical.patient.move',
+    'nh.clinical.patient.placement', 'nh.clinical.patient.admission',
+    'nh.clinical.patient.discharge', 'nh.clinical.patient.transfer'
+]
+#: Unique index allowing one started spell per patient
+STARTED_SPELL_PATIENT_INDEX = 'nh_activity_started_spell_patient_idx'
+#: Partial indexes over started spells, used to find admitted patients
+#: and occupied beds without scanning every activity
+STARTED_SPELL_INDEXES = [
+    ('nh_activity_started_spell_location_idx', 'location_id', False),
+    (STARTED_SPELL_PATIENT_INDEX, 'patient_id', True)
+]
+
+#: Indexes used to fetch the activity tree of a spell in sequence order
+#: (see :meth:`get_timeline<spell.nh_clinical_spell.get_timeline>`)
+SPELL_TIMELINE_INDEXES = [
+    ('nh_activity_spell_timeline_idx',
+     'spell_activity_id, coalesce(sequence, 0), id'),
+    ('nh_activity_parent_timeline_idx',
+     'parent_id, coalesce(sequence, 0), id')
+]
+
+#: Context key holding the activities whose
+#: :meth:`update_activity<nh_activity_data.update_activity>` is deferred
+#: until :meth:`nh_activity.flush_activity_updates`, mapped to their
+#: planned spell activity id (``None`` if not planned)
+DEFERRED_UPDATES = 'nh_deferred_updates'
+
+#: Users responsible for the location of each activity, as in
+#: :meth:`nh_activity_data.get_activity_user_ids`
+RESPONSIBLE_USERS_SQL = """
+    select activity.id, array_agg(distinct ulr.user_id)
+    from nh_activity activity
+    inner join ir_model model on model.model = activity.data_model
+    inner join ir_model_access access on access.model_id = model.id
+        and access.perm_responsibility = true
+    inner join res_groups_users_rel gur on gur.gid = access.group_id
+    inner join user_location_rel ulr on ulr.user_id = gur.uid
+        and ulr.location_id = activity.location_id
+    where activity.id in %s
+    group by activity.id
+"""
+
 
 def list2sqlstr(lst):
     res = []
@@ -58,7 +106,10 @@ class nh_activity(orm.Model):
             'nh.clinical.location', 'Location', readonly=True),
         'location_name': fields.related(
             'location_id', 'full_name', type='char', size=150,
-            string='Location Name'),
+            string='Location Name', readonly=True, select=True, store={
+                'nh.activity': (lambda s, cr, uid, ids, c: ids,
+                                ['location_id'], 10)
+            }),
         'pos_id': fields.many2one('nh.clinical.pos', 'POS', readonly=True),
         'spell_activity_id': fields.many2one(
             'nh.activity', 'Spell Activity', readonly=True),
@@ -68,12 +119,51 @@ class nh_activity(orm.Model):
             'res.users', 'Ward Manager of the ward on Complete/Cancel')
     }
 
+    def init(self, cr):
+        super(nh_activity, self).init(cr)
+        for index, column, unique in STARTED_SPELL_INDEXES:
+            cr.execute("select indexdef from pg_indexes where indexname = %s",
+                       (index,))
+            row = cr.fetchone()
+            if row and (not unique or row[0].startswith('CREATE UNIQUE')):
+                continue
+            cr.execute("savepoint nh_activity_started_spell_index")
+            try:
+                if row:
+                    cr.execute("drop index {index}".format(index=index))
+                cr.execute("""
+                    create {unique} index {index} on nh_activity ({column})
+                    where data_model = 'nh.clinical.spell'
+                        and state = 'started'
+                """.format(unique='unique' if unique else '', index=index,
+                           column=column))
+            except psycopg2.IntegrityError:
+                cr.execute(
+                    "rollback to savepoint nh_activity_started_spell_index")
+                _logger.warning(
+                    "Some patients have more than one started spell, "
+                    "index %s can not be made unique.", index)
+                if not row:
+                    cr.execute("""
+                        create index {index} on nh_activity ({column})
+                        where data_model = 'nh.clinical.spell'
+                            and state = 'started'
+                    """.format(index=index, column=column))
+            cr.execute("release savepoint nh_activity_started_spell_index")
+        for index, columns in SPELL_TIMELINE_INDEXES:
+            cr.execute("select 1 from pg_indexes where indexname = %s",
+                       (index,))
+            if not cr.fetchone():
+                cr.execute("create index {index} on nh_activity ({columns})"
+                           .format(index=index, columns=columns))
+
     def create(self, cr, uid, vals, context=None):
         """
         Extends Odoo's `create()` method.
 
         Writes ``user_ids`` for responsible users of the activities`
-        location.
+        location, unless the activity updates are deferred (see
+        :meth:`flush_activity_updates`).
 
         :param vals: values to create record
         :type vals: doct
@@ -81,7 +171,8 @@ class nh_activity(orm.Model):
         :rtype: int
         """
         res = super(nh_activity, self).create(cr, uid, vals, context=context)
-        if vals.get('location_id'):
+        if vals.get('location_id') and \
+                DEFERRED_UPDATES not in (context or {}):
             user_ids = self.pool['nh.activity.data'].get_activity_user_ids(
                 cr, uid, res, context=context)
             if vals.get('data_model') == 'nh.clinical.spell':
@@ -110,8 +201,22 @@ class nh_activity(orm.Model):
 
         if not values:
             values = {}
+        ward_ids = []
+        if 'location_id' in values:
+            ward_ids = self.pool['nh.clinical.location'].get_ward_ids(
+                cr, uid, self._get_ward_location_ids(cr, ids),
+                context=context)
         res = super(nh_activity, self).write(cr, uid, ids, values,
                                              context=context)
+        if 'state' in values or 'location_id' in values:
+            self._bump_ward_versions(cr, uid, ids, ward_ids=ward_ids,
+                                     context=context)
+        if 'state' in values or 'patient_id' in values:
+            spell_activity_ids = self._get_spell_activity_ids(cr, ids)
+            if spell_activity_ids:
+                self.pool['nh.clinical.spell'].sync_open_spells(
+                    cr, uid, activity_ids=spell_activity_ids,
+                    context=context)
         if 'location_id' in values:
             location_pool = self.pool['nh.clinical.location']
             location = location_pool.read(cr, uid, values['location_id'],
@@ -122,6 +227,142 @@ class nh_activity(orm.Model):
                            context=context)
         return res
 
+    @traced()
+    def flush_activity_updates(self, cr, uid, context=None):
+        """
+        Applies the activity updates deferred in the
+        :data:`DEFERRED_UPDATES` context key and empties it.
+
+        Activities without a planned spell activity go through their
+        :meth:`update_activity<nh_activity_data.update_activity>`.
+        Planned activities already have their patient, location and POS
+        (set when they were created), so only their spell activity and
+        responsible users are written, computed for all of them at
+        once.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        deferred = (context or {}).get(DEFERRED_UPDATES)
+        if not deferred:
+            return True
+        updates = deferred.items()
+        deferred.clear()
+        update_context = context.copy()
+        del update_context[DEFERRED_UPDATES]
+        planned = {}
+        for activity_id, spell_activity_id in updates:
+            if spell_activity_id is None:
+                data_model = self.read(cr, uid, activity_id, ['data_model'],
+                                       context=context)['data_model']
+                self.pool[data_model].update_activity(
+                    cr, SUPERUSER_ID, activity_id, context=update_context)
+            else:
+                planned[activity_id] = spell_activity_id
+        if not planned:
+            return True
+        user_ids = self._get_responsible_user_ids(
+            cr, uid, planned.keys(), context=context)
+        writes = {}
+        for activity_id, spell_activity_id in planned.items():
+            key = (spell_activity_id, tuple(sorted(user_ids[activity_id])))
+            writes.setdefault(key, []).append(activity_id)
+        for (spell_activity_id, users), activity_ids in writes.items():
+            self.write(cr, SUPERUSER_ID, activity_ids, {
+                'user_ids': [(6, 0, list(users))],
+                'spell_activity_id': spell_activity_id},
+                context=update_context)
+        _logger.debug("activity updates flushed for activity.ids=%s",
+                      [activity_id for activity_id, _ in updates])
+        return True
+
+    def _get_responsible_user_ids(self, cr, uid, activity_ids, context=None):
+        """
+        Gets the users of several activities as
+        :meth:`get_activity_user_ids<nh_activity_data.get_activity_user_ids>`
+        does for each one of them, with a single query for the
+        activities that are not spells.
+
+        :param activity_ids: activity ids
+        :type activity_ids: list
+        :returns: user ids by activity id
+        :rtype: dict
+        """
+        res = {activity_id: [] for activity_id in activity_ids}
+        activities = self.read(
+            cr, uid, activity_ids, ['data_model', 'location_id', 'patient_id'],
+            context=context)
+        other_ids = []
+        patient_ids = set()
+        for activity in activities:
+            if not activity['location_id']:
+                continue
+            if activity['data_model'] == 'nh.clinical.spell':
+                res[activity['id']] = self.pool[
+                    'nh.clinical.spell'].get_activity_user_ids(
+                    cr, uid, activity['id'], context=context)
+                continue
+            other_ids.append(activity['id'])
+            if activity['patient_id']:
+                patient_ids.add(activity['patient_id'][0])
+        if not other_ids:
+            return res
+        cr.execute(RESPONSIBLE_USERS_SQL, (tuple(other_ids),))
+        for activity_id, user_ids in cr.fetchall():
+            res[activity_id] = user_ids
+        followers = {patient['id']: patient['follower_ids']
+                     for patient in self.pool['nh.clinical.patient'].read(
+                         cr, uid, list(patient_ids), ['follower_ids'],
+                         context=context)}
+        for activity in activities:
+            if activity['id'] in other_ids and activity['patient_id']:
+                res[activity['id']] = list(set(
+                    res[activity['id']] +
+                    followers[activity['patient_id'][0]]))
+        return res
+
+    def _get_spell_activity_ids(self, cr, ids):
+        """
+        Gets the spell activities among the activities.
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return []
+        cr.execute("""
+            select id from nh_activity
+            where id in %s and data_model = 'nh.clinical.spell'
+        """, (tuple(ids),))
+        return [row[0] for row in cr.fetchall()]
+
+    def _get_ward_location_ids(self, cr, ids):
+        """
+        Gets the locations of the activities that change ward bed boards.
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return []
+        cr.execute("""
+            select distinct location_id from nh_activity
+            where id in %s and data_model in %s and location_id is not null
+        """, (tuple(ids), tuple(WARD_SNAPSHOT_MODELS)))
+        return [row[0] for row in cr.fetchall()]
+
+    def _bump_ward_versions(self, cr, uid, ids, ward_ids=None,
+                            context=None):
+        """
+        Bumps the version of the wards of the activities that change
+        ward bed boards (see
+        :meth:`get_ward_snapshot<base.nh_clinical_location.get_ward_snapshot>`)
+        and of ``ward_ids``.
+        """
+        location_ids = self._get_ward_location_ids(cr, ids)
+        if location_ids or ward_ids:
+            self.pool['nh.clinical.location'].bump_ward_versions(
+                cr, uid, location_ids, ward_ids=ward_ids, context=context)
+        return True
+
     def cancel_with_reason(self, cr, uid, activity_id, cancel_reason_id):
         """
         Cancel the activity add a cancel reason to it.
@@ -207,6 +448,91 @@ class nh_activity(orm.Model):
 
         return True
 
+    def add_follower_users(self, cr, uid, patient_ids, user_ids=None,
+                           context=None):
+        """
+        Gives the followers of the patients visibility of the patients'
+        open activities with a single insert into ``activity_user_rel``.
+        Spell activities are left alone as their users only depend on
+        the spell location.
+
+        :param patient_ids: :class:`patient<base.nh_clinical_patient>`
+            ids
+        :type patient_ids: list
+        :param user_ids: only add these followers. All of them if
+            ``None``
+        :type user_ids: list
+        :returns: ``True``
+        :rtype: bool
+        """
+        if not patient_ids or user_ids is not None and not user_ids:
+            return True
+        cr.execute("""
+            insert into activity_user_rel (activity_id, user_id)
+            select activity.id, follower.user_id
+            from nh_activity activity
+            inner join user_patient_rel follower
+                on follower.patient_id = activity.patient_id
+            where activity.patient_id in %(patient_ids)s
+                and activity.state not in ('completed', 'cancelled')
+                and activity.data_model != 'nh.clinical.spell'
+                and (%(all_users)s or follower.user_id in %(user_ids)s)
+                and not exists (
+                    select 1 from activity_user_rel rel
+                    where rel.activity_id = activity.id
+                        and rel.user_id = follower.user_id)
+        """, {'patient_ids': tuple(patient_ids),
+              'all_users': user_ids is None,
+              'user_ids': tuple(user_ids or [None])})
+        return True
+
+    def remove_follower_users(self, cr, uid, patient_ids, user_ids,
+                              context=None):
+        """
+        Removes the visibility of the patients' open activities from
+        users that stopped following them with a single delete from
+        ``activity_user_rel``. Users still following the patient or
+        responsible for the activity location keep it.
+
+        :param patient_ids: :class:`patient<base.nh_clinical_patient>`
+            ids
+        :type patient_ids: list
+        :param user_ids: former followers
+        :type user_ids: list
+        :returns: ``True``
+        :rtype: bool
+        """
+        if not patient_ids or not user_ids:
+            return True
+        cr.execute("""
+            delete from activity_user_rel rel
+            using nh_activity activity
+            where rel.activity_id = activity.id
+                and activity.patient_id in %(patient_ids)s
+                and activity.state not in ('completed', 'cancelled')
+                and activity.data_model != 'nh.clinical.spell'
+                and rel.user_id in %(user_ids)s
+                and not exists (
+                    select 1 from user_patient_rel follower
+                    where follower.patient_id = activity.patient_id
+                        and follower.user_id = rel.user_id)
+                and not exists (
+                    select 1
+                    from user_location_rel ulr
+                    inner join res_groups_users_rel gur
+                        on ulr.user_id = gur.uid
+                    inner join ir_model_access access
+                        on access.group_id = gur.gid
+                        and access.perm_responsibility = true
+                    inner join ir_model model
+                        on model.id = access.model_id
+                    where ulr.user_id = rel.user_id
+                        and ulr.location_id = activity.location_id
+                        and model.model = activity.data_model)
+        """, {'patient_ids': tuple(patient_ids),
+              'user_ids': tuple(user_ids)})
+        return True
+
     def update_spell_users(self, cr, uid, user_ids=None):
         """
         Updates spell activities with the user_ids of users
@@ -356,6 +682,7 @@ class nh_activity_data(orm.AbstractModel):
         self._audit_shift_coordinator(cr, uid, activity_id, context=context)
         return res
 
+    @traced()
     def update_activity(self, cr, uid, activity_id, context=None):
         """
         Extends
@@ -364,10 +691,16 @@ class nh_activity_data(orm.AbstractModel):
 
         :param activity_id: activity id of updated activity
         :type activity_id: int
+        Deferred while the :data:`DEFERRED_UPDATES` context key is set,
+        see :meth:`flush_activity_updates<nh_activity.flush_activity_updates>`.
+
         :returns: ``True``
         :rtype: bool
         """
-
+        deferred = (context or {}).get(DEFERRED_UPDATES)
+        if deferred is not None:
+            deferred.setdefault(activity_id, None)
+            return True
         activity_pool = self.pool['nh.activity']
         activity = activity_pool.browse(cr, uid, activity_id, context=context)
         activity_vals = {}
@@ -495,6 +828,7 @@ class nh_activity_data(orm.AbstractModel):
             patient_id = data.patient_id and data.patient_id.id or False
         return patient_id
 
+    @traced()
     def get_activity_user_ids(self, cr, uid, activity_id, context=None):
         """
         Gets the activity's user ids.
@@ -539,6 +873,7 @@ class nh_activity_data(orm.AbstractModel):
         return list(set(user_ids))
 
     # TODO EOBS-703: Trigger policy method is too large
+    @traced()
     def trigger_policy(self, cr, uid, activity_id, location_id=None,
                        case=False, context=None):
         """
@@ -562,13 +897,10 @@ class nh_activity_data(orm.AbstractModel):
         if self._POLICY.get('activities', []):
             activity = activity_pool.browse(cr, SUPERUSER_ID, activity_id,
                                             context)
-            spell_id = spell_pool.get_by_patient_id(
+            spell_id, spell_activity_id = spell_pool.get_open_spell(
                 cr, SUPERUSER_ID, activity.data_ref.patient_id.id,
                 context=context)
-            if spell_id:
-                spell_activity_id = spell_pool.browse(
-                    cr, uid, spell_id, context=context).activity_id.id
-            else:
+            if not spell_id:
                 return False
 
         else:
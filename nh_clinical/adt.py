@@ -4,15 +4,61 @@
 ``adt.py`` defines a set of activity types to deal with patient
 management systems operations.
 """
+import json
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime as dt
 
+from openerp import tools
 from openerp.osv import orm, fields, osv
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT as DTF
 from openerp import SUPERUSER_ID
 
+from .activity_extension import DEFERRED_UPDATES
+from .api import ADT_RESOLVED
+from .tracing import traced
+
 _logger = logging.getLogger(__name__)
 
+#: What :meth:`nh_clinical_adt_spell_update.should_apply` does with the
+#: spell updates that change nothing, set with the
+#: ``nh_adt_noop_spell_update`` server option or context key: ``'audit'``
+#: records them in ``nh_clinical_adt_spell_update_noop`` (default),
+#: ``'skip'`` just drops them and ``'apply'`` applies them as any other
+NOOP_SPELL_UPDATE_MODES = ('audit', 'skip', 'apply')
+#: How long no-op spell updates are kept in
+#: ``nh_clinical_adt_spell_update_noop``
+NOOP_SPELL_UPDATE_RETENTION = '30 days'
+#: Models whose records stay with the source patient of a patient merge
+MERGE_EXCLUDED_MODELS = ['nh.clinical.notification',
+                         'nh.clinical.patient.observation']
+
+#: Open spell of a patient with the values a spell update can change,
+#: and the ids the given doctor codes resolve to (see
+#: :meth:`get_doctor_ids<base.nh_clinical_doctor.get_doctor_ids>`)
+SPELL_UPDATE_STATE_SQL = """
+    select spell.activity_id, spell.location_id, spell.pos_id, spell.code,
+        spell.start_date,
+        array(select rel.doctor_id from con_doctor_spell_rel rel
+              where rel.spell_id = spell.id) as con_doctor_ids,
+        array(select rel.doctor_id from ref_doctor_spell_rel rel
+              where rel.spell_id = spell.id) as ref_doctor_ids,
+        array(select array[doctor.code, min(doctor.id)::varchar]
+              from nh_clinical_doctor doctor
+              inner join res_partner partner
+                  on partner.id = doctor.partner_id
+              where doctor.code = any(%(codes)s::varchar[])
+                  and partner.active = true
+              group by doctor.code) as doctor_codes
+    from nh_clinical_spell_open open_spell
+    inner join nh_clinical_spell spell on spell.id = open_spell.spell_id
+    where open_spell.patient_id = %(patient_id)s
+"""
+
+_spell_update_counters = {'applied': 0, 'skipped': 0}
+_spell_update_counters_lock = threading.Lock()
+
 
 class nh_clinical_adt_patient_register(orm.Model):
     """
@@ -52,6 +98,7 @@ class nh_clinical_adt_patient_register(orm.Model):
         'title': fields.many2one('res.partner.title', 'Title')
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the patient data is correct and then calls
@@ -66,6 +113,7 @@ class nh_clinical_adt_patient_register(orm.Model):
         return super(nh_clinical_adt_patient_register, self).submit(
             cr, uid, activity_id, data, context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Creates a new instance of
@@ -140,6 +188,7 @@ class nh_clinical_adt_patient_update(orm.Model):
         'title': fields.many2one('res.partner.title', 'Title')
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the patient data is correct and then calls
@@ -154,6 +203,7 @@ class nh_clinical_adt_patient_update(orm.Model):
         return super(nh_clinical_adt_patient_update, self).submit(
             cr, uid, activity_id, data, context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Overwrites the target :mod:`patient<base.nh_clinical_patient>`
@@ -222,6 +272,7 @@ class nh_clinical_adt_patient_admit(orm.Model):
         'doctors': fields.text("Doctors")
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the submitted data and then calls
@@ -236,14 +287,21 @@ class nh_clinical_adt_patient_admit(orm.Model):
         instance of `pos` type, as new Wards will need to be assigned to
         a point of service.
 
+        The user POS and the locations a transfer already resolved (see
+        ``context[ADT_RESOLVED]``) are reused.
+
         :returns: ``True``
         :rtype: bool
         """
-        user = self.pool['res.users'].browse(cr, uid, uid, context=context)
-        if not user.pos_ids:
-            raise osv.except_osv('POS Missing Error!',
-                                 "POS location is not set for user.login = %s!"
-                                 % user.login)
+        resolved = (context or {}).get(ADT_RESOLVED) or {}
+        if not resolved.get('pos_ids'):
+            user_context = self.pool['res.users'].get_user_context(
+                cr, uid, context=context)
+            if not user_context['pos_ids']:
+                raise osv.except_osv(
+                    'POS Missing Error!',
+                    "POS location is not set for user.login = %s!"
+                    % user_context['login'])
         if not vals.get('location'):
             raise osv.except_osv('Admission Error!',
                                  'Location must be set for admission!')
@@ -252,30 +310,24 @@ class nh_clinical_adt_patient_admit(orm.Model):
                 raise osv.except_osv('Admission Error!',
                                      'Patient must be set for admission!')
         location_pool = self.pool['nh.clinical.location']
-        location_id = location_pool.get_by_code(
-            cr, uid, vals['location'], auto_create=True, context=context)
-        location = location_pool.browse(cr, uid, location_id, context=context)
+        location_id = resolved.get('location_ids', {}).get(vals['location'])
+        if not location_id:
+            location_id = location_pool.get_by_code(
+                cr, uid, vals['location'], auto_create=True, context=context)
+        location = location_pool.get_cached_location(
+            cr, uid, location_id=location_id, context=context)
         patient_pool = self.pool['nh.clinical.patient']
-        if vals.get('other_identifier'):
-            patient_pool.check_hospital_number(
-                cr, uid, vals['other_identifier'], exception='False',
-                context=context)
-            patient_id = patient_pool.search(
-                cr, uid, [['other_identifier', '=', vals['other_identifier']]],
-                context=context)[0]
-        else:
-            patient_pool.check_nhs_number(cr, uid, vals['patient_identifier'],
-                                          exception='False', context=context)
-            patient_id = patient_pool.search(
-                cr, uid,
-                [['patient_identifier', '=', vals['patient_identifier']]],
-                context=context)[0]
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=vals.get('other_identifier'),
+            nhs_number=vals.get('patient_identifier'),
+            patient_id=vals.get('patient_id'), context=context)
         data = vals.copy()
         data.update({'location_id': location_id, 'patient_id': patient_id,
-                     'pos_id': location.pos_id.id})
+                     'pos_id': location['pos_id']})
         return super(nh_clinical_adt_patient_admit, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
@@ -283,6 +335,12 @@ class nh_clinical_adt_patient_admit(orm.Model):
         :mod:`admission<operations.nh_clinical_patient_admission>` to
         the provided location.
 
+        The admission is created with its patient, location and POS and
+        its
+        :meth:`update_activity<activity.nh_activity_data.update_activity>`
+        is deferred, so it is applied together with the ones of the
+        spell and movement the admission creates.
+
         :returns: ``True``
         :rtype: bool
         """
@@ -304,13 +362,21 @@ class nh_clinical_adt_patient_admit(orm.Model):
             doctor_pool.evaluate_doctors_dict(cr, uid, admission_data,
                                               context=context)
             del admission_data['doctors']
-        admission_id = admission_pool.create_activity(
-            cr, uid, {'creator_id': activity_id}, admission_data,
-            context=context)
-        activity_pool.complete(cr, uid, admission_id, context=context)
-        spell_id = activity_pool.search(cr, uid, [
-            ['data_model', '=', 'nh.clinical.spell'],
-            ['creator_id', '=', admission_id]], context=context)[0]
+        deferred = OrderedDict()
+        plan_context = dict(context or {}, **{DEFERRED_UPDATES: deferred})
+        admission_id = admission_pool.create_activity(cr, uid, {
+            'creator_id': activity_id,
+            'patient_id': admission_data['patient_id'],
+            'location_id': admission_data['location_id'],
+            'pos_id': admission_data['pos_id']
+        }, admission_data, context=plan_context)
+        # the admission is completed before the spell is started
+        deferred[admission_id] = False
+        activity_pool.complete(cr, uid, admission_id, context=plan_context)
+        activity_pool.flush_activity_updates(cr, uid, context=plan_context)
+        spell_id = activity_pool.read(
+            cr, uid, admission_id, ['parent_id'],
+            context=context)['parent_id'][0]
         activity_pool.write(cr, SUPERUSER_ID, activity_id,
                             {'parent_id': spell_id})
         return res
@@ -332,6 +398,7 @@ class nh_clinical_adt_patient_cancel_admit(orm.Model):
         'admission_id': fields.many2one('nh.activity', 'Admission Activity')
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the submitted data is correct, finding the last completed
@@ -345,11 +412,9 @@ class nh_clinical_adt_patient_cancel_admit(orm.Model):
         if not vals.get('other_identifier'):
             raise osv.except_osv('Cancel Admit Error!', 'Patient must be set!')
         patient_pool = self.pool['nh.clinical.patient']
-        patient_pool.check_hospital_number(cr, uid, vals['other_identifier'],
-                                           exception='False', context=context)
-        patient_id = patient_pool.search(
-            cr, uid, [['other_identifier', '=', vals['other_identifier']]],
-            context=context)[0]
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=vals['other_identifier'],
+            patient_id=vals.get('patient_id'), context=context)
         spell_pool = self.pool['nh.clinical.spell']
         activity_pool = self.pool['nh.activity']
         spell_id = spell_pool.get_by_patient_id(
@@ -366,6 +431,7 @@ class nh_clinical_adt_patient_cancel_admit(orm.Model):
         return super(nh_clinical_adt_patient_cancel_admit, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
@@ -404,6 +470,7 @@ class nh_clinical_adt_patient_discharge(orm.Model):
                                       required=True)
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the submitted data and then calls
@@ -418,32 +485,22 @@ class nh_clinical_adt_patient_discharge(orm.Model):
         :returns: ``True``
         :rtype: bool
         """
-        user = self.pool['res.users'].browse(cr, uid, uid, context=context)
-        if not user.pos_ids:
+        user_context = self.pool['res.users'].get_user_context(
+            cr, uid, context=context)
+        if not user_context['pos_ids']:
             raise osv.except_osv('POS Missing Error!',
                                  "POS location is not set for user.login = %s!"
-                                 % user.login)
+                                 % user_context['login'])
         if not vals.get('other_identifier'):
             if not vals.get('patient_identifier'):
                 raise osv.except_osv('Discharge Error!',
                                      'Patient must be set!')
         data = vals.copy()
         patient_pool = self.pool['nh.clinical.patient']
-        if vals.get('other_identifier'):
-            patient_pool.check_hospital_number(
-                cr, uid, vals['other_identifier'], exception='False',
-                context=context)
-            patient_id = patient_pool.search(
-                cr, uid, [['other_identifier', '=', vals['other_identifier']]],
-                context=context)[0]
-        else:
-            patient_pool.check_nhs_number(
-                cr, uid, vals['patient_identifier'], exception='False',
-                context=context)
-            patient_id = patient_pool.search(
-                cr, uid,
-                [['patient_identifier', '=', vals['patient_identifier']]],
-                context=context)[0]
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=vals.get('other_identifier'),
+            nhs_number=vals.get('patient_identifier'),
+            patient_id=vals.get('patient_id'), context=context)
         if vals.get('discharge_date'):
             discharge_date = vals.get('discharge_date')
         else:
@@ -471,12 +528,12 @@ class nh_clinical_adt_patient_discharge(orm.Model):
             location_pool = self.pool['nh.clinical.location']
             location_id = location_pool.get_by_code(
                 cr, uid, vals['location'], auto_create=True, context=context)
-            location = location_pool.browse(
-                cr, uid, location_id, context=context)
+            location = location_pool.get_cached_location(
+                cr, uid, location_id=location_id, context=context)
             data.update({'location_id': location_id})
             admission_pool = self.pool['nh.clinical.patient.admission']
             admission_data = {
-                'pos_id': location.pos_id.id,
+                'pos_id': location['pos_id'],
                 'patient_id': patient_id,
                 'location_id': location_id,
             }
@@ -495,6 +552,7 @@ class nh_clinical_adt_patient_discharge(orm.Model):
         return super(nh_clinical_adt_patient_discharge, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
@@ -537,6 +595,7 @@ class nh_clinical_adt_patient_cancel_discharge(orm.Model):
         'discharge_id': fields.many2one('nh.activity', 'Discharge Activity')
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the submitted data is correct, finding the last
@@ -551,11 +610,9 @@ class nh_clinical_adt_patient_cancel_discharge(orm.Model):
             raise osv.except_osv('Cancel Discharge Error!',
                                  'Patient must be set!')
         patient_pool = self.pool['nh.clinical.patient']
-        patient_pool.check_hospital_number(cr, uid, vals['other_identifier'],
-                                           exception='False', context=context)
-        patient_id = patient_pool.search(
-            cr, uid, [['other_identifier', '=', vals['other_identifier']]],
-            context=context)[0]
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=vals['other_identifier'],
+            patient_id=vals.get('patient_id'), context=context)
         discharge_pool = self.pool['nh.clinical.patient.discharge']
         discharge_id = discharge_pool.get_last(
             cr, uid, patient_id, exception='False', context=context)
@@ -564,6 +621,7 @@ class nh_clinical_adt_patient_cancel_discharge(orm.Model):
         return super(nh_clinical_adt_patient_cancel_discharge, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
@@ -608,26 +666,32 @@ class nh_clinical_adt_patient_transfer(orm.Model):
                                       required=True)
     }
 
-    def submit(self, cr, uid, activity_id, vals, context=None):
+    def resolve_transfer(self, cr, uid, vals, context=None):
         """
-        Checks the submitted data and then calls
-        :meth:`submit<activity.nh_activity.submit>`.
-
-        Creates a new :mod:`spell<spell.nh_clinical_spell>` for the
-        provided patient if there is not an open instance related to it
-        and an origin location for the transfer was provided.
-        Requires the user to be linked to a
-        :mod:`point of service<base.nh_clinical_pos>` due to similar
-        behaviour as the admission in this particular scenario.
-
-        :returns: ``True``
-        :rtype: bool
+        Checks the transfer data and resolves everything the transfer
+        chain needs once: the user POS, the destination and origin
+        locations (created if they do not exist), the patient and its
+        open spell.
+
+        Admits the patient to the origin location if there is no open
+        spell and an origin location was provided. The admission reuses
+        what is resolved so far.
+
+        :param vals: transfer data
+        :type vals: dict
+        :returns: ``pos_ids``, ``location_ids`` by code, ``location_id``,
+            ``origin_location_id``, ``patient_id``, ``spell_id``,
+            ``spell_activity_id``, ``spell_location_id`` and
+            ``spell_pos_id``. To be passed down the chain in
+            ``context[ADT_RESOLVED]``
+        :rtype: dict
         """
-        user = self.pool['res.users'].browse(cr, uid, uid, context=context)
-        if not user.pos_ids:
+        user_context = self.pool['res.users'].get_user_context(
+            cr, uid, context=context)
+        if not user_context['pos_ids']:
             raise osv.except_osv('POS Missing Error!',
                                  "POS location is not set for user.login = %s!"
-                                 % user.login)
+                                 % user_context['login'])
         if not vals.get('location'):
             raise osv.except_osv('Transfer Error!',
                                  'Location must be set for transfer!')
@@ -636,62 +700,85 @@ class nh_clinical_adt_patient_transfer(orm.Model):
                 raise osv.except_osv('Transfer Error!',
                                      'Patient must be set for transfer!')
         location_pool = self.pool['nh.clinical.location']
-        location_id = location_pool.get_by_code(
-            cr, uid, vals['location'], auto_create=True, context=context)
-
-        if vals.get('original_location'):
-            olocation_id = location_pool.get_by_code(
-                cr, uid, vals.get('original_location'), auto_create=True,
-                context=context)
-        else:
-            olocation_id = False
+        resolved = {'pos_ids': list(user_context['pos_ids']),
+                    'location_ids': {}}
+        for key, code in [('location_id', vals['location']),
+                          ('origin_location_id',
+                           vals.get('original_location'))]:
+            resolved[key] = code and location_pool.get_by_code(
+                cr, uid, code, auto_create=True, context=context) or False
+            if code:
+                resolved['location_ids'][code] = resolved[key]
 
         patient_pool = self.pool['nh.clinical.patient']
-        if vals.get('other_identifier'):
-            patient_pool.check_hospital_number(
-                cr, uid, vals['other_identifier'], exception='False',
-                context=context)
-            patient_id = patient_pool.search(
-                cr, uid, [['other_identifier', '=', vals['other_identifier']]],
-                context=context)[0]
-        else:
-            patient_pool.check_nhs_number(
-                cr, uid, vals['patient_identifier'], exception='False',
-                context=context)
-            patient_id = patient_pool.search(
-                cr, uid,
-                [['patient_identifier', '=', vals['patient_identifier']]],
-                context=context)[0]
+        patient_id = resolved['patient_id'] = patient_pool.get_patient_id(
+            cr, uid, hospital_number=vals.get('other_identifier'),
+            nhs_number=vals.get('patient_identifier'),
+            patient_id=vals.get('patient_id'), context=context)
         spell_pool = self.pool['nh.clinical.spell']
-        activity_pool = self.pool['nh.activity']
-        spell_id = spell_pool.get_by_patient_id(cr, uid, patient_id,
-                                                context=context)
+        spell_id = spell_pool.get_open_spell(cr, uid, patient_id,
+                                             context=context)[0]
         if not spell_id:
-            if olocation_id:
-                api = self.pool['nh.clinical.api']
-                api.admit(cr, uid, vals['other_identifier'],
-                          {'location': vals['original_location']},
-                          context=context)
-                spell_id = spell_pool.get_by_patient_id(cr, uid, patient_id,
-                                                        context=context)
-            else:
+            if not resolved['origin_location_id']:
                 raise osv.except_osv(
                     'Transfer Error!',
                     'Patient does not have an open spell.'
                     'No origin location provided.')
-        spell = spell_pool.browse(cr, uid, spell_id, context=context)
+            api = self.pool['nh.clinical.api']
+            api.admit(cr, uid, vals['other_identifier'],
+                      {'location': vals['original_location']},
+                      context=dict(context or {},
+                                   **{ADT_RESOLVED: resolved}))
+        spell_id, spell_activity_id = spell_pool.get_open_spell(
+            cr, uid, patient_id, context=context)
+        spell = spell_pool.read(cr, uid, spell_id, ['location_id', 'pos_id'],
+                                context=context)
+        resolved.update({
+            'spell_id': spell_id,
+            'spell_activity_id': spell_activity_id,
+            'spell_location_id': spell['location_id'] and
+            spell['location_id'][0],
+            'spell_pos_id': spell['pos_id'] and spell['pos_id'][0]
+        })
+        return resolved
+
+    @traced()
+    def submit(self, cr, uid, activity_id, vals, context=None):
+        """
+        Checks the submitted data and then calls
+        :meth:`submit<activity.nh_activity.submit>`.
+
+        Creates a new :mod:`spell<spell.nh_clinical_spell>` for the
+        provided patient if there is not an open instance related to it
+        and an origin location for the transfer was provided.
+        Requires the user to be linked to a
+        :mod:`point of service<base.nh_clinical_pos>` due to similar
+        behaviour as the admission in this particular scenario.
+
+        Everything is resolved by :meth:`resolve_transfer`, unless the
+        caller already did it and passed the result in
+        ``context[ADT_RESOLVED]``.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        resolved = (context or {}).get(ADT_RESOLVED)
+        if not resolved:
+            resolved = self.resolve_transfer(cr, uid, vals, context=context)
+        activity_pool = self.pool['nh.activity']
         activity_pool.write(
-            cr, uid, activity_id, {'parent_id': spell.activity_id.id},
+            cr, uid, activity_id, {'parent_id': resolved['spell_activity_id']},
             context=context)
         data = vals.copy()
         data.update({
-            'location_id': location_id,
-            'origin_location_id': olocation_id,
-            'patient_id': patient_id
+            'location_id': resolved['location_id'],
+            'origin_location_id': resolved['origin_location_id'],
+            'patient_id': resolved['patient_id']
         })
         return super(nh_clinical_adt_patient_transfer, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
@@ -699,6 +786,12 @@ class nh_clinical_adt_patient_transfer(orm.Model):
         :mod:`transfer<operations.nh_clinical_patient_transfer>` for the
         provided patient.
 
+        The transfer is created with its patient, location and POS and
+        its
+        :meth:`update_activity<activity.nh_activity_data.update_activity>`
+        is deferred, so it is applied together with the one of the
+        movement the transfer may create.
+
         :returns: ``True``
         :rtype: bool
         """
@@ -708,14 +801,22 @@ class nh_clinical_adt_patient_transfer(orm.Model):
         transfer_pool = self.pool['nh.clinical.patient.transfer']
         activity = activity_pool.browse(cr, uid, activity_id, context=context)
         transfer = activity.data_ref
+        spell_activity = activity.parent_id
         transfer_data = {
             'patient_id': transfer.patient_id.id,
             'location_id': transfer.location_id.id
         }
-        transfer_id = transfer_pool.create_activity(
-            cr, uid, {'creator_id': activity_id}, transfer_data,
-            context=context)
-        activity_pool.complete(cr, uid, transfer_id, context=context)
+        deferred = OrderedDict()
+        plan_context = dict(context or {}, **{DEFERRED_UPDATES: deferred})
+        transfer_id = transfer_pool.create_activity(cr, uid, {
+            'creator_id': activity_id,
+            'patient_id': transfer.patient_id.id,
+            'location_id': transfer.location_id.id,
+            'pos_id': spell_activity.pos_id.id
+        }, transfer_data, context=plan_context)
+        deferred[transfer_id] = spell_activity.id
+        activity_pool.complete(cr, uid, transfer_id, context=plan_context)
+        activity_pool.flush_activity_updates(cr, uid, context=plan_context)
         return res
 
 
@@ -735,6 +836,7 @@ class nh_clinical_adt_patient_cancel_transfer(orm.Model):
         'transfer_id': fields.many2one('nh.activity', 'Transfer Activity')
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the submitted data is correct, finding the last
@@ -749,11 +851,9 @@ class nh_clinical_adt_patient_cancel_transfer(orm.Model):
             raise osv.except_osv('Cancel Transfer Error!',
                                  'Patient must be set!')
         patient_pool = self.pool['nh.clinical.patient']
-        patient_pool.check_hospital_number(cr, uid, vals['other_identifier'],
-                                           exception='False', context=context)
-        patient_id = patient_pool.search(
-            cr, uid, [['other_identifier', '=', vals['other_identifier']]],
-            context=context)[0]
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=vals['other_identifier'],
+            patient_id=vals.get('patient_id'), context=context)
         transfer_pool = self.pool['nh.clinical.patient.transfer']
         transfer_id = transfer_pool.get_last(
             cr, uid, patient_id, exception='False', context=context)
@@ -762,6 +862,7 @@ class nh_clinical_adt_patient_cancel_transfer(orm.Model):
         return super(nh_clinical_adt_patient_cancel_transfer, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
@@ -806,6 +907,173 @@ class nh_clinical_adt_spell_update(orm.Model):
         'doctors': fields.text("Doctors"),
     }
 
+    def init(self, cr):
+        cr.execute("""
+            select 1 from information_schema.tables
+            where table_name = 'nh_clinical_adt_spell_update_noop'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                create table nh_clinical_adt_spell_update_noop (
+                    id serial primary key,
+                    patient_id integer not null,
+                    spell_activity_id integer,
+                    data text,
+                    create_uid integer,
+                    create_date timestamp not null
+                );
+                create index nh_clinical_adt_spell_update_noop_date_idx
+                    on nh_clinical_adt_spell_update_noop (create_date);
+            """)
+
+    def get_spell_changes(self, cr, uid, patient_id, vals, context=None):
+        """
+        Compares the values of a spell update with the open spell of the
+        patient, read with a single query, the way :meth:`complete`
+        would apply them.
+
+        :param patient_id: :mod:`patient<base.nh_clinical_patient>` id
+        :type patient_id: int
+        :param vals: spell update values, with the ``location`` code
+        :type vals: dict
+        :returns: the spell :mod:`activity<activity.nh_activity>` id
+            (``False`` if there is no open spell) and the names of the
+            changed values. The location only changes if the patient is
+            not within the location with the given code.
+        :rtype: tuple
+        """
+        doctors = []
+        if vals.get('doctors'):
+            try:
+                doctors = self.pool['nh.clinical.doctor']._parse_doctors(
+                    vals['doctors'])
+            except (ValueError, SyntaxError):
+                doctors = None
+        cr.execute(SPELL_UPDATE_STATE_SQL, {
+            'patient_id': patient_id,
+            'codes': [d['code'] for d in doctors or []]})
+        spell = cr.dictfetchone()
+        if not spell:
+            return False, ['spell']
+        changes = []
+        location_pool = self.pool['nh.clinical.location']
+        location = vals.get('location') and location_pool.get_cached_location(
+            cr, uid, code=vals['location'], context=context)
+        current = location_pool.get_cached_location(
+            cr, uid, location_id=spell['location_id'], context=context)
+        if not location or not current or \
+                location['id'] not in current['path_ids']:
+            changes.append('location')
+        elif location['pos_id'] != spell['pos_id']:
+            changes.append('pos_id')
+        if (vals.get('code') or False) != (spell['code'] or False):
+            changes.append('code')
+        start_date = spell['start_date'] and \
+            spell['start_date'].strftime(DTF)
+        if (vals.get('start_date') or False) != (start_date or False):
+            changes.append('start_date')
+        doctor_ids = dict((code, int(doctor_id))
+                          for code, doctor_id in spell['doctor_codes'])
+        if doctors is None or \
+                any(d['code'] not in doctor_ids for d in doctors):
+            changes.append('doctors')
+            return spell['activity_id'], changes
+        ref_doctor_ids = set(doctor_ids[d['code']] for d in doctors
+                             if d['type'] == 'r')
+        con_doctor_ids = set(doctor_ids[d['code']] for d in doctors
+                             if d['type'] != 'r')
+        if doctors:
+            # doctors of a type missing in the message are kept
+            ref_doctor_ids = ref_doctor_ids or set(spell['ref_doctor_ids'])
+            con_doctor_ids = con_doctor_ids or set(spell['con_doctor_ids'])
+        if ref_doctor_ids != set(spell['ref_doctor_ids']) or \
+                con_doctor_ids != set(spell['con_doctor_ids']):
+            changes.append('doctors')
+        return spell['activity_id'], changes
+
+    def should_apply(self, cr, uid, patient_id, vals, context=None):
+        """
+        Tells whether a spell update has to be applied. Updates that
+        change nothing (see :meth:`get_spell_changes`) are not, unless
+        the ``nh_adt_noop_spell_update`` mode (see
+        ``NOOP_SPELL_UPDATE_MODES``) is ``'apply'``. In ``'audit'`` mode
+        they are recorded in ``nh_clinical_adt_spell_update_noop``.
+        Skipped updates still need the access rights and the point of
+        service :meth:`submit` requires.
+
+        :param patient_id: :mod:`patient<base.nh_clinical_patient>` id
+        :type patient_id: int
+        :param vals: spell update values
+        :type vals: dict
+        :returns: ``True`` if the update has to be applied
+        :rtype: bool
+        """
+        mode = (context or {}).get(
+            'nh_adt_noop_spell_update',
+            tools.config.get('nh_adt_noop_spell_update', 'audit'))
+        if mode not in NOOP_SPELL_UPDATE_MODES:
+            _logger.warn("Unknown no-op spell update mode %s", mode)
+            mode = 'audit'
+        changes = []
+        if mode != 'apply':
+            spell_activity_id, changes = self.get_spell_changes(
+                cr, uid, patient_id, vals, context=context)
+        if mode == 'apply' or changes:
+            self._count_spell_update('applied')
+            return True
+        # A skipped update must be refused as an applied one would be
+        self.check_access_rights(cr, uid, 'create')
+        user_context = self.pool['res.users'].get_user_context(
+            cr, uid, context=context)
+        if not user_context['pos_ids']:
+            raise osv.except_osv('POS Missing Error!',
+                                 "POS location is not set for user.login = %s!"
+                                 % user_context['login'])
+        if mode == 'audit':
+            cr.execute("""
+                insert into nh_clinical_adt_spell_update_noop
+                    (patient_id, spell_activity_id, data, create_uid,
+                     create_date)
+                values (%s, %s, %s, %s, now() at time zone 'UTC')
+            """, (patient_id, spell_activity_id,
+                  json.dumps(vals, default=repr), uid))
+        self._count_spell_update('skipped')
+        _logger.debug("Spell update of patient.id=%s skipped, nothing "
+                      "changed", patient_id)
+        return False
+
+    def _count_spell_update(self, outcome):
+        with _spell_update_counters_lock:
+            _spell_update_counters[outcome] += 1
+
+    def get_update_counters(self, cr, uid, context=None):
+        """
+        Gets the number of spell updates applied and skipped by
+        :meth:`should_apply` since this server process started.
+
+        :returns: ``applied`` and ``skipped`` counts
+        :rtype: dict
+        """
+        with _spell_update_counters_lock:
+            return dict(_spell_update_counters)
+
+    def prune_noop_updates(self, cr, uid, context=None):
+        """
+        Removes the no-op spell updates recorded longer than
+        ``NOOP_SPELL_UPDATE_RETENTION`` ago. Called by the
+        ``ir_cron_prune_adt_noop_spell_updates`` scheduled action.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        cr.execute("""
+            delete from nh_clinical_adt_spell_update_noop
+            where create_date < now() at time zone 'UTC' - interval %s
+        """, (NOOP_SPELL_UPDATE_RETENTION,))
+        _logger.debug("%s no-op spell updates removed.", cr.rowcount)
+        return True
+
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the submitted data and then calls
@@ -823,11 +1091,12 @@ class nh_clinical_adt_spell_update(orm.Model):
         :returns: ``True``
         :rtype: bool
         """
-        user = self.pool['res.users'].browse(cr, uid, uid, context=context)
-        if not user.pos_ids:
+        user_context = self.pool['res.users'].get_user_context(
+            cr, uid, context=context)
+        if not user_context['pos_ids']:
             raise osv.except_osv('POS Missing Error!',
                                  "POS location is not set for user.login = %s!"
-                                 % user.login)
+                                 % user_context['login'])
         if not vals.get('location'):
             raise osv.except_osv('Update Error!',
                                  'Location must be set for spell update!')
@@ -838,23 +1107,13 @@ class nh_clinical_adt_spell_update(orm.Model):
         location_pool = self.pool['nh.clinical.location']
         location_id = location_pool.get_by_code(
             cr, uid, vals['location'], auto_create=True, context=context)
-        location = location_pool.browse(cr, uid, location_id, context=context)
+        location = location_pool.get_cached_location(
+            cr, uid, location_id=location_id, context=context)
         patient_pool = self.pool['nh.clinical.patient']
-        if vals.get('other_identifier'):
-            patient_pool.check_hospital_number(
-                cr, uid, vals['other_identifier'], exception='False',
-                context=context)
-            patient_id = patient_pool.search(
-                cr, uid, [['other_identifier', '=', vals['other_identifier']]],
-                context=context)[0]
-        else:
-            patient_pool.check_nhs_number(
-                cr, uid, vals['patient_identifier'], exception='False',
-                context=context)
-            patient_id = patient_pool.search(
-                cr, uid,
-                [['patient_identifier', '=', vals['patient_identifier']]],
-                context=context)[0]
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=vals.get('other_identifier'),
+            nhs_number=vals.get('patient_identifier'),
+            patient_id=vals.get('patient_id'), context=context)
         spell_pool = self.pool['nh.clinical.spell']
         activity_pool = self.pool['nh.activity']
         spell_id = spell_pool.get_by_patient_id(cr, uid, patient_id,
@@ -870,11 +1129,12 @@ class nh_clinical_adt_spell_update(orm.Model):
         data.update({
             'location_id': location_id,
             'patient_id': patient_id,
-            'pos_id': location.pos_id.id
+            'pos_id': location['pos_id']
         })
         return super(nh_clinical_adt_spell_update, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Overwrites the target :mod:`spell<spell.nh_clinical_spell>`
@@ -952,8 +1212,10 @@ class nh_clinical_adt_patient_merge(orm.Model):
         'into_identifier': fields.char('Destination Identifier', size=100),
         'dest_patient_id': fields.many2one('nh.clinical.patient',
                                            'Destination Patient'),
+        'rows_moved': fields.text('Rows Moved', readonly=True),
     }
 
+    @traced()
     def submit(self, cr, uid, activity_id, vals, context=None):
         """
         Checks the submitted data and then calls
@@ -965,24 +1227,19 @@ class nh_clinical_adt_patient_merge(orm.Model):
         patient_pool = self.pool['nh.clinical.patient']
         data = vals.copy()
         if data.get('from_identifier'):
-            patient_pool.check_hospital_number(
-                cr, uid, data['from_identifier'], exception='False',
+            from_id = patient_pool.get_patient_id(
+                cr, uid, hospital_number=data['from_identifier'],
                 context=context)
-            from_id = patient_pool.search(
-                cr, uid, [('other_identifier', '=', data['from_identifier'])]
-            )[0]
             data.update({'source_patient_id': from_id})
         if data.get('into_identifier'):
-            patient_pool.check_hospital_number(
-                cr, uid, data['into_identifier'], exception='False',
+            into_id = patient_pool.get_patient_id(
+                cr, uid, hospital_number=data['into_identifier'],
                 context=context)
-            into_id = patient_pool.search(
-                cr, uid, [('other_identifier', '=', data['into_identifier'])]
-            )[0]
             data.update({'dest_patient_id': into_id})
         return super(nh_clinical_adt_patient_merge, self).submit(
             cr, uid, activity_id, data, context=context)
 
+    @traced()
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
@@ -990,13 +1247,14 @@ class nh_clinical_adt_patient_merge(orm.Model):
         the destination patient lacks into the destination patient.
 
         The destination patient ends up being linked to all the
-        :class:`activities<activity.nh_activity>` both patients were
-        linked to.
+        :class:`activities<activity.nh_activity>` and records both
+        patients were linked to (see
+        :meth:`merge<base.nh_clinical_patient.merge>`). The number of
+        rows moved per table is kept in ``rows_moved``.
 
         :returns: ``True``
         :rtype: bool
         """
-        res = {}
         activity_pool = self.pool['nh.activity']
         merge_activity = activity_pool.browse(
             cr, SUPERUSER_ID, activity_id, context=context)
@@ -1013,40 +1271,16 @@ class nh_clinical_adt_patient_merge(orm.Model):
         patient_pool = self.pool['nh.clinical.patient']
         from_id = merge_activity.data_ref.source_patient_id.id
         into_id = merge_activity.data_ref.dest_patient_id.id
-
-        for model_name in self.pool.models.keys():
-            model_pool = self.pool[model_name]
-            if model_name.startswith("nh.clinical") and model_pool._auto and \
-                'patient_id' in model_pool._columns.keys() and \
-                model_name != self._name and \
-                model_name != 'nh.clinical.notification' and model_name != \
-                    'nh.clinical.patient.observation':
-                ids = model_pool.search(
-                    cr, uid, [('patient_id', '=', from_id)], context=context)
-                if ids:
-                    model_pool.write(cr, uid, ids, {'patient_id': into_id},
-                                     context=context)
-        activity_ids = activity_pool.search(
-            cr, uid, [('patient_id', '=', from_id)], context=context)
-        activity_pool.write(cr, uid, activity_ids,
-                            {'patient_id': into_id}, context=context)
-        from_data = patient_pool.read(cr, uid, from_id, context)
-        into_data = patient_pool.read(cr, uid, into_id, context)
-        vals_into = {}
-        for key, value in from_data.iteritems():
-            if not value:
-                continue
-            if value and into_data[key] and value != into_data[key]:
-                pass
-            if value and not into_data[key]:
-                if '_id' == key[-3:]:
-                    vals_into.update({key: value[0]})
-                else:
-                    vals_into.update({key: value})
-        res['merge_into_update'] = patient_pool.write(
-            cr, uid, into_id, vals_into, context=context)
-        res['merge_from_deactivate'] = patient_pool.write(
-            cr, uid, from_id, {'active': False}, context=context)
+        exclude_tables = [self._table] + [
+            self.pool[model]._table for model in MERGE_EXCLUDED_MODELS
+            if model in self.pool and self.pool[model]._auto]
+        res = patient_pool.merge(cr, uid, from_id, into_id,
+                                 exclude_tables=exclude_tables,
+                                 context=context)
+        self.write(cr, uid, merge_activity.data_ref.id, {
+            'rows_moved': '\n'.join(
+                '%s: %s' % item for item in sorted(res['rows_moved'].items()))
+        }, context=context)
         activity_pool.write(cr, uid, activity_id, {'patient_id': into_id},
                             context=context)
         return res
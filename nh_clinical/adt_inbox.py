@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+"""
+``adt_inbox.py`` defines a durable inbox for ADT messages, applied by
+parallel workers while keeping the messages of every patient in order.
+"""
+import json
+import logging
+import threading
+import time
+from datetime import datetime as dt
+
+import psycopg2
+from openerp import api
+from openerp.osv import fields, osv
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT as DTF
+
+from .api import BATCH_MESSAGE_TYPES
+
+_logger = logging.getLogger(__name__)
+
+#: Messages claimed by a worker per transaction
+INBOX_CLAIM_SIZE = 50
+#: Failed attempts after which a message is dead-lettered
+INBOX_MAX_ATTEMPTS = 5
+#: Retry delay in seconds after the first failed attempt, doubled after
+#: every further failure up to ``INBOX_MAX_BACKOFF``
+INBOX_BACKOFF = 30
+INBOX_MAX_BACKOFF = 3600
+#: Workers started by :meth:`nh_clinical_adt_inbox.run_workers`
+INBOX_WORKERS = 4
+#: Seconds :meth:`nh_clinical_adt_inbox.run_workers` keeps claiming
+#: messages for
+INBOX_RUN_SECONDS = 50
+
+#: Pending messages that can be claimed: the oldest pending message of
+#: every hospital number, once its retry delay is over
+CLAIM_SQL = """
+    select inbox.id, inbox.message_id, inbox.message_type,
+        inbox.hospital_number, inbox.data
+    from nh_clinical_adt_inbox inbox
+    where inbox.state = 'pending'
+        and inbox.next_attempt <= (now() at time zone 'UTC')
+        and not exists (
+            select 1 from nh_clinical_adt_inbox prior
+            where prior.hospital_number = inbox.hospital_number
+                and prior.state = 'pending' and prior.id < inbox.id)
+        {claimed}
+    order by inbox.id
+    limit %(limit)s
+"""
+
+#: Takes the transaction level advisory lock of every given hospital
+#: number that no other worker holds. A worker only applies the messages
+#: of the hospital numbers it holds the lock of, so the messages of a
+#: patient are only applied by one worker at a time and in the order
+#: they were received.
+LOCK_SQL = """
+    select hospital_number, pg_try_advisory_xact_lock(
+        hashtext('nh_clinical_adt_inbox'), hashtext(hospital_number))
+    from unnest(%s) hospital_number
+"""
+
+#: Indexes backing :data:`CLAIM_SQL`
+INBOX_INDEXES = {
+    'nh_clinical_adt_inbox_pending_patient_idx':
+        "(hospital_number, id) where state = 'pending'",
+    'nh_clinical_adt_inbox_pending_next_attempt_idx':
+        "(next_attempt, id) where state = 'pending'"
+}
+
+
+class nh_clinical_adt_inbox(osv.Model):
+    """
+    ADT message waiting to be applied through
+    :meth:`process_batch<api.nh_clinical_api.process_batch>`.
+
+    Messages are partitioned by hospital number: different patients are
+    processed concurrently by the workers, while the messages of a
+    patient are applied one after the other. A failed message is retried
+    with an exponential backoff, holding back the later messages of the
+    patient, and dead-lettered after ``INBOX_MAX_ATTEMPTS`` attempts so
+    they can go on. Merges are ordered by the hospital number they merge
+    into only.
+    """
+
+    _name = 'nh.clinical.adt.inbox'
+    _description = 'ADT Inbox Message'
+    _order = 'id'
+
+    _states = [['pending', 'Pending'], ['done', 'Done'],
+               ['dead', 'Dead Letter']]
+    _message_types = [[t, t.replace('_', ' ').title()]
+                      for t in sorted(BATCH_MESSAGE_TYPES)]
+
+    _columns = {
+        'message_id': fields.char('Message Id', size=100),
+        'message_type': fields.selection(_message_types, 'Message Type',
+                                         required=True),
+        'hospital_number': fields.char('Hospital Number', size=100),
+        'data': fields.text('Data', help="JSON encoded message data"),
+        'state': fields.selection(_states, 'State', required=True,
+                                  readonly=True),
+        'attempts': fields.integer('Attempts', readonly=True),
+        'next_attempt': fields.datetime('Next Attempt', required=True),
+        'last_error': fields.text('Last Error', readonly=True),
+        'result': fields.text('Result', readonly=True),
+        'date_processed': fields.datetime('Date Processed', readonly=True)
+    }
+
+    _defaults = {
+        'state': 'pending',
+        'attempts': 0,
+        'next_attempt': lambda *a: dt.utcnow().strftime(DTF)
+    }
+
+    def init(self, cr):
+        for index, definition in INBOX_INDEXES.items():
+            cr.execute("select 1 from pg_indexes where indexname = %s",
+                       (index,))
+            if not cr.fetchone():
+                cr.execute("create index {index} on {table} {definition}"
+                           .format(index=index, table=self._table,
+                                   definition=definition))
+
+    def enqueue(self, cr, uid, messages, context=None):
+        """
+        Stores ADT messages to be applied by the workers, with a single
+        ``INSERT``.
+
+        :param messages: messages as taken by
+            :meth:`process_batch<api.nh_clinical_api.process_batch>`
+        :type messages: list
+        :returns: inbox message ids, in the order of ``messages``
+        :rtype: list
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if a
+            message type is not supported or a message has no hospital
+            number
+        """
+        if not messages:
+            return []
+        now = dt.utcnow().strftime(DTF)
+        for message in messages:
+            if message.get('type') not in BATCH_MESSAGE_TYPES:
+                raise osv.except_osv(
+                    'ADT Inbox Error!',
+                    'Unknown message type %s' % message.get('type'))
+            if not message.get('hospital_number'):
+                raise osv.except_osv(
+                    'ADT Inbox Error!',
+                    'Hospital number missing in %s message' %
+                    message['type'])
+        # ids are taken from the sequence first and assigned in the order
+        # of the messages (which is the order they are applied in),
+        # RETURNING gives no order guarantee
+        cr.execute("""
+            select nextval('nh_clinical_adt_inbox_id_seq')
+            from generate_series(1, %s)
+        """, (len(messages),))
+        ids = sorted(row[0] for row in cr.fetchall())
+        values = [cr.mogrify(
+            "(%s, %s, %s, %s, %s, 'pending', 0, %s, %s, %s, %s, %s)", (
+                message_id, message.get('message_id') or None,
+                message['type'], message['hospital_number'],
+                json.dumps(message.get('data') or {}), now,
+                uid, now, uid, now))
+            for message_id, message in zip(ids, messages)]
+        cr.execute("""
+            insert into nh_clinical_adt_inbox
+                (id, message_id, message_type, hospital_number, data, state,
+                 attempts, next_attempt, create_uid, create_date, write_uid,
+                 write_date)
+            values {values}
+        """.format(values=', '.join(values)))
+        return ids
+
+    def process_pending(self, cr, uid, limit=None, context=None):
+        """
+        Claims the messages that can be applied now (see
+        :data:`CLAIM_SQL` and :data:`LOCK_SQL`), applies them and
+        records their outcome, in the current transaction. Committing is
+        left to the caller.
+
+        :param limit: maximum number of messages claimed. Default is
+            ``INBOX_CLAIM_SIZE``
+        :type limit: int
+        :returns: number of messages ``claimed``, ``done``, ``retried``
+            and ``dead``-lettered
+        :rtype: dict
+        """
+        counts = dict.fromkeys(['claimed', 'done', 'retried', 'dead'], 0)
+        params = {'limit': limit or INBOX_CLAIM_SIZE}
+        cr.execute(CLAIM_SQL.format(claimed=''), params)
+        hospital_numbers = sorted(
+            set(row['hospital_number'] for row in cr.dictfetchall()))
+        if not hospital_numbers:
+            return counts
+        cr.execute(LOCK_SQL, (hospital_numbers,))
+        params['hospital_numbers'] = tuple(
+            hospital_number for hospital_number, locked in cr.fetchall()
+            if locked)
+        if not params['hospital_numbers']:
+            return counts
+        # Claim again now the locks are held: another worker may have
+        # applied some of the messages since they were read
+        cr.execute(CLAIM_SQL.format(
+            claimed='and inbox.hospital_number in %(hospital_numbers)s') +
+            "for update of inbox", params)
+        rows = cr.dictfetchall()
+        if not rows:
+            return counts
+        counts['claimed'] = len(rows)
+        outcomes = self.pool['nh.clinical.api'].process_batch(cr, uid, [{
+            'message_id': row['message_id'],
+            'type': row['message_type'],
+            'hospital_number': row['hospital_number'],
+            'data': json.loads(row['data'] or '{}')
+        } for row in rows], context=context)
+        for row, outcome in zip(rows, outcomes):
+            if outcome['status'] == 'done':
+                cr.execute("""
+                    update nh_clinical_adt_inbox
+                    set state = 'done', attempts = attempts + 1,
+                        result = %s, last_error = null,
+                        date_processed = (now() at time zone 'UTC'),
+                        write_uid = %s, write_date = (now() at time zone 'UTC')
+                    where id = %s
+                """, (json.dumps(outcome['result'], default=repr), uid,
+                      row['id']))
+                counts['done'] += 1
+                continue
+            cr.execute("""
+                update nh_clinical_adt_inbox
+                set attempts = attempts + 1, last_error = %(error)s,
+                    state = case when attempts + 1 >= %(max_attempts)s
+                        then 'dead' else 'pending' end,
+                    next_attempt = (now() at time zone 'UTC') +
+                        least(%(backoff)s * power(2, attempts),
+                              %(max_backoff)s) * interval '1 second',
+                    write_uid = %(uid)s,
+                    write_date = (now() at time zone 'UTC')
+                where id = %(id)s
+                returning state, attempts
+            """, {'error': outcome['error'],
+                  'max_attempts': INBOX_MAX_ATTEMPTS,
+                  'backoff': INBOX_BACKOFF, 'max_backoff': INBOX_MAX_BACKOFF,
+                  'uid': uid, 'id': row['id']})
+            state, attempts = cr.fetchone()
+            if state == 'dead':
+                _logger.error(
+                    "ADT inbox message %s (%s) dead-lettered after %s "
+                    "attempts: %s", row['id'], row['message_type'], attempts,
+                    outcome['error'])
+                counts['dead'] += 1
+            else:
+                counts['retried'] += 1
+        return counts
+
+    def requeue(self, cr, uid, ids, context=None):
+        """
+        Puts dead-lettered messages back in the inbox to be retried
+        straight away, e.g. once the data they depend on is fixed.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        dead_ids = self.search(cr, uid, [['id', 'in', ids],
+                                         ['state', '=', 'dead']],
+                               context=context)
+        return self.write(cr, uid, dead_ids, {
+            'state': 'pending', 'attempts': 0,
+            'next_attempt': dt.utcnow().strftime(DTF)}, context=context)
+
+    def run_workers(self, cr, uid, workers=None, max_seconds=None,
+                    context=None):
+        """
+        Applies the pending messages with several workers, each one in
+        its own thread and cursor, committing after every claim. Workers
+        stop once nothing can be claimed or after ``max_seconds``. Used
+        by the inbox cron job and usable from a standalone runner.
+
+        :param workers: number of workers. Default is ``INBOX_WORKERS``
+        :type workers: int
+        :param max_seconds: time budget. Default is ``INBOX_RUN_SECONDS``
+        :type max_seconds: int
+        :returns: number of messages ``claimed``, ``done``, ``retried``
+            and ``dead``-lettered by all the workers
+        :rtype: dict
+        """
+        deadline = time.time() + (max_seconds or INBOX_RUN_SECONDS)
+        totals = dict.fromkeys(['claimed', 'done', 'retried', 'dead'], 0)
+        lock = threading.Lock()
+        threads = [threading.Thread(
+            target=self._run_worker,
+            args=(cr.dbname, uid, deadline, totals, lock, context),
+            name='nh_adt_inbox_worker_%s' % index)
+            for index in range(workers or INBOX_WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        _logger.info("ADT inbox workers finished: %s", totals)
+        return totals
+
+    def _run_worker(self, dbname, uid, deadline, totals, lock, context):
+        threading.current_thread().dbname = dbname
+        with api.Environment.manage():
+            cr = self.pool.cursor()
+            try:
+                while time.time() < deadline:
+                    try:
+                        counts = self.process_pending(cr, uid,
+                                                      context=context)
+                        cr.commit()
+                    except psycopg2.OperationalError:
+                        # Concurrent update of a claimed row, claim again
+                        cr.rollback()
+                        continue
+                    except Exception:
+                        cr.rollback()
+                        _logger.exception("ADT inbox worker failed")
+                        break
+                    with lock:
+                        for key, count in counts.items():
+                            totals[key] += count
+                    if not counts['claimed']:
+                        break
+            finally:
+                cr.close()
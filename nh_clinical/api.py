@@ -4,19 +4,183 @@
 ``api.py`` defines the core methods to interface with the
 :mod:`adt` module.
 """
+import functools
+import json
 import logging
 
+import psycopg2
+from openerp import tools
 from openerp.osv import orm
 
+from .tracing import traced
 
 _logger = logging.getLogger(__name__)
 
+#: ADT message types accepted by :meth:`nh_clinical_api.process_batch`
+#: and whether the API method applying them takes a ``data`` dictionary
+BATCH_MESSAGE_TYPES = {
+    'register': True,
+    'update': True,
+    'admit': True,
+    'admit_update': True,
+    'cancel_admit': False,
+    'discharge': True,
+    'cancel_discharge': False,
+    'merge': True,
+    'transfer': True,
+    'cancel_transfer': False
+}
+
+#: Context key holding what an ADT transfer resolved up front: the user
+#: POS, the locations by code, the patient and the open spell (see
+#: :meth:`adt.nh_clinical_adt_patient_transfer.resolve_transfer`).
+#: It is reused down the transfer chain and by the admission a transfer
+#: may need.
+ADT_RESOLVED = 'nh_adt_resolved'
+
+#: How long processed ADT message ids are kept in the ledger, i.e. how
+#: late a resent message is still recognised
+MESSAGE_LEDGER_RETENTION = '30 days'
+
+
+def idempotent(method):
+    """
+    Gives an API method an optional ``message_id`` argument. A message
+    id found in the ``nh_clinical_adt_message_ledger`` table is a resent
+    message: the original result is returned with a single primary key
+    lookup and nothing is applied again. Otherwise the message id is
+    claimed in the ledger before the method runs and its result is
+    recorded in the same transaction as the changes.
+
+    Deliveries of the same message id are serialized with a transaction
+    level advisory lock, so a concurrent delivery waits for the first
+    one. If the first delivery committed after this transaction took its
+    snapshot the claim fails on the primary key, and the stored result
+    is read with a new cursor instead.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, cr, uid, *args, **kwargs):
+        message_id = kwargs.pop('message_id', None)
+        if not message_id:
+            return method(self, cr, uid, *args, **kwargs)
+        cr.execute("select pg_advisory_xact_lock(hashtext(%s))",
+                   (message_id,))
+        cr.execute("""
+            select result from nh_clinical_adt_message_ledger
+            where message_id = %s
+        """, (message_id,))
+        row = cr.fetchone()
+        if not row:
+            cr.execute("savepoint nh_adt_message_ledger")
+            try:
+                cr.execute("""
+                    insert into nh_clinical_adt_message_ledger
+                        (message_id, method, processed_at)
+                    values (%s, %s, now() at time zone 'UTC')
+                """, (message_id, method.__name__))
+            except psycopg2.IntegrityError:
+                # Committed by a concurrent delivery after our snapshot
+                cr.execute("rollback to savepoint nh_adt_message_ledger")
+                ledger_cr = self.pool.cursor()
+                try:
+                    ledger_cr.execute("""
+                        select result from nh_clinical_adt_message_ledger
+                        where message_id = %s
+                    """, (message_id,))
+                    row = ledger_cr.fetchone()
+                finally:
+                    ledger_cr.close()
+            else:
+                cr.execute("release savepoint nh_adt_message_ledger")
+        if row:
+            _logger.info("ADT message %s already processed, skipping %s",
+                         message_id, method.__name__)
+            return json.loads(row[0])
+        result = method(self, cr, uid, *args, **kwargs)
+        cr.execute("""
+            update nh_clinical_adt_message_ledger set result = %s
+            where message_id = %s
+        """, (json.dumps(result, default=repr), message_id))
+        return result
+    wrapper.__wrapped__ = method
+    return wrapper
+
 
 class nh_clinical_api(orm.AbstractModel):
     """Core API for nh_clinical"""
 
     _name = 'nh.clinical.api'
 
+    def init(self, cr):
+        cr.execute("""
+            select 1 from information_schema.tables
+            where table_name = 'nh_clinical_adt_message_ledger'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                create table nh_clinical_adt_message_ledger (
+                    message_id varchar primary key,
+                    method varchar not null,
+                    result text,
+                    processed_at timestamp not null
+                );
+                create index nh_clinical_adt_message_ledger_processed_at_idx
+                    on nh_clinical_adt_message_ledger (processed_at);
+            """)
+
+    def prune_message_ledger(self, cr, uid, context=None):
+        """
+        Removes the message ids processed longer than
+        ``MESSAGE_LEDGER_RETENTION`` ago from the ledger. Called by the
+        ``ir_cron_prune_adt_message_ledger`` scheduled action.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        cr.execute("""
+            delete from nh_clinical_adt_message_ledger
+            where processed_at < now() at time zone 'UTC' - interval %s
+        """, (MESSAGE_LEDGER_RETENTION,))
+        _logger.debug("%s processed ADT message ids removed.", cr.rowcount)
+        return True
+
+    def _check_patient(self, cr, uid, hospital_number, data, warning=None,
+                       context=None):
+        """
+        Resolves the patient an ADT message refers to with
+        :meth:`resolve_patient<patient.nh_clinical_patient.resolve_patient>`.
+        A patient only found by NHS number gets the hospital number and
+        an unknown patient is registered. The patient id is then added to
+        ``data`` so the ADT activities don't look it up again.
+
+        :param warning: message logged if the patient is registered
+        :type warning: str
+        :returns: patient id
+        :rtype: int
+        """
+
+        patient_pool = self.pool['nh.clinical.patient']
+        patient_id, match = patient_pool.resolve_patient(
+            cr, uid, hospital_number=hospital_number,
+            nhs_number=data.get('patient_identifier'), context=context)
+        if match == 'nhs_number':
+            nhs_data = data.copy()
+            nhs_data['other_identifier'] = hospital_number
+            patient_pool.write(cr, uid, patient_id, nhs_data,
+                               context=context)
+        elif not match:
+            if warning:
+                _logger.warn("%s - data available:%s", warning, data)
+            self.register(cr, uid, hospital_number, data, context=context)
+            patient_id = patient_pool.get_patient_id(
+                cr, uid, hospital_number=hospital_number,
+                nhs_number=data.get('patient_identifier'), context=context)
+        data['patient_id'] = patient_id
+        return patient_id
+
+    @traced(root=True)
+    @idempotent
     def update(self, cr, uid, hospital_number, data, context=None):
         """
         Update patient information.
@@ -34,19 +198,11 @@ class nh_clinical_api(orm.AbstractModel):
         activity_pool = self.pool['nh.activity']
         patient_pool = self.pool['nh.clinical.patient']
         update_pool = self.pool['nh.clinical.adt.patient.update']
-        if not patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                                  context=context):
-            nhs_data = data.copy()
-            nhs_data['other_identifier'] = hospital_number
-            if not patient_pool.check_nhs_number(
-                    cr, uid, data.get('patient_identifier'), context=context):
-                _logger.warn("Patient registered from an update call - "
-                             "data available:%s", data)
-                self.register(cr, uid, hospital_number, data, context=context)
-            else:
-                patient_pool.update(cr, uid, data.get('patient_identifier'),
-                                    nhs_data, selection='patient_identifier',
-                                    context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        self._check_patient(cr, uid, hospital_number, data,
+                            warning="Patient registered from an update call",
+                            context=context)
         if hospital_number:
             data.update({'other_identifier': hospital_number})
         update_activity = update_pool.create_activity(cr, uid, {}, {},
@@ -57,6 +213,8 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Patient updated\n data: %s", data)
         return res
 
+    @traced(root=True)
+    @idempotent
     def register(self, cr, uid, hospital_number, data, context=None):
         """
         Registers a new patient in the system.
@@ -82,6 +240,8 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Patient registered\n data: %s", data)
         return res
 
+    @traced(root=True)
+    @idempotent
     def admit(self, cr, uid, hospital_number, data, context=None):
         """
         Admits a patient into a specified location.
@@ -100,17 +260,9 @@ class nh_clinical_api(orm.AbstractModel):
         activity_pool = self.pool['nh.activity']
         patient_pool = self.pool['nh.clinical.patient']
         admit_pool = self.pool['nh.clinical.adt.patient.admit']
-        if not patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                                  context=context):
-            nhs_data = data.copy()
-            nhs_data['other_identifier'] = hospital_number
-            if patient_pool.check_nhs_number(
-                    cr, uid, data.get('patient_identifier'), context=context):
-                patient_pool.update(cr, uid, data.get('patient_identifier'),
-                                    nhs_data, selection='patient_identifier',
-                                    context=context)
-            else:
-                self.register(cr, uid, hospital_number, data, context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        self._check_patient(cr, uid, hospital_number, data, context=context)
         if hospital_number:
             data.update({'other_identifier': hospital_number})
         admit_activity = admit_pool.create_activity(cr, uid, {}, {},
@@ -120,9 +272,13 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Patient admitted\n data: %s", data)
         return True
 
+    @traced(root=True)
+    @idempotent
     def admit_update(self, cr, uid, hospital_number, data, context=None):
         """
-        Updates the spell information of a patient.
+        Updates the spell information of a patient. Updates that change
+        nothing are not applied, see
+        :meth:`should_apply<adt.nh_clinical_adt_spell_update.should_apply>`.
 
         :param hospital_number: hospital number of the patient
         :type hospital_number: str
@@ -136,19 +292,15 @@ class nh_clinical_api(orm.AbstractModel):
         activity_pool = self.pool['nh.activity']
         update_pool = self.pool['nh.clinical.adt.spell.update']
         patient_pool = self.pool['nh.clinical.patient']
-        if not patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                                  context=context):
-            nhs_data = data.copy()
-            nhs_data['other_identifier'] = hospital_number
-            if patient_pool.check_nhs_number(
-                    cr, uid, data.get('patient_identifier'), context=context):
-                patient_pool.update(cr, uid, data.get('patient_identifier'),
-                                    nhs_data, selection='patient_identifier',
-                                    context=context)
-            else:
-                self.register(cr, uid, hospital_number, data, context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        patient_id = self._check_patient(cr, uid, hospital_number, data,
+                                         context=context)
         if hospital_number:
             data.update({'other_identifier': hospital_number})
+        if not update_pool.should_apply(cr, uid, patient_id, data,
+                                        context=context):
+            return True
         update_activity = update_pool.create_activity(cr, uid, {}, {},
                                                       context=context)
         activity_pool.submit(cr, uid, update_activity, data, context=context)
@@ -156,6 +308,8 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Admission updated\n data: %s", data)
         return True
 
+    @traced(root=True)
+    @idempotent
     def cancel_admit(self, cr, uid, hospital_number, context=None):
         """
         Cancels the open admission of the patient.
@@ -169,9 +323,11 @@ class nh_clinical_api(orm.AbstractModel):
         activity_pool = self.pool['nh.activity']
         cancel_pool = self.pool['nh.clinical.adt.patient.cancel_admit']
         patient_pool = self.pool['nh.clinical.patient']
-        patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                           exception='False', context=context)
-        data = {'other_identifier': hospital_number}
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=hospital_number, context=context)
+        data = {'other_identifier': hospital_number, 'patient_id': patient_id}
         cancel_activity = cancel_pool.create_activity(cr, uid, {}, {},
                                                       context=context)
         activity_pool.submit(cr, uid, cancel_activity, data, context=context)
@@ -179,6 +335,8 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Admission cancelled\n data: %s", data)
         return True
 
+    @traced(root=True)
+    @idempotent
     def discharge(self, cr, uid, hospital_number, data, context=None):
         """
         Discharges a patient.
@@ -194,17 +352,9 @@ class nh_clinical_api(orm.AbstractModel):
         activity_pool = self.pool['nh.activity']
         discharge_pool = self.pool['nh.clinical.adt.patient.discharge']
         patient_pool = self.pool['nh.clinical.patient']
-        if not patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                                  context=context):
-            nhs_data = data.copy()
-            nhs_data['other_identifier'] = hospital_number
-            if patient_pool.check_nhs_number(
-                    cr, uid, data.get('patient_identifier'), context=context):
-                patient_pool.update(cr, uid, data.get('patient_identifier'),
-                                    nhs_data, selection='patient_identifier',
-                                    context=context)
-            else:
-                self.register(cr, uid, hospital_number, data, context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        self._check_patient(cr, uid, hospital_number, data, context=context)
         if hospital_number:
             data.update({'other_identifier': hospital_number})
         discharge_activity = discharge_pool.create_activity(cr, uid, {}, {},
@@ -215,6 +365,8 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Patient discharged: %s", hospital_number)
         return True
 
+    @traced(root=True)
+    @idempotent
     def cancel_discharge(self, cr, uid, hospital_number, context=None):
         """
         Cancels the last discharge of a patient.
@@ -226,20 +378,25 @@ class nh_clinical_api(orm.AbstractModel):
         """
 
         patient_pool = self.pool['nh.clinical.patient']
-        patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                           exception='False', context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=hospital_number, context=context)
         activity_pool = self.pool['nh.activity']
         cancel_pool = self.pool['nh.clinical.adt.patient.cancel_discharge']
         cancel_discharge_activity = cancel_pool.create_activity(
             cr, uid, {}, {}, context=context)
         activity_pool.submit(cr, uid, cancel_discharge_activity,
-                             {'other_identifier': hospital_number},
+                             {'other_identifier': hospital_number,
+                              'patient_id': patient_id},
                              context=context)
         activity_pool.complete(cr, uid, cancel_discharge_activity,
                                context=context)
         _logger.debug("Discharge cancelled for patient: %s", hospital_number)
         return True
 
+    @traced(root=True)
+    @idempotent
     def merge(self, cr, uid, hospital_number, data, context=None):
         """
         Merges a specified patient into a patient.
@@ -255,8 +412,10 @@ class nh_clinical_api(orm.AbstractModel):
         """
 
         patient_pool = self.pool['nh.clinical.patient']
-        patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                           exception='False', context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        patient_pool.get_patient_id(
+            cr, uid, hospital_number=hospital_number, context=context)
         activity_pool = self.pool['nh.activity']
         merge_pool = self.pool['nh.clinical.adt.patient.merge']
         data.update({'into_identifier': hospital_number})
@@ -267,9 +426,13 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Patient merged\n data: %s", data)
         return True
 
+    @traced(root=True)
+    @idempotent
     def transfer(self, cr, uid, hospital_number, data, context=None):
         """
-        Transfers the patient to a specified location.
+        Transfers the patient to a specified location. The user POS,
+        the locations, the patient and the spell are resolved once and
+        shared by the whole transfer chain.
 
         :param hospital_number: hospital number of the patient
         :type hospital_number: str
@@ -282,19 +445,13 @@ class nh_clinical_api(orm.AbstractModel):
         activity_pool = self.pool['nh.activity']
         patient_pool = self.pool['nh.clinical.patient']
         transfer_pool = self.pool['nh.clinical.adt.patient.transfer']
-        if not patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                                  context=context):
-            nhs_data = data.copy()
-            nhs_data['other_identifier'] = hospital_number
-            if patient_pool.check_nhs_number(
-                    cr, uid, data.get('patient_identifier'), context=context):
-                patient_pool.update(cr, uid, data.get('patient_identifier'),
-                                    nhs_data, selection='patient_identifier',
-                                    context=context)
-            else:
-                self.register(cr, uid, hospital_number, data, context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        self._check_patient(cr, uid, hospital_number, data, context=context)
         if hospital_number:
             data.update({'other_identifier': hospital_number})
+        context[ADT_RESOLVED] = transfer_pool.resolve_transfer(
+            cr, uid, data, context=context)
         transfer_activity = transfer_pool.create_activity(cr, uid, {}, {},
                                                           context=context)
         activity_pool.submit(cr, uid, transfer_activity, data, context=context)
@@ -302,6 +459,8 @@ class nh_clinical_api(orm.AbstractModel):
         _logger.debug("Patient transferred\n data: %s", data)
         return True
 
+    @traced(root=True)
+    @idempotent
     def cancel_transfer(self, cr, uid, hospital_number, context=None):
         """
         Cancels the last transfer of a patient.
@@ -313,20 +472,102 @@ class nh_clinical_api(orm.AbstractModel):
         """
 
         patient_pool = self.pool['nh.clinical.patient']
-        patient_pool.check_hospital_number(cr, uid, hospital_number,
-                                           exception='False', context=context)
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        patient_id = patient_pool.get_patient_id(
+            cr, uid, hospital_number=hospital_number, context=context)
         activity_pool = self.pool['nh.activity']
         cancel_pool = self.pool['nh.clinical.adt.patient.cancel_transfer']
         cancel_transfer_activity = cancel_pool.create_activity(
             cr, uid, {}, {}, context=context)
         activity_pool.submit(
             cr, uid, cancel_transfer_activity,
-            {'other_identifier': hospital_number}, context=context)
+            {'other_identifier': hospital_number, 'patient_id': patient_id},
+            context=context)
         activity_pool.complete(cr, uid, cancel_transfer_activity,
                                context=context)
         _logger.debug("Transfer cancelled for patient: %s", hospital_number)
         return True
 
+    def process_batch(self, cr, uid, messages, context=None):
+        """
+        Applies a list of ADT messages in order within the current
+        transaction, e.g. to replay the events queued by the integration
+        engine in a single call.
+
+        Every message is applied in its own savepoint, so a message
+        failing is rolled back and reported without aborting the rest
+        of the batch. The patient identifier memo (see
+        :meth:`get_patient_memo_context<patient.nh_clinical_patient.get_patient_memo_context>`)
+        and the doctor code memo (see
+        :meth:`get_doctor_ids<base.nh_clinical_doctor.get_doctor_ids>`)
+        are shared by the whole batch, while locations and started spells
+        are resolved through their own caches.
+
+        :param messages: dictionaries with the message ``type`` (see
+            ``BATCH_MESSAGE_TYPES``), the ``hospital_number`` of the
+            patient, the message ``data`` when the type takes it and an
+            optional ``message_id``, used to skip resent messages (see
+            :func:`idempotent`) and returned with the outcome
+        :type messages: list
+        :returns: one outcome per message, in order, with its ``index``,
+            ``message_id``, ``type`` and ``status``: ``'done'`` with the
+            ``result`` of the API method or ``'error'`` with the
+            ``error`` message
+        :rtype: list
+        """
+
+        patient_pool = self.pool['nh.clinical.patient']
+        context = patient_pool.get_patient_memo_context(cr, uid,
+                                                        context=context)
+        context.setdefault('nh_doctor_memo', {})
+        outcomes = []
+        for index, message in enumerate(messages):
+            message_type = message.get('type')
+            outcome = {
+                'index': index,
+                'message_id': message.get('message_id', False),
+                'type': message_type
+            }
+            outcomes.append(outcome)
+            if message_type not in BATCH_MESSAGE_TYPES:
+                outcome.update(status='error',
+                               error='Unknown message type %s' % message_type)
+                continue
+            args = [cr, uid, message.get('hospital_number')]
+            if BATCH_MESSAGE_TYPES[message_type]:
+                args.append(dict(message.get('data') or {}))
+            cr.execute("savepoint nh_clinical_api_batch")
+            try:
+                result = getattr(self, message_type)(
+                    *args, message_id=message.get('message_id'),
+                    context=context)
+            except psycopg2.OperationalError:
+                # Concurrency errors abort the batch so it can be retried
+                raise
+            except Exception as e:
+                cr.execute("rollback to savepoint nh_clinical_api_batch")
+                # Patients and records of the message are gone
+                patient_pool._clear_patient_memo(context)
+                context['nh_doctor_memo'].clear()
+                self.invalidate_cache(cr, uid, context=context)
+                if isinstance(e, orm.except_orm):
+                    error = tools.ustr(e.value)
+                    _logger.warning("ADT message %s (%s) failed: %s",
+                                    index, message_type, error)
+                else:
+                    error = tools.ustr(e)
+                    _logger.exception("ADT message %s (%s) failed",
+                                      index, message_type)
+                outcome.update(status='error', error=error)
+                continue
+            cr.execute("release savepoint nh_clinical_api_batch")
+            outcome.update(status='done', result=result)
+        _logger.info("ADT batch processed: %s messages, %s failed",
+                     len(outcomes),
+                     len([o for o in outcomes if o['status'] == 'error']))
+        return outcomes
+
     def check_activity_access(self, cr, uid, activity_id, context=None):
         """
         Verifies if an :class:`activity<activity.nh_activity>` is
@@ -0,0 +1,6 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+"""
+Command line benchmarks run against an existing database with the
+``nh_clinical`` module installed. They are not loaded with the module.
+"""
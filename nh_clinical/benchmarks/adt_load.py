@@ -0,0 +1,391 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+"""
+Measures the ADT throughput of :mod:`nh.clinical.api<api>` on a generated
+estate and a generated stream of ADT messages, single-threaded and with
+concurrent cursors.
+
+Usage::
+
+    python -m openerp.addons.nh_clinical.benchmarks.adt_load \\
+        -c /etc/odoo.conf -d nhclinical --messages 5000 --workers 1 4 8
+
+The stream only depends on ``--seed``: the same seed replays the same
+admissions, transfers, discharges and merges in the same order, with
+codes prefixed by a random run token so runs don't collide. Each message
+is committed on its own, as when the integration engine calls the API,
+so run it against a scratch database.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+
+from psycopg2.extensions import TransactionRollbackError
+
+import openerp
+from openerp import SUPERUSER_ID
+from openerp.tools import ustr
+
+from ..api import BATCH_MESSAGE_TYPES
+
+#: Default message type ratios of the stream
+DEFAULT_MIX = 'admit=0.4,transfer=0.3,discharge=0.25,merge=0.05'
+#: Times a message is retried after a serialization failure or deadlock
+MAX_RETRIES = 3
+#: Seconds between two samples of the sessions waiting for a lock
+LOCK_SAMPLE_INTERVAL = 0.05
+
+
+def parse_mix(mix):
+    ratios = {}
+    for item in mix.split(','):
+        message_type, ratio = item.split('=')
+        if message_type not in ('admit', 'transfer', 'discharge', 'merge'):
+            raise ValueError('Unsupported message type %s' % message_type)
+        ratios[message_type] = float(ratio)
+    return ratios
+
+
+def build_estate(cr, token, wards, beds):
+    """
+    Creates a hospital with ``wards`` wards of ``beds`` beds, its point
+    of service and an ADT user.
+
+    :returns: ``adt_uid`` and ``ward_codes``
+    :rtype: dict
+    """
+    registry = openerp.registry(cr.dbname)
+    location_pool = registry['nh.clinical.location']
+    hospital_id = location_pool.create(cr, SUPERUSER_ID, {
+        'name': 'Benchmark Hospital %s' % token,
+        'code': 'BMH%s' % token, 'usage': 'hospital', 'type': 'structural'})
+    pos_id = registry['nh.clinical.pos'].create(cr, SUPERUSER_ID, {
+        'name': 'Benchmark POS %s' % token, 'code': 'BMPOS%s' % token,
+        'location_id': hospital_id})
+    ward_codes = []
+    for ward in xrange(wards):
+        code = 'BM%sW%s' % (token, ward)
+        ward_id = location_pool.create(cr, SUPERUSER_ID, {
+            'name': code, 'code': code, 'parent_id': hospital_id,
+            'usage': 'ward', 'type': 'poc'})
+        for bed in xrange(beds):
+            location_pool.create(cr, SUPERUSER_ID, {
+                'name': '%sB%s' % (code, bed), 'code': '%sB%s' % (code, bed),
+                'parent_id': ward_id, 'usage': 'bed', 'type': 'poc'})
+        ward_codes.append(code)
+    group = registry['ir.model.data'].get_object(
+        cr, SUPERUSER_ID, 'nh_clinical', 'group_nhc_adt')
+    adt_uid = registry['res.users'].create(cr, SUPERUSER_ID, {
+        'name': 'Benchmark ADT %s' % token, 'login': 'bm_adt_%s' % token,
+        'groups_id': [[4, group.id]], 'pos_id': pos_id,
+        'pos_ids': [[6, 0, [pos_id]]]})
+    return {'adt_uid': adt_uid, 'ward_codes': ward_codes}
+
+
+def generate_stream(seed, token, ward_codes, count, patients, mix,
+                    rate, burst_probability, burst_size):
+    """
+    Generates ``count`` ADT messages for a population of ``patients``
+    patients following the ``mix`` ratios. Only messages valid for the
+    current state of the patient are generated: admissions of patients
+    that are not admitted, transfers and discharges of admitted
+    patients and merges of a newly registered duplicate into an existing
+    patient.
+
+    Messages arrive ``rate`` per second on average, with bursts of
+    ``burst_size`` messages arriving at once for the patients of a
+    ward.
+
+    :returns: messages with their ``type``, ``hospital_number``,
+        ``data``, ``message_id``, ``arrival`` (seconds from the start)
+        and ``partition`` (the patient whose messages must be applied in
+        order)
+    :rtype: list
+    """
+    rand = random.Random(seed)
+    hospital_numbers = ['BM%sP%06d' % (token, i) for i in xrange(patients)]
+    location = {}
+    registered = []
+    merged = 0
+    stream = []
+    arrival = 0.0
+    burst = 0
+    burst_ward = None
+
+    def add(message_type, hospital_number, data, partition):
+        stream.append({
+            'type': message_type,
+            'hospital_number': hospital_number,
+            'data': data,
+            'message_id': 'BM%s-%s' % (token, len(stream)),
+            'arrival': round(arrival, 6),
+            'partition': partition
+        })
+
+    while len(stream) < count:
+        if burst:
+            burst -= 1
+        else:
+            arrival += rand.expovariate(rate)
+            burst_ward = None
+            if rand.random() < burst_probability:
+                burst = burst_size - 1
+                burst_ward = rand.choice(ward_codes)
+        admitted = [h for h in hospital_numbers if h in location]
+        if burst_ward:
+            admitted = [h for h in admitted
+                        if location[h] == burst_ward] or admitted
+        candidates = {
+            'admit': len(location) < len(hospital_numbers),
+            'transfer': bool(admitted) and len(ward_codes) > 1,
+            'discharge': bool(admitted),
+            'merge': bool(registered)
+        }
+        types = [t for t in sorted(mix) if candidates[t] and mix[t] > 0]
+        message_type = weighted_choice(rand, types,
+                                       [mix[t] for t in types])
+        if message_type == 'admit':
+            hospital_number = rand.choice(
+                [h for h in hospital_numbers if h not in location])
+            ward = burst_ward or rand.choice(ward_codes)
+            location[hospital_number] = ward
+            if hospital_number not in registered:
+                registered.append(hospital_number)
+            add('admit', hospital_number, {
+                'location': ward,
+                'family_name': 'Family%s' % rand.randint(0, 5000),
+                'given_name': 'Given%s' % rand.randint(0, 300),
+                'gender': rand.choice(['M', 'F', 'U'])
+            }, hospital_number)
+        elif message_type == 'transfer':
+            hospital_number = rand.choice(admitted)
+            ward = rand.choice([w for w in ward_codes
+                                if w != location[hospital_number]])
+            location[hospital_number] = ward
+            add('transfer', hospital_number, {'location': ward},
+                hospital_number)
+        elif message_type == 'discharge':
+            hospital_number = rand.choice(admitted)
+            del location[hospital_number]
+            add('discharge', hospital_number, {}, hospital_number)
+        else:
+            into = rand.choice(registered)
+            duplicate = 'BM%sD%06d' % (token, merged)
+            merged += 1
+            add('register', duplicate, {
+                'family_name': 'Family%s' % rand.randint(0, 5000),
+                'given_name': 'Given%s' % rand.randint(0, 300)
+            }, into)
+            if len(stream) < count:
+                add('merge', into, {'from_identifier': duplicate}, into)
+    return stream
+
+
+def weighted_choice(rand, items, weights):
+    point = rand.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        point -= weight
+        if point < 0:
+            return item
+    return items[-1]
+
+
+def percentile(values, rank):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1,
+                       int(round(rank / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class LockSampler(threading.Thread):
+    """
+    Counts the sessions of the database waiting for a lock every
+    ``LOCK_SAMPLE_INTERVAL`` seconds.
+    """
+
+    def __init__(self, registry):
+        super(LockSampler, self).__init__(name='nh_adt_load_lock_sampler')
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.samples = []
+
+    def run(self):
+        with self.registry.cursor() as cr:
+            while not self.stopped.is_set():
+                cr.execute("""
+                    select count(*) from pg_stat_activity
+                    where datname = current_database()
+                        and wait_event_type = 'Lock'
+                """)
+                self.samples.append(cr.fetchone()[0])
+                cr.rollback()
+                self.stopped.wait(LOCK_SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return {
+            'samples': len(self.samples),
+            'samples_waiting': len([s for s in self.samples if s]),
+            'max_waiting': max(self.samples) if self.samples else 0
+        }
+
+
+def apply_message(cr, api_pool, uid, message):
+    args = [cr, uid, message['hospital_number']]
+    if BATCH_MESSAGE_TYPES[message['type']]:
+        args.append(dict(message['data']))
+    getattr(api_pool, message['type'])(*args,
+                                       message_id=message['message_id'])
+
+
+def run_worker(registry, uid, messages, start, paced, results):
+    threading.current_thread().dbname = registry.db_name
+    api_pool = registry['nh.clinical.api']
+    with openerp.api.Environment.manage():
+        with registry.cursor() as cr:
+            for message in messages:
+                scheduled = start + message['arrival']
+                if paced and scheduled > time.time():
+                    time.sleep(scheduled - time.time())
+                begin = time.time()
+                queries = cr.sql_log_count
+                result = {'type': message['type'], 'retries': 0}
+                while True:
+                    try:
+                        apply_message(cr, api_pool, uid, message)
+                        cr.commit()
+                        result['error'] = False
+                    except TransactionRollbackError:
+                        cr.rollback()
+                        if result['retries'] < MAX_RETRIES:
+                            result['retries'] += 1
+                            continue
+                        result['error'] = 'retries exhausted'
+                    except Exception as e:
+                        cr.rollback()
+                        result['error'] = ustr(getattr(e, 'value', e))
+                    break
+                end = time.time()
+                result['latency'] = end - (scheduled if paced else begin)
+                result['queries'] = cr.sql_log_count - queries
+                results.append(result)
+
+
+def run(registry, uid, stream, workers, paced):
+    """
+    Applies the stream with ``workers`` cursors, each one applying the
+    messages of its partitions in order.
+
+    :returns: throughput, latency percentiles (milliseconds), SQL
+        statements per message, errors, retries and lock waits
+    :rtype: dict
+    """
+    partitions = [[] for i in xrange(workers)]
+    for message in stream:
+        index = zlib.crc32(message['partition']) % workers
+        partitions[index].append(message)
+    results = []
+    sampler = LockSampler(registry)
+    sampler.start()
+    start = time.time()
+    threads = [threading.Thread(
+        target=run_worker,
+        args=(registry, uid, messages, start, paced, results),
+        name='nh_adt_load_worker_%s' % index)
+        for index, messages in enumerate(partitions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    lock_waits = sampler.stop()
+
+    def summary(items):
+        latencies = [r['latency'] * 1000 for r in items]
+        return {
+            'messages': len(items),
+            'errors': len([r for r in items if r['error']]),
+            'p50_ms': round(percentile(latencies, 50) or 0, 3),
+            'p95_ms': round(percentile(latencies, 95) or 0, 3),
+            'p99_ms': round(percentile(latencies, 99) or 0, 3),
+            'queries_per_message': round(
+                sum(r['queries'] for r in items) / float(len(items)), 2)
+            if items else None
+        }
+
+    res = summary(results)
+    res.update({
+        'workers': workers,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(len(results) / elapsed, 1)
+        if elapsed else None,
+        'retries': sum(r['retries'] for r in results),
+        'lock_waits': lock_waits,
+        'by_type': dict(
+            (message_type, summary([r for r in results
+                                    if r['type'] == message_type]))
+            for message_type in set(r['type'] for r in results)),
+        'first_errors': sorted(set(
+            '%s: %s' % (r['type'], r['error']) for r in results
+            if r['error']))[:10]
+    })
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--config', help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--wards', type=int, default=10)
+    parser.add_argument('--beds', type=int, default=20,
+                        help='beds per ward')
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=5000,
+                        help='messages per run')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='message type ratios')
+    parser.add_argument('--rate', type=float, default=50.0,
+                        help='average messages per second')
+    parser.add_argument('--burst-probability', type=float, default=0.05)
+    parser.add_argument('--burst-size', type=int, default=20)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4],
+                        help='concurrent cursors of each run')
+    parser.add_argument('--paced', action='store_true',
+                        help='replay the arrival times instead of '
+                             'applying the messages as fast as possible')
+    args = parser.parse_args()
+
+    openerp.tools.config.parse_config(
+        ['-c', args.config] if args.config else [])
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+    mix = parse_mix(args.mix)
+    res = {
+        'config': dict((k, v) for k, v in vars(args).items()
+                       if k not in ('config', 'database')),
+        'runs': []
+    }
+    with openerp.api.Environment.manage():
+        for workers in args.workers:
+            token = uuid.uuid4().hex[:6].upper()
+            with registry.cursor() as cr:
+                estate = build_estate(cr, token, args.wards, args.beds)
+                cr.commit()
+            stream = generate_stream(
+                args.seed, token, estate['ward_codes'], args.messages,
+                args.patients, mix, args.rate, args.burst_probability,
+                args.burst_size)
+            res['runs'].append(run(registry, estate['adt_uid'], stream,
+                                   workers, args.paced))
+    print(json.dumps(res, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
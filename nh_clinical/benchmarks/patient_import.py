@@ -0,0 +1,120 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+"""
+Measures the throughput of
+:meth:`import_patients<patient.nh_clinical_patient.import_patients>`
+and, for comparison, of the ORM based
+:meth:`load<patient.nh_clinical_patient.load>` on generated patients.
+
+Usage::
+
+    python -m openerp.addons.nh_clinical.benchmarks.patient_import \\
+        -c /etc/odoo.conf -d nhclinical --rows 100000 --load-rows 1000
+
+Everything is rolled back unless ``--commit`` is given.
+"""
+import argparse
+import csv
+import json
+import time
+import uuid
+from cStringIO import StringIO
+
+import openerp
+from openerp import SUPERUSER_ID
+
+
+FIELDS = ['other_identifier', 'patient_identifier', 'family_name',
+          'given_name', 'middle_names', 'dob', 'gender']
+
+
+def generate_rows(count, seed):
+    """
+    Generates ``count`` patient rows with unique identifiers, written
+    with the separators and date formats usually found in PAS exports.
+    """
+    for i in xrange(count):
+        yield [
+            'BM-{0}-{1:08d}'.format(seed, i),
+            '{0} {1:07d}'.format(seed, i),
+            'Family{0}'.format(i % 5000),
+            'Given{0}'.format(i % 300),
+            'Middle' if i % 3 else '',
+            '{0:02d}/{1:02d}/{2}'.format(i % 28 + 1, i % 12 + 1,
+                                         1930 + i % 80),
+            ['M', 'F', 'U'][i % 3]
+        ]
+
+
+def generate_csv(count, seed):
+    data = StringIO()
+    writer = csv.writer(data)
+    writer.writerow(FIELDS)
+    for row in generate_rows(count, seed):
+        writer.writerow(row)
+    data.seek(0)
+    return data
+
+
+def run(cr, rows, load_rows, chunk_size):
+    patient_pool = openerp.registry(cr.dbname)['nh.clinical.patient']
+    context = {'dateformat': 'DMY'}
+    seed = uuid.uuid4().hex[:6].upper()
+    res = {'rows': rows, 'chunk_size': chunk_size}
+
+    data = generate_csv(rows, seed)
+    start = time.time()
+    imported = patient_pool.import_patients(
+        cr, SUPERUSER_ID, data, chunk_size=chunk_size, context=context)
+    elapsed = time.time() - start
+    res['import_patients'] = {
+        'seconds': round(elapsed, 3),
+        'created': imported['created'],
+        'errors': len(imported['errors']),
+        'rows_per_second': round(imported['created'] / elapsed, 1)
+        if elapsed else None
+    }
+
+    if load_rows:
+        data = [tuple(row) for row in generate_rows(load_rows, seed + 'L')]
+        start = time.time()
+        loaded = patient_pool.load(cr, SUPERUSER_ID, FIELDS, data,
+                                   context=context)
+        elapsed = time.time() - start
+        res['load'] = {
+            'rows': load_rows,
+            'seconds': round(elapsed, 3),
+            'created': len([i for i in loaded['ids'] or [] if i]),
+            'rows_per_second': round(load_rows / elapsed, 1)
+            if elapsed else None
+        }
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--config', help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='patients imported with import_patients')
+    parser.add_argument('--load-rows', type=int, default=1000,
+                        help='patients imported with the ORM load '
+                             '(0 to skip)')
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--commit', action='store_true',
+                        help='keep the imported patients')
+    args = parser.parse_args()
+
+    openerp.tools.config.parse_config(
+        ['-c', args.config] if args.config else [])
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+    with openerp.api.Environment.manage():
+        with registry.cursor() as cr:
+            res = run(cr, args.rows, args.load_rows, args.chunk_size)
+            if not args.commit:
+                cr.rollback()
+    print(json.dumps(res, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -42,7 +42,10 @@ class res_groups(orm.Model):
         """
         Extends Odoo's
         :meth:`write()<openerp.addons.base.res.res_users.res_groups.write>`
-        to update nh_activity records with the responsible users.
+        to update nh_activity records with the responsible users and to
+        invalidate the user context cache (see
+        :meth:`get_user_context<base.res_users.get_user_context>`) when
+        the users or implied groups change.
 
         :param ids: group ids
         :type ids: list
@@ -63,4 +66,7 @@ class res_groups(orm.Model):
                 user_ids.extend([u.id for u in group.users])
             # update activities with user ids of responsible users
             activity_pool.update_users(cr, uid, user_ids)
+        if 'users' in values or 'implied_ids' in values:
+            self.pool['res.users'].invalidate_user_context_cache(
+                cr, uid, context=context)
         return res
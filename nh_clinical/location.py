@@ -1,13 +1,95 @@
 # Part of NHClinical. See LICENSE file for full copyright and licensing details
 # -*- coding: utf-8 -*-
+import copy
+import csv
+import json
 import logging
+from cStringIO import StringIO
 
-from openerp.osv import orm, fields
+from openerp.osv import orm, fields, osv
 from openerp import SUPERUSER_ID
 
+from .tracing import traced
+from .versioned_cache import (ensure_version_table, get_cache,
+                              get_keyed_cache, prune_versions)
+
 
 _logger = logging.getLogger(__name__)
 
+#: Name of the code/id resolution cache, see
+#: :meth:`nh_clinical_location.get_cached_location`
+LOCATION_CACHE = 'nh.clinical.location'
+#: Location fields that change what the resolution cache holds
+LOCATION_CACHE_FIELDS = ['code', 'parent_id', 'usage', 'active']
+#: Guard against parent cycles when walking up the location tree
+MAX_LOCATION_DEPTH = 64
+#: Name of the ward snapshot cache, see
+#: :meth:`nh_clinical_location.get_ward_snapshot`
+WARD_SNAPSHOT_CACHE = 'nh.clinical.location.ward_snapshot'
+#: Location fields that change what a ward snapshot holds
+WARD_SNAPSHOT_FIELDS = ['name', 'code', 'parent_id', 'usage', 'active']
+#: Groups of the staff listed in a ward snapshot
+WARD_SNAPSHOT_GROUPS = {
+    'NH Clinical Nurse Group': 'nurse_ids',
+    'NH Clinical HCA Group': 'hca_ids'
+}
+#: Subquery matching the started spells of the ``location`` row, backed
+#: by the ``nh_activity_started_spell_location_idx`` partial index
+OCCUPIED_BED_SQL = """
+    select 1 from nh_activity spell_activity
+    where spell_activity.location_id = location.id
+        and location.usage = 'bed'
+        and spell_activity.data_model = 'nh.clinical.spell'
+        and spell_activity.state = 'started'
+"""
+#: Stored fields computed from the location ancestors
+LOCATION_TREE_FIELDS = ['full_name', 'pos_id']
+#: Computes ``full_name`` and ``pos_id`` for the ``ids`` locations as
+#: ``tree_value(id, full_name, pos_id)``. The full name is the location
+#: name followed by the closest ward name (wards just use their name),
+#: the POS is the one of the root location.
+LOCATION_TREE_CTE = """
+    with recursive
+        ancestor(location_id, id, parent_id, usage, name, depth) as (
+                select id, id, parent_id, usage, name, 0
+                from nh_clinical_location
+                where id in %(ids)s
+            union all
+                select ancestor.location_id, parent.id, parent.parent_id,
+                    parent.usage, parent.name, ancestor.depth + 1
+                from nh_clinical_location parent
+                inner join ancestor on parent.id = ancestor.parent_id
+                where ancestor.depth < %(depth)s
+        ),
+        ward as (
+            select distinct on (location_id) location_id, name
+            from ancestor
+            where depth > 0 and usage = 'ward'
+            order by location_id, depth
+        ),
+        root as (
+            select ancestor.location_id, min(pos.id) as pos_id
+            from ancestor
+            left join nh_clinical_pos pos on pos.location_id = ancestor.id
+            where ancestor.parent_id is null
+            group by ancestor.location_id
+        ),
+        tree_value as (
+            select
+                location.id,
+                case
+                    when location.usage = 'ward' or ward.name is null
+                        then location.name
+                    else location.name || ' [' || ward.name || ']'
+                end as full_name,
+                root.pos_id
+            from nh_clinical_location location
+            left join ward on ward.location_id = location.id
+            left join root on root.location_id = location.id
+            where location.id in %(ids)s
+        )
+"""
+
 
 class nh_clinical_location(orm.Model):
     """
@@ -28,35 +110,50 @@ class nh_clinical_location(orm.Model):
                ('hospital', 'Hospital')]
 
     def _get_pos_id(self, cr, uid, ids, field, args, context=None):
-        res = {}
-        pos_pool = self.pool['nh.clinical.pos']
-        for location in self.browse(cr, uid, ids, context):
-            pos_location_id = self.search(
-                cr, uid, [['parent_id', '=', False],
-                          ['child_ids', 'child_of', location.id]])
-            pos_location_id = pos_location_id[0] if pos_location_id else False
-            pos_id = pos_pool.search(cr, uid,
-                                     [['location_id', '=', pos_location_id]])
-            res[location.id] = pos_id[0] if pos_id else False
+        res = {location_id: False for location_id in ids}
+        for location_id, pos_id in self._get_tree_values(
+                cr, ids, 'pos_id').items():
+            res[location_id] = pos_id or False
             if not pos_id:
-                _logger.debug("pos_id not found for location '%s', id=%s" %
-                              (location.code, location.id))
+                _logger.debug("pos_id not found for location id=%s",
+                              location_id)
         return res
 
+    def _get_subtree_ids(self, cr, uid, ids, context=None):
+        """
+        Store trigger returning the locations and all their descendants,
+        fetched with a single recursive query.
+        """
+        if not ids:
+            return []
+        location_pool = self.pool['nh.clinical.location']
+        return location_pool.get_subtree_ids(cr, uid, ids, context=context)
+
     def _pos2location_id(self, cr, uid, ids, context=None):
-        res = []
-        for pos in self.browse(cr, uid, ids, context):
-            res.extend(self.pool['nh.clinical.location'].search(
-                cr, uid, [['id', 'child_of', pos.location_id.id]]))
-        return res
+        location_ids = [pos['location_id'][0] for pos in self.read(
+            cr, uid, ids, ['location_id'], context=context)
+            if pos['location_id']]
+        if not location_ids:
+            return []
+        location_pool = self.pool['nh.clinical.location']
+        return location_pool.get_subtree_ids(cr, uid, location_ids,
+                                             context=context)
 
     def _is_available(self, cr, uid, ids, field, args, context=None):
-        usages = [usage[0] for usage in self._usages]
-        available_location_ids = self.get_available_location_ids(
-            cr, uid, usages=usages, context=context)
-        res = {}
-        for i in ids:
-            res[i] = i in available_location_ids
+        """
+        Active locations are available unless they are beds with a
+        started spell, computed in one query for all the locations.
+        """
+        res = {location_id: False for location_id in ids}
+        if not ids:
+            return res
+        cr.execute("""
+            select location.id, not exists ({occupied})
+            from nh_clinical_location location
+            where location.id in %s and location.active = true
+                and location.usage is not null
+        """.format(occupied=OCCUPIED_BED_SQL), (tuple(ids),))
+        res.update(dict(cr.fetchall()))
         return res
 
     def _get_patient_ids(self, cr, uid, ids, field, args, context=None):
@@ -237,40 +334,153 @@ class nh_clinical_location(orm.Model):
         """
         Checks if a location is a child of another location.
 
+        Both locations are resolved through the location cache (see
+        :meth:`get_cached_location`) so no subtree is expanded.
+
         :param location_id: location id
         :type location_id: int
         :param code: location code
         :type code: str
-        :returns: the dictionary ``location_id`` (key) and a string
-            containing location name and parent location name (value)
-            Otherwise ``False`` is returned.
-        :rtype: dict or bool
+        :returns: ``True`` if the location is the location with that
+            code or one of its descendants. Otherwise ``False``.
+        :rtype: bool
         """
 
-        code_location_id = self.search(cr, uid, [['code', '=', code]],
-                                       context=context)
-        child_location_ids = self.search(
-            cr, uid, [['id', 'child_of', code_location_id[0]]],
-            context=context
-        )
-        return location_id in child_location_ids
+        parent = self.get_cached_location(cr, uid, code=code,
+                                          context=context)
+        location = self.get_cached_location(cr, uid, location_id=location_id,
+                                            context=context)
+        if not parent or not location:
+            return False
+        return parent['id'] in location['path_ids']
 
     def _get_name(self, cr, uid, ids, field, args, context=None):
-        result = {}
-        for location in self.browse(cr, uid, ids, context=context):
-            if location.usage == 'ward':
-                result[location.id] = location.name
-            else:
-                parent_id = self.get_closest_parent_id(cr, uid, location.id,
-                                                       'ward', context=context)
-                if parent_id:
-                    parent = self.read(cr, uid, parent_id, ['name'],
-                                       context=context)
-                else:
-                    parent = False
-                result[location.id] = '{0} [{1}]'.format(
-                    location.name, parent['name']) if parent else location.name
-        return result
+        res = {location_id: False for location_id in ids}
+        res.update(self._get_tree_values(cr, ids, 'full_name'))
+        return res
+
+    def get_subtree_ids(self, cr, uid, ids, context=None):
+        """
+        Gets the locations and all their descendants (active or not) in
+        one recursive query.
+
+        :param ids: location ids
+        :type ids: list
+        :returns: location ids
+        :rtype: list
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return []
+        cr.execute("""
+            with recursive subtree(id, depth) as (
+                    select id, 0
+                    from nh_clinical_location
+                    where id in %s
+                union
+                    select child.id, subtree.depth + 1
+                    from nh_clinical_location child
+                    inner join subtree on child.parent_id = subtree.id
+                    where subtree.depth < %s
+            )
+            select distinct id from subtree
+        """, (tuple(ids), MAX_LOCATION_DEPTH))
+        return [row[0] for row in cr.fetchall()]
+
+    def get_path_ids(self, cr, uid, ids, context=None):
+        """
+        Gets the locations and all their ancestors in one recursive
+        query.
+
+        :param ids: location ids
+        :type ids: list
+        :returns: location ids
+        :rtype: list
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return []
+        cr.execute("""
+            with recursive ancestor(id, parent_id, depth) as (
+                    select id, parent_id, 0
+                    from nh_clinical_location
+                    where id in %s
+                union
+                    select parent.id, parent.parent_id, ancestor.depth + 1
+                    from nh_clinical_location parent
+                    inner join ancestor on parent.id = ancestor.parent_id
+                    where ancestor.depth < %s
+            )
+            select distinct id from ancestor
+        """, (tuple(ids), MAX_LOCATION_DEPTH))
+        return [row[0] for row in cr.fetchall()]
+
+    def _get_tree_values(self, cr, ids, column):
+        """
+        Computes a tree dependent column (``full_name`` or ``pos_id``)
+        for all the locations in one query.
+
+        :returns: location id (key) and value (value)
+        :rtype: dict
+        """
+        if not ids:
+            return {}
+        cr.execute(LOCATION_TREE_CTE + """
+            select id, {column} from tree_value
+        """.format(column=column), {'ids': tuple(ids),
+                                    'depth': MAX_LOCATION_DEPTH})
+        return dict(cr.fetchall())
+
+    def _store_set_values(self, cr, uid, ids, fields, context):
+        """
+        Extends Odoo's ``_store_set_values()`` so ``full_name`` and
+        ``pos_id`` are recomputed for all the triggered locations with a
+        single ``UPDATE`` instead of one statement per location. The new
+        full names are then copied to the stored ``location_name`` of the
+        activities and patient moves of those locations.
+        """
+        tree_fields = [f for f in fields if f in LOCATION_TREE_FIELDS]
+        other_fields = [f for f in fields if f not in LOCATION_TREE_FIELDS]
+        if tree_fields and ids:
+            cr.execute(LOCATION_TREE_CTE + """
+                update nh_clinical_location location
+                set {columns}
+                from tree_value
+                where location.id = tree_value.id
+            """.format(columns=', '.join(
+                '{0} = tree_value.{0}'.format(f) for f in tree_fields)),
+                {'ids': tuple(ids), 'depth': MAX_LOCATION_DEPTH})
+            self.invalidate_cache(cr, uid, tree_fields, ids, context=context)
+            if 'full_name' in tree_fields:
+                self._update_location_names(cr, uid, ids, context=context)
+        if other_fields:
+            return super(nh_clinical_location, self)._store_set_values(
+                cr, uid, ids, other_fields, context)
+        return True
+
+    def _update_location_names(self, cr, uid, ids, context=None):
+        """
+        Copies the stored ``full_name`` of the locations to the stored
+        ``location_name`` of their activities and patient moves.
+        """
+        for table, model in [('nh_activity', 'nh.activity'),
+                             ('nh_clinical_patient_move',
+                              'nh.clinical.patient.move')]:
+            cr.execute("""
+                update {table} record
+                set location_name = location.full_name
+                from nh_clinical_location location
+                where record.location_id = location.id
+                    and location.id in %s
+                    and record.location_name is distinct from
+                        location.full_name
+            """.format(table=table), (tuple(ids),))
+            if cr.rowcount:
+                self.pool[model].invalidate_cache(
+                    cr, uid, ['location_name'], context=context)
+        return True
 
     def _is_available_search(self, cr, uid, obj, name, args, domain=None,
                              context=None):
@@ -278,29 +488,40 @@ class nh_clinical_location(orm.Model):
         Permits searching :meth:`_is_available` method so is_available
         field is searchable, ignoring any operand not '=' or '!='
         because is_available is a boolean and thus nonsensical.
+
+        Only active beds are matched. The search is pushed down to
+        PostgreSQL as an anti-join against the started spells, so no
+        location ids are loaded.
         """
 
-        location_ids = []
+        values = set()
         for cond in args:
-            available_value = bool(cond[2])
             if cond[1] not in ['=', '!=']:
                 continue
-            all_ids = self.search(cr, uid, [['usage', '=', 'bed']],
-                                  context=context)
-            available_locations_map = self._is_available(
-                cr, uid, all_ids, 'is_available', None, context=context)
-            if cond[1] == '=':
-                location_ids += [k for k, v in available_locations_map.items()
-                                 if v == available_value]
-            else:
-                location_ids += [k for k, v in available_locations_map.items()
-                                 if v != available_value]
-        return [('id', 'in', location_ids)]
+            available_value = bool(cond[2])
+            values.add(available_value if cond[1] == '=' else
+                       not available_value)
+        if not values:
+            return [('id', 'in', [])]
+        if len(values) == 1:
+            occupancy = 'not exists' if values.pop() else 'exists'
+            occupancy = 'and {0} ({1})'.format(occupancy, OCCUPIED_BED_SQL)
+        else:
+            occupancy = ''
+        return [('id', 'inselect', ("""
+            select location.id
+            from nh_clinical_location location
+            where location.usage = 'bed' and location.active = true
+                {occupancy}
+        """.format(occupancy=occupancy), []))]
 
     _columns = {
         'name': fields.char('Location', size=100, required=True, select=True),
-        'full_name': fields.function(_get_name, type='char', size=150,
-                                     string='Full Name'),
+        'full_name': fields.function(
+            _get_name, type='char', size=150, string='Full Name', store={
+                'nh.clinical.location': (
+                    _get_subtree_ids, ['name', 'parent_id', 'usage'], 10)
+            }),
         'code': fields.char('Code', size=256),
         'parent_id': fields.many2one('nh.clinical.location',
                                      'Parent Location'),
@@ -312,10 +533,7 @@ class nh_clinical_location(orm.Model):
         'pos_id': fields.function(
             _get_pos_id, type='many2one', relation='nh.clinical.pos',
             string='POS', store={
-                'nh.clinical.location': (
-                    lambda s, cr, uid, ids, c:
-                    s.search(cr, uid, [['id', 'child_of', ids]]),
-                    ['parent_id'], 10),
+                'nh.clinical.location': (_get_subtree_ids, ['parent_id'], 10),
                 'nh.clinical.pos': (_pos2location_id, ['location_id'], 5),
             }),
         'company_id': fields.related('pos_id', 'company_id', type='many2one',
@@ -448,17 +666,12 @@ class nh_clinical_location(orm.Model):
 
         if not usages:
             usages = ['bed']
-        activity_pool = self.pool['nh.activity']
-        open_spell_ids = activity_pool.search(
-            cr, uid, [['data_model', '=', 'nh.clinical.spell'],
-                      ['state', '=', 'started']],
-            context=context)
-        busy_location_ids = [a.location_id.id
-                             if a.location_id.usage == 'bed' else False
-                             for a in activity_pool.browse(cr, uid,
-                                                           open_spell_ids,
-                                                           context=context)]
-        busy_location_ids = list(set(busy_location_ids))
+        cr.execute("""
+            select distinct location.id
+            from nh_clinical_location location
+            where exists ({occupied})
+        """.format(occupied=OCCUPIED_BED_SQL))
+        busy_location_ids = [row[0] for row in cr.fetchall()]
         return self.search(cr, uid, [['usage', 'in', usages],
                                      ['id', 'not in', busy_location_ids]],
                            context=context)
@@ -510,6 +723,7 @@ class nh_clinical_location(orm.Model):
                                                      context=context)
         return True
 
+    @traced()
     def get_by_code(self, cr, uid, code, auto_create=False, context=None):
         """
         Gets the location's id by the location's code. Creates a
@@ -527,8 +741,13 @@ class nh_clinical_location(orm.Model):
         :rtype: int or bool
         """
 
-        location_ids = self.search(cr, uid, [['code', '=', code]],
-                                   context=context)
+        if code:
+            location = self.get_cached_location(cr, uid, code=code,
+                                                context=context)
+            location_ids = [location['id']] if location else []
+        else:
+            location_ids = self.search(cr, uid, [['code', '=', code]],
+                                       context=context)
         if not location_ids:
             if not auto_create:
                 return False
@@ -536,14 +755,14 @@ class nh_clinical_location(orm.Model):
                 _logger.warn("Location '%s' not found! "
                              "Automatically creating one with this code.",
                              code)
-                user_pool = self.pool['res.users']
-                user = user_pool.browse(cr, uid, uid, context=context)
+                user_context = self.pool['res.users'].get_user_context(
+                    cr, uid, context=context)
                 location_id = self.create(cr, uid, {
                     'name': code,
                     'code': code,
-                    'pos_id': user.pos_id.id if user.pos_id else False,
-                    'parent_id': user.pos_ids[0].location_id.id
-                    if user.pos_ids[0].location_id else False,
+                    'pos_id': user_context['pos_id'],
+                    'parent_id': user_context['pos_location_ids'][0]
+                    if user_context['pos_location_ids'] else False,
                     'type': 'poc',
                     'usage': 'ward'
                 }, context=context)
@@ -551,6 +770,722 @@ class nh_clinical_location(orm.Model):
             location_id = location_ids[0]
         return location_id
 
+    def get_cached_location(self, cr, uid, code=None, location_id=None,
+                            context=None):
+        """
+        Resolves an active location by code or id through a per registry
+        cache shared by all workers (see
+        :mod:`versioned_cache<versioned_cache>`). The cache is invalidated
+        whenever a location is created, unlinked or has its code, parent,
+        usage or active flag changed and whenever a POS location changes.
+
+        :param code: location code
+        :type code: str
+        :param location_id: location id, used if no code is given
+        :type location_id: int
+        :returns: dictionary with the ``id``, ``code``, ``usage``,
+            ``ward_id`` (the closest ward, the location itself if it is a
+            ward), ``pos_id`` and ``path_ids`` (the location id followed
+            by its ancestors ids) of the location. ``False`` if there is
+            no such active location.
+        :rtype: dict or bool
+        """
+
+        if code:
+            key = ('code', code)
+        elif location_id:
+            key = ('id', location_id)
+        else:
+            return False
+        cache = get_cache(cr, LOCATION_CACHE)
+        version = cache.validate(cr)
+        location = cache.get(version, key)
+        if location is None:
+            location = self._read_location_path(cr, key)
+            if location:
+                if location['code']:
+                    cache.set(version, ('code', location['code']), location)
+                cache.set(version, ('id', location['id']), location)
+        return dict(location) if location else False
+
+    def _read_location_path(self, cr, key):
+        """
+        Reads an active location and its active ancestors in one query.
+
+        :param key: ``('code', code)`` or ``('id', location_id)``
+        :type key: tuple
+        :returns: see :meth:`get_cached_location`
+        :rtype: dict or bool
+        """
+
+        column = 'code' if key[0] == 'code' else 'id'
+        cr.execute("""
+            with recursive ancestor(id, code, parent_id, usage, pos_id,
+                                    depth) as (
+                    select id, code, parent_id, usage, pos_id, 0
+                    from nh_clinical_location
+                    where {column} = %s and active = true
+                union all
+                    select parent.id, parent.code, parent.parent_id,
+                        parent.usage, parent.pos_id, ancestor.depth + 1
+                    from nh_clinical_location parent
+                    inner join ancestor on parent.id = ancestor.parent_id
+                    where parent.active = true and ancestor.depth < %s
+            )
+            select id, code, usage, pos_id from ancestor order by depth
+        """.format(column=column), (key[1], MAX_LOCATION_DEPTH))
+        rows = cr.dictfetchall()
+        if not rows:
+            return False
+        ward_ids = [r['id'] for r in rows if r['usage'] == 'ward']
+        return {
+            'id': rows[0]['id'],
+            'code': rows[0]['code'],
+            'usage': rows[0]['usage'],
+            'ward_id': ward_ids[0] if ward_ids else False,
+            'pos_id': rows[0]['pos_id'] or False,
+            'path_ids': tuple(r['id'] for r in rows)
+        }
+
+    def get_location_cache_stats(self, cr, uid, context=None):
+        """
+        :returns: ``hits``, ``misses``, ``size`` and ``version`` of the
+            location resolution cache for this registry
+        :rtype: dict
+        """
+        return get_cache(cr, LOCATION_CACHE).stats()
+
+    def invalidate_location_cache(self, cr, uid, context=None):
+        """
+        Invalidates the location resolution cache for every worker once
+        the current transaction is committed.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        get_cache(cr, LOCATION_CACHE).invalidate(cr)
+        return True
+
+    def get_ward_snapshot(self, cr, uid, ward_ids, context=None):
+        """
+        Gets the bed board of the wards: every bed with its occupant and
+        spell, the patients waiting to be placed in the ward, the nurses
+        and HCAs allocated and the bed availability.
+
+        Snapshots are cached per ward and tagged with the ward version
+        (see :meth:`bump_ward_versions`), so when nothing changed a call
+        only costs the version check. Versions are not committed in
+        sequence order, so the version is the highest version of the
+        ward together with its number of version rows. Outdated wards
+        are rebuilt together in a fixed number of queries, regardless of
+        the number of wards, beds or patients.
+
+        :param ward_ids: `ward` usage location ids
+        :type ward_ids: list
+        :returns: ward id (key) and snapshot dictionary (value) with the
+            ``id``, ``name``, ``code``, ``full_name`` and ``version`` of
+            the ward, its ``beds``, ``waiting_placements``,
+            ``nurse_ids``, ``hca_ids``, ``bed_count`` and
+            ``available_bed_count``
+        :rtype: dict
+        """
+
+        if isinstance(ward_ids, (int, long)):
+            ward_ids = [ward_ids]
+        if not ward_ids:
+            return {}
+        cache = get_keyed_cache(cr, WARD_SNAPSHOT_CACHE)
+        cr.execute("select ward_id, max(version), count(*) "
+                   "from nh_clinical_ward_version "
+                   "where ward_id in %s group by ward_id", (tuple(ward_ids),))
+        versions = dict((ward_id, (version, count))
+                        for ward_id, version, count in cr.fetchall())
+        res = {}
+        outdated_ids = []
+        for ward_id in ward_ids:
+            snapshot = cache.get(ward_id, versions.get(ward_id)) \
+                if ward_id in versions else None
+            if snapshot is None:
+                outdated_ids.append(ward_id)
+            else:
+                res[ward_id] = snapshot
+        if outdated_ids:
+            snapshots = self._build_ward_snapshots(cr, uid, outdated_ids,
+                                                   context=context)
+            for ward_id, snapshot in snapshots.items():
+                snapshot['version'] = versions.get(ward_id)
+                if ward_id in versions:
+                    cache.set(ward_id, versions[ward_id], snapshot)
+                res[ward_id] = snapshot
+        return copy.deepcopy(res)
+
+    def _build_ward_snapshots(self, cr, uid, ward_ids, context=None):
+        """
+        Builds the snapshots returned by :meth:`get_ward_snapshot` with
+        one query for the locations, one for the occupants, one for the
+        waiting placements and one for the allocated staff.
+        """
+
+        cr.execute("""
+            with recursive subtree(id, ward_id, depth) as (
+                    select id, id, 0
+                    from nh_clinical_location
+                    where id in %s and usage = 'ward' and active = true
+                union all
+                    select child.id, subtree.ward_id, subtree.depth + 1
+                    from nh_clinical_location child
+                    inner join subtree on child.parent_id = subtree.id
+                    where child.active = true and subtree.depth < %s
+            )
+            select location.id, subtree.ward_id, location.name,
+                location.code, location.full_name, location.usage,
+                location.parent_id
+            from subtree
+            inner join nh_clinical_location location
+                on location.id = subtree.id
+            order by location.name, location.id
+        """, (tuple(ward_ids), MAX_LOCATION_DEPTH))
+        locations = cr.dictfetchall()
+        res = {}
+        beds = {}
+        location_ward = {}
+        for location in locations:
+            location_ward[location['id']] = location['ward_id']
+            if location['id'] == location['ward_id']:
+                res[location['id']] = {
+                    'id': location['id'],
+                    'name': location['name'],
+                    'code': location['code'],
+                    'full_name': location['full_name'],
+                    'beds': [],
+                    'waiting_placements': [],
+                    'nurse_ids': [],
+                    'hca_ids': []
+                }
+            elif location['usage'] == 'bed':
+                beds[location['id']] = {
+                    'id': location['id'],
+                    'name': location['name'],
+                    'code': location['code'],
+                    'full_name': location['full_name'],
+                    'parent_id': location['parent_id'],
+                    'is_available': True,
+                    'patient': False,
+                    'spell_activity_id': False,
+                    'nurse_ids': [],
+                    'hca_ids': []
+                }
+        if not res:
+            return res
+
+        patient_pool = self.pool['nh.clinical.patient']
+        if beds:
+            cr.execute("""
+                select activity.location_id, activity.id as activity_id,
+                    patient.id as patient_id, patient.family_name,
+                    patient.given_name, patient.middle_names,
+                    patient.other_identifier, patient.patient_identifier
+                from nh_activity activity
+                inner join nh_clinical_spell spell
+                    on spell.activity_id = activity.id
+                inner join nh_clinical_patient patient
+                    on patient.id = spell.patient_id
+                where activity.data_model = 'nh.clinical.spell'
+                    and activity.state = 'started'
+                    and activity.location_id in %s
+            """, (tuple(beds),))
+            for row in cr.dictfetchall():
+                bed = beds[row['location_id']]
+                bed['is_available'] = False
+                bed['spell_activity_id'] = row['activity_id']
+                bed['patient'] = self._snapshot_patient(patient_pool, row)
+
+        cr.execute("""
+            select placement.suggested_location_id, activity.id as activity_id,
+                patient.id as patient_id, patient.family_name,
+                patient.given_name, patient.middle_names,
+                patient.other_identifier, patient.patient_identifier
+            from nh_clinical_patient_placement placement
+            inner join nh_activity activity
+                on activity.id = placement.activity_id
+            inner join nh_clinical_patient patient
+                on patient.id = placement.patient_id
+            where placement.suggested_location_id in %s
+                and activity.state not in ('completed', 'cancelled')
+            order by activity.id
+        """, (tuple(res),))
+        for row in cr.dictfetchall():
+            placement = self._snapshot_patient(patient_pool, row)
+            placement['activity_id'] = row['activity_id']
+            res[row['suggested_location_id']]['waiting_placements'].append(
+                placement)
+
+        cr.execute("""
+            select distinct ulr.location_id, ulr.user_id, groups.name
+            from user_location_rel ulr
+            inner join res_users users
+                on users.id = ulr.user_id and users.active = true
+            inner join res_groups_users_rel gur on gur.uid = ulr.user_id
+            inner join res_groups groups
+                on groups.id = gur.gid and groups.name in %s
+            where ulr.location_id in %s
+            order by ulr.user_id
+        """, (tuple(WARD_SNAPSHOT_GROUPS), tuple(location_ward)))
+        for location_id, user_id, group_name in cr.fetchall():
+            key = WARD_SNAPSHOT_GROUPS[group_name]
+            ward = res[location_ward[location_id]]
+            if user_id not in ward[key]:
+                ward[key].append(user_id)
+            if location_id in beds:
+                beds[location_id][key].append(user_id)
+
+        for bed in sorted(beds.values(), key=lambda b: (b['name'], b['id'])):
+            res[location_ward[bed['id']]]['beds'].append(bed)
+        for ward in res.values():
+            ward['bed_count'] = len(ward['beds'])
+            ward['available_bed_count'] = len(
+                [b for b in ward['beds'] if b['is_available']])
+        return res
+
+    def _snapshot_patient(self, patient_pool, row):
+        if row['family_name'] and row['given_name']:
+            name = patient_pool._get_fullname(row)
+        else:
+            name = row['family_name'] or row['given_name'] or ''
+        return {
+            'id': row['patient_id'],
+            'name': name,
+            'hospital_number': row['other_identifier'],
+            'nhs_number': row['patient_identifier']
+        }
+
+    def get_ward_ids(self, cr, uid, location_ids, context=None):
+        """
+        Gets the wards the locations belong to (and the locations
+        themselves when they are wards).
+
+        :param location_ids: location ids
+        :type location_ids: list
+        :returns: ward ids
+        :rtype: list
+        """
+
+        if isinstance(location_ids, (int, long)):
+            location_ids = [location_ids]
+        location_ids = [i for i in location_ids if i]
+        if not location_ids:
+            return []
+        cr.execute("""
+            with recursive ancestor(id, parent_id, usage, depth) as (
+                    select id, parent_id, usage, 0
+                    from nh_clinical_location
+                    where id in %s
+                union all
+                    select parent.id, parent.parent_id, parent.usage,
+                        ancestor.depth + 1
+                    from nh_clinical_location parent
+                    inner join ancestor on parent.id = ancestor.parent_id
+                    where ancestor.depth < %s
+            )
+            select distinct id from ancestor where usage = 'ward'
+        """, (tuple(set(location_ids)), MAX_LOCATION_DEPTH))
+        return [row[0] for row in cr.fetchall()]
+
+    def bump_ward_versions(self, cr, uid, location_ids, ward_ids=None,
+                           context=None):
+        """
+        Bumps the version of the wards the locations belong to (and of
+        the locations themselves when they are wards), so cached ward
+        snapshots are rebuilt once the current transaction is committed.
+
+        It is called whenever patients are moved, placed or discharged,
+        spells start or end and staff is allocated.
+
+        New versions are inserted, never updated, so transactions
+        changing the same ward do not conflict. Older ones are removed by
+        :meth:`prune_ward_versions`.
+
+        :param location_ids: location ids
+        :type location_ids: list
+        :param ward_ids: more ward ids to bump, e.g. the wards of the
+            locations before they were changed
+        :type ward_ids: list
+        :returns: ``True``
+        :rtype: bool
+        """
+
+        ward_ids = set(ward_ids or []) | set(
+            self.get_ward_ids(cr, uid, location_ids, context=context))
+        if not ward_ids:
+            return True
+        cr.execute("""
+            insert into nh_clinical_ward_version (ward_id, version)
+            select ward_id, nextval('nh_clinical_cache_version_seq')
+            from unnest(%s) ward_id
+        """, (sorted(ward_ids),))
+        return True
+
+    def prune_ward_versions(self, cr, uid, context=None):
+        """
+        Removes the ward versions superseded by a newer one, together
+        with the superseded cache version stamps (see
+        :func:`prune_versions<versioned_cache.prune_versions>`). Called
+        by the ``ir_cron_prune_ward_versions`` scheduled action.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        # removing versions changes their count, so the pruned wards are
+        # bumped for their version to never be seen twice
+        cr.execute("""
+            with pruned as (
+                delete from nh_clinical_ward_version old
+                using nh_clinical_ward_version newer
+                where newer.ward_id = old.ward_id
+                    and newer.version > old.version
+                returning old.ward_id
+            )
+            insert into nh_clinical_ward_version (ward_id, version)
+            select ward_id, nextval('nh_clinical_cache_version_seq')
+            from (select distinct ward_id from pruned) pruned_ward
+        """)
+        _logger.debug("Versions of %s wards pruned.", cr.rowcount)
+        prune_versions(cr)
+        return True
+
+    def get_ward_snapshot_stats(self, cr, uid, context=None):
+        """
+        :returns: ``hits``, ``misses`` and ``size`` of the ward snapshot
+            cache for this registry
+        :rtype: dict
+        """
+        return get_keyed_cache(cr, WARD_SNAPSHOT_CACHE).stats()
+
+    def _ensure_ward_versions(self, cr, ids):
+        cr.execute("""
+            insert into nh_clinical_ward_version (ward_id, version)
+            select location.id, nextval('nh_clinical_cache_version_seq')
+            from nh_clinical_location location
+            where location.usage = 'ward' and location.id in %s
+                and not exists (
+                    select 1 from nh_clinical_ward_version version
+                    where version.ward_id = location.id)
+        """, (tuple(ids),))
+
+    def bulk_create(self, cr, uid, rows, context=None):
+        """
+        Creates a whole location tree (e.g. a hospital estate) at once.
+
+        Locations are inserted level by level with one multi-row
+        ``INSERT`` per tree depth, the clinical contexts are resolved and
+        checked once for the whole import and ``full_name`` and
+        ``pos_id`` are computed for all the new locations with a single
+        ``UPDATE`` (see :meth:`_store_set_values`).
+
+        Each row is a dictionary with the ``code`` (required and unique),
+        ``name`` (defaults to the code), ``parent_code`` or ``parent_id``
+        (the parent may be an existing location or another row),
+        ``usage``, ``type``, ``patient_capacity``, ``active`` and
+        ``contexts`` (list or comma separated names of clinical contexts,
+        ``eobs`` by default) of the location.
+
+        As with :meth:`create`, a POS is created for `hospital` usage and
+        `pos` type locations when the user is a NH Clinical Admin.
+
+        :param rows: locations to create
+        :type rows: list
+        :returns: location code (key) and location id (value)
+        :rtype: dict
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if a
+            code is missing or duplicated, a parent can't be found or a
+            context is not applicable to locations
+        """
+
+        self.check_access_rights(cr, uid, 'create')
+        if not rows:
+            return {}
+        rows = [self._prepare_bulk_row(row) for row in rows]
+        codes = [row['code'] for row in rows]
+        duplicates = set(c for c in codes if codes.count(c) > 1)
+        cr.execute("select code from nh_clinical_location where code in %s",
+                   (tuple(codes),))
+        duplicates.update(r[0] for r in cr.fetchall())
+        if duplicates:
+            raise osv.except_osv(
+                'Error!', 'Location codes already in use: %s'
+                % ', '.join(sorted(duplicates)))
+        levels = self._get_bulk_levels(cr, rows)
+        context_ids = self._resolve_bulk_contexts(cr, uid, rows,
+                                                  context=context)
+
+        code_ids = {}
+        for level in levels:
+            values = []
+            for row in level:
+                parent_id = row['parent_id'] or \
+                    code_ids.get(row['parent_code']) or None
+                values.append(cr.mogrify(
+                    "(%s, %s, %s, %s, %s, %s, %s, %s, "
+                    "(now() at time zone 'UTC'), %s, "
+                    "(now() at time zone 'UTC'))",
+                    (row['name'], row['code'], parent_id,
+                     row['type'] or None, row['usage'] or None,
+                     row['active'], row['patient_capacity'], uid, uid)))
+            cr.execute("""
+                insert into nh_clinical_location
+                    (name, code, parent_id, type, usage, active,
+                     patient_capacity, create_uid, create_date, write_uid,
+                     write_date)
+                values {values}
+                returning code, id
+            """.format(values=', '.join(values)))
+            code_ids.update(dict(cr.fetchall()))
+
+        relations = [cr.mogrify("(%s, %s)", (code_ids[row['code']], c))
+                     for row in rows for c in context_ids[row['code']]]
+        if relations:
+            cr.execute("""
+                insert into nh_location_context_rel (location_id, context_id)
+                values {values}
+            """.format(values=', '.join(relations)))
+
+        ids = code_ids.values()
+        self._ensure_ward_versions(cr, ids)
+        hospitals = [row for row in rows if row['type'] == 'pos' and
+                     row['usage'] == 'hospital']
+        if hospitals:
+            self._create_bulk_pos(cr, uid, hospitals, code_ids,
+                                  context=context)
+        self._store_set_values(cr, uid, ids, LOCATION_TREE_FIELDS, context)
+        self.invalidate_cache(cr, uid, ['child_ids'], context=context)
+        self.invalidate_location_cache(cr, uid, context=context)
+        self.bump_ward_versions(cr, uid, ids, context=context)
+        return code_ids
+
+    def _prepare_bulk_row(self, row):
+        code = row.get('code')
+        if not code:
+            raise osv.except_osv('Error!',
+                                 'Location code is required: %s' % row)
+        contexts = row.get('contexts')
+        if contexts is None:
+            contexts = ['eobs']
+        elif isinstance(contexts, basestring):
+            contexts = [c.strip() for c in contexts.split(',') if c.strip()]
+        active = row.get('active', True)
+        if isinstance(active, basestring):
+            active = active.strip().lower() not in ('0', 'false', 'no', '')
+        return {
+            'code': code,
+            'name': row.get('name') or code,
+            'parent_code': row.get('parent_code') or False,
+            'parent_id': int(row.get('parent_id') or 0) or False,
+            'type': row.get('type') or False,
+            'usage': row.get('usage') or False,
+            'active': bool(active),
+            'patient_capacity': int(row.get('patient_capacity') or 1),
+            'contexts': contexts
+        }
+
+    def _get_bulk_levels(self, cr, rows):
+        """
+        Sorts the rows of :meth:`bulk_create` into tree levels, so every
+        row comes after its parent. Parents outside of the rows are
+        resolved by code with one query.
+
+        :returns: list of rows lists, root locations first
+        :rtype: list
+        """
+
+        row_codes = set(row['code'] for row in rows)
+        external_codes = set(row['parent_code'] for row in rows
+                             if row['parent_code'] and not row['parent_id'] and
+                             row['parent_code'] not in row_codes)
+        if external_codes:
+            cr.execute("select code, id from nh_clinical_location "
+                       "where code in %s", (tuple(external_codes),))
+            external_ids = dict(cr.fetchall())
+            missing = external_codes - set(external_ids)
+            if missing:
+                raise osv.except_osv(
+                    'Error!', 'Parent locations not found: %s'
+                    % ', '.join(sorted(missing)))
+            for row in rows:
+                if row['parent_code'] in external_ids:
+                    row['parent_id'] = external_ids[row['parent_code']]
+
+        levels = []
+        placed = set()
+        pending = rows
+        while pending:
+            level = [row for row in pending if row['parent_id'] or
+                     not row['parent_code'] or row['parent_code'] in placed]
+            if not level:
+                raise osv.except_osv(
+                    'Error!', 'Location hierarchy contains a cycle: %s'
+                    % ', '.join(sorted(row['code'] for row in pending)))
+            levels.append(level)
+            placed.update(row['code'] for row in level)
+            pending = [row for row in pending if row['code'] not in placed]
+        return levels
+
+    def _resolve_bulk_contexts(self, cr, uid, rows, context=None):
+        """
+        Resolves the clinical context names of the rows of
+        :meth:`bulk_create` and checks they apply to locations, once per
+        context.
+
+        :returns: location code (key) and context ids (value)
+        :rtype: dict
+        """
+
+        names = set(name for row in rows for name in row['contexts'])
+        context_ids = {}
+        if names:
+            context_pool = self.pool['nh.clinical.context']
+            cr.execute("select name, min(id) from nh_clinical_context "
+                       "where name in %s group by name", (tuple(names),))
+            context_ids = dict(cr.fetchall())
+            missing = names - set(context_ids)
+            if missing:
+                raise osv.except_osv(
+                    'Error!', 'Clinical contexts not found: %s'
+                    % ', '.join(sorted(missing)))
+            context_pool.check_model(cr, uid, context_ids.values(),
+                                     self._name, context=context)
+        return {row['code']: [context_ids[name] for name in row['contexts']]
+                for row in rows}
+
+    def _create_bulk_pos(self, cr, uid, rows, code_ids, context=None):
+        user_pool = self.pool['res.users']
+        user = user_pool.browse(cr, uid, uid, context=context)
+        if 'NH Clinical Admin Group' not in [g.name for g in user.groups_id]:
+            return True
+        pos_pool = self.pool['nh.clinical.pos']
+        pos_ids = [pos_pool.create(cr, uid, {
+            'name': row['name'], 'location_id': code_ids[row['code']]},
+            context=context) for row in rows]
+        return user_pool.write(cr, uid, user.id,
+                               {'pos_ids': [[4, p] for p in pos_ids]},
+                               context=context)
+
+    def load_estate(self, cr, uid, data, file_format='csv', context=None):
+        """
+        Loads a hospital estate from a CSV or JSON export and creates it
+        with :meth:`bulk_create`.
+
+        CSV data must have a header row using the :meth:`bulk_create`
+        keys as column names. JSON data must be a list of
+        :meth:`bulk_create` rows or an object with such a list as
+        ``locations``.
+
+        :param data: file contents
+        :type data: str
+        :param file_format: ``csv`` [default] or ``json``
+        :type file_format: str
+        :returns: location code (key) and location id (value)
+        :rtype: dict
+        """
+
+        if file_format == 'json':
+            rows = json.loads(data)
+            if isinstance(rows, dict):
+                rows = rows.get('locations', [])
+        elif file_format == 'csv':
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            rows = [{k.strip(): v.decode('utf-8').strip()
+                     for k, v in row.items() if k and v is not None}
+                    for row in csv.DictReader(StringIO(data))]
+        else:
+            raise osv.except_osv('Error!',
+                                 'Unknown estate format: %s' % file_format)
+        return self.bulk_create(cr, uid, rows, context=context)
+
+    def bulk_reparent(self, cr, uid, ids, parent_id, context=None):
+        """
+        Moves locations (e.g. bays or beds) under a new parent location
+        with a single ``UPDATE``, then recomputes the tree dependent
+        fields of the moved subtrees at once.
+
+        :param ids: ids of the locations to move
+        :type ids: list
+        :param parent_id: id of the new parent location
+        :type parent_id: int
+        :returns: ``True``
+        :rtype: bool
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if the
+            new parent is one of the moved locations or their descendants
+        """
+
+        self.check_access_rights(cr, uid, 'write')
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return True
+        subtree_ids = self.get_subtree_ids(cr, uid, ids, context=context)
+        if parent_id in subtree_ids:
+            raise osv.except_osv(
+                'Error!', 'A location can not be moved under itself or '
+                          'one of its descendants')
+        ward_ids = self.get_ward_ids(cr, uid, ids, context=context)
+        # the transfer origins whose ancestors or descendants change
+        origin_ids = set(subtree_ids)
+        origin_ids.update(self.get_path_ids(cr, uid, ids, context=context))
+        if parent_id:
+            origin_ids.update(self.get_path_ids(cr, uid, parent_id,
+                                                context=context))
+        cr.execute("""
+            update nh_clinical_location
+            set parent_id = %s, write_uid = %s,
+                write_date = (now() at time zone 'UTC')
+            where id in %s
+        """, (parent_id, uid, tuple(ids)))
+        self._store_set_values(cr, uid, subtree_ids, LOCATION_TREE_FIELDS,
+                               context)
+        self.invalidate_cache(cr, uid, ['parent_id', 'child_ids'],
+                              context=context)
+        self.invalidate_location_cache(cr, uid, context=context)
+        self.bump_ward_versions(cr, uid, ids, ward_ids=ward_ids,
+                                context=context)
+        self.pool['nh.clinical.spell'].refresh_transferred_access(
+            cr, SUPERUSER_ID, location_ids=list(origin_ids), context=context)
+        return True
+
+    def init(self, cr):
+        ensure_version_table(cr, LOCATION_CACHE)
+        cr.execute("""
+            select 1 from information_schema.tables
+            where table_name = 'nh_clinical_ward_version'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                create table nh_clinical_ward_version (
+                    ward_id integer not null
+                        references nh_clinical_location on delete cascade,
+                    version bigint not null
+                )
+            """)
+        cr.execute("""
+            alter table nh_clinical_ward_version
+            drop constraint if exists nh_clinical_ward_version_pkey
+        """)
+        cr.execute("select 1 from pg_indexes where indexname = %s",
+                   ('nh_clinical_ward_version_idx',))
+        if not cr.fetchone():
+            cr.execute("""
+                create index nh_clinical_ward_version_idx
+                on nh_clinical_ward_version (ward_id, version)
+            """)
+        cr.execute("""
+            insert into nh_clinical_ward_version (ward_id, version)
+            select location.id, nextval('nh_clinical_cache_version_seq')
+            from nh_clinical_location location
+            where location.usage = 'ward' and not exists (
+                select 1 from nh_clinical_ward_version version
+                where version.ward_id = location.id)
+        """)
+
     def create(self, cr, uid, vals, context=None):
         """
         Extends Odoo's :meth:`create()<openerp.models.Model.create>`
@@ -568,6 +1503,10 @@ class nh_clinical_location(orm.Model):
                                    context=context)
         res = super(nh_clinical_location, self).create(
             cr, uid, vals, context=context)
+        self.invalidate_location_cache(cr, uid, context=context)
+        if vals.get('usage') == 'ward':
+            self._ensure_ward_versions(cr, [res])
+        self.bump_ward_versions(cr, uid, [res], context=context)
         if vals.get('type') == 'pos' and vals.get('usage') == 'hospital':
             user_pool = self.pool['res.users']
             user = user_pool.browse(cr, uid, uid, context=context)
@@ -595,5 +1534,47 @@ class nh_clinical_location(orm.Model):
         if vals.get('context_ids'):
             self.check_context_ids(cr, uid, vals.get('context_ids'),
                                    context=context)
-        return super(nh_clinical_location, self).write(cr, uid, ids, vals,
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        ward_change = any(f in vals for f in WARD_SNAPSHOT_FIELDS)
+        ward_ids = self.get_ward_ids(cr, uid, ids, context=context) \
+            if ward_change else []
+        origin_ids = set()
+        if 'parent_id' in vals:
+            # the transfer origins whose ancestors or descendants change
+            origin_ids.update(self.get_path_ids(cr, uid, ids,
+                                                context=context))
+        res = super(nh_clinical_location, self).write(cr, uid, ids, vals,
+                                                      context=context)
+        if any(f in vals for f in LOCATION_CACHE_FIELDS):
+            self.invalidate_location_cache(cr, uid, context=context)
+        if vals.get('usage') == 'ward':
+            self._ensure_ward_versions(cr, ids)
+        if ward_change:
+            self.bump_ward_versions(cr, uid, ids, ward_ids=ward_ids,
+                                    context=context)
+        if 'parent_id' in vals or 'user_ids' in vals:
+            # users allocated here reach the origins above and below
+            origin_ids.update(self.get_path_ids(cr, uid, ids,
+                                                context=context))
+            origin_ids.update(self.get_subtree_ids(cr, uid, ids,
+                                                   context=context))
+            self.pool['nh.clinical.spell'].refresh_transferred_access(
+                cr, SUPERUSER_ID, location_ids=list(origin_ids),
+                context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        """
+        Extends Odoo's :meth:`unlink()<openerp.models.Model.unlink>`
+        method to invalidate the location resolution cache.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+
+        self.bump_ward_versions(cr, uid, ids, context=context)
+        res = super(nh_clinical_location, self).unlink(cr, uid, ids,
                                                        context=context)
+        self.invalidate_location_cache(cr, uid, context=context)
+        return res
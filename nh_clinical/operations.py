@@ -6,10 +6,14 @@ hospital administrative tasks like patient movements, admissions,
 discharge, etc.
 """
 import logging
+from collections import OrderedDict
 
 from openerp import SUPERUSER_ID, api
 from openerp.osv import orm, fields, osv
 
+from .activity_extension import DEFERRED_UPDATES
+from .api import ADT_RESOLVED
+
 _logger = logging.getLogger(__name__)
 
 
@@ -34,7 +38,11 @@ class nh_clinical_patient_move(orm.Model):
                                        'Destination Location'),
         'location_name': fields.related(
             'location_id', 'full_name', type='char', size=150,
-            string='Destination Location'),
+            string='Destination Location', readonly=True, select=True,
+            store={
+                'nh.clinical.patient.move': (lambda s, cr, uid, ids, c: ids,
+                                             ['location_id'], 10)
+            }),
         'patient_id': fields.many2one('nh.clinical.patient', 'Patient',
                                       required=True),
         'reason': fields.text('Reason'),
@@ -107,8 +115,21 @@ class nh_clinical_patient_move(orm.Model):
                 cr, uid, activity.parent_id.id,
                 {'location_id': activity.data_ref.location_id.id},
                 context=context)
-        return super(nh_clinical_patient_move, self).complete(
+        res = super(nh_clinical_patient_move, self).complete(
             cr, uid, activity_id, context)
+        if location_id and activity.parent_id and activity.creator_id and \
+                activity.creator_id.data_model == \
+                'nh.clinical.patient.transfer':
+            self.pool['nh.clinical.spell'].refresh_transferred_access(
+                cr, SUPERUSER_ID, spell_ids=[activity.parent_id.data_ref.id],
+                context=context)
+        return res
+
+    def init(self, cr):
+        # nh.clinical.spell is loaded before the moves the recently
+        # transferred access is computed from
+        self.pool['nh.clinical.spell'].refresh_transferred_access(
+            cr, SUPERUSER_ID)
 
 
 class nh_clinical_patient_swap_beds(orm.Model):
@@ -611,6 +632,13 @@ class nh_clinical_patient_admission(orm.Model):
         as actions may need to take place after the patient is admitted
         into the Hospital.
 
+        The spell and the movement are created with their patient,
+        location and POS, and their
+        :meth:`update_activity<activity.nh_activity_data.update_activity>`
+        is deferred and applied once for both (and for any activity the
+        caller deferred, like the admission itself) before the policy is
+        triggered.
+
         :returns: ``True``
         :rtype: bool
         """
@@ -620,42 +648,53 @@ class nh_clinical_patient_admission(orm.Model):
         activity = activity_pool.browse(cr, SUPERUSER_ID, activity_id,
                                         context=context)
         admission = activity.data_ref
-
-        spell_pool = self.pool['nh.clinical.spell']
-        spell_activity_id = spell_pool.create_activity(cr, SUPERUSER_ID, {
-            'creator_id': activity_id
-        }, {
+        plan_context = dict(context or {})
+        deferred = plan_context.setdefault(DEFERRED_UPDATES, OrderedDict())
+        planned_vals = {
             'patient_id': admission.patient_id.id,
             'location_id': admission.location_id.id,
-            'pos_id': admission.pos_id.id,
-            'code': admission.code,
-            'start_date': admission.start_date,
-            'con_doctor_ids': [
-                [6, False, [d.id for d in admission.con_doctor_ids]]
-            ],
-            'ref_doctor_ids': [
-                [6, False, [d.id for d in admission.ref_doctor_ids]]
-            ]
-        }, context=context)
+            'pos_id': admission.pos_id.id
+        }
+
+        spell_pool = self.pool['nh.clinical.spell']
+        spell_activity_id = spell_pool.create_activity(
+            cr, SUPERUSER_ID, dict(planned_vals, creator_id=activity_id), {
+                'patient_id': admission.patient_id.id,
+                'location_id': admission.location_id.id,
+                'pos_id': admission.pos_id.id,
+                'code': admission.code,
+                'start_date': admission.start_date,
+                'con_doctor_ids': [
+                    [6, False, [d.id for d in admission.con_doctor_ids]]
+                ],
+                'ref_doctor_ids': [
+                    [6, False, [d.id for d in admission.ref_doctor_ids]]
+                ]
+            }, context=plan_context)
         activity_pool.start(cr, SUPERUSER_ID, spell_activity_id,
-                            context=context)
+                            context=plan_context)
         activity_pool.write(cr, SUPERUSER_ID, activity_id,
-                            {'parent_id': spell_activity_id}, context=context)
+                            {'parent_id': spell_activity_id},
+                            context=plan_context)
 
         move_pool = self.pool['nh.clinical.patient.move']
-        move_activity_id = move_pool.create_activity(cr, SUPERUSER_ID, {
-            'parent_id': spell_activity_id,
-            'creator_id': activity_id
-        }, {
-            'patient_id': admission.patient_id.id,
-            'location_id': admission.location_id.id
-        }, context=context)
+        move_activity_id = move_pool.create_activity(
+            cr, SUPERUSER_ID, dict(planned_vals, parent_id=spell_activity_id,
+                                   creator_id=activity_id), {
+                'patient_id': admission.patient_id.id,
+                'location_id': admission.location_id.id
+            }, context=plan_context)
         activity_pool.complete(cr, SUPERUSER_ID, move_activity_id,
-                               context=context)
+                               context=plan_context)
+        # the spell is its own spell activity once started
+        deferred.update({spell_activity_id: spell_activity_id,
+                         move_activity_id: spell_activity_id})
+        activity_pool.flush_activity_updates(cr, uid, context=plan_context)
         # trigger admission policy activities
+        del plan_context[DEFERRED_UPDATES]
         self.trigger_policy(
             cr, uid, activity_id, location_id=admission.location_id.id,
-            context=context)
+            context=plan_context)
         return res
 
     def cancel(self, cr, uid, activity_id, context=None):
@@ -734,20 +773,31 @@ class nh_clinical_patient_transfer(orm.Model):
         Checks the submitted data is correct and then calls
         :meth:`submit<activity.nh_activity.submit>`.
 
+        The spell of the patient is taken from ``context[ADT_RESOLVED]``
+        when an ADT transfer already resolved it.
+
         :returns: ``True``
         :rtype: bool
         """
         data = vals.copy()
         if 'patient_id' in vals:
-            spell_pool = self.pool['nh.clinical.spell']
+            resolved = (context or {}).get(ADT_RESOLVED) or {}
+            if resolved.get('spell_id') and \
+                    resolved['patient_id'] == vals['patient_id']:
+                spell_activity_id = resolved['spell_activity_id']
+                origin_location_id = resolved['spell_location_id']
+            else:
+                spell_pool = self.pool['nh.clinical.spell']
+                spell_id = spell_pool.get_by_patient_id(
+                    cr, uid, vals['patient_id'], exception='False',
+                    context=context)
+                spell = spell_pool.browse(cr, uid, spell_id, context=context)
+                spell_activity_id = spell.activity_id.id
+                origin_location_id = spell.location_id.id
             activity_pool = self.pool['nh.activity']
-            spell_id = spell_pool.get_by_patient_id(
-                cr, uid, vals['patient_id'], exception='False',
-                context=context)
-            spell = spell_pool.browse(cr, uid, spell_id, context=context)
-            data.update({'origin_loc_id': spell.location_id.id})
+            data.update({'origin_loc_id': origin_location_id})
             activity_pool.write(
-                cr, uid, activity_id, {'parent_id': spell.activity_id.id},
+                cr, uid, activity_id, {'parent_id': spell_activity_id},
                 context=context)
         else:
             raise osv.except_osv('Transfer Error!',
@@ -768,6 +818,12 @@ class nh_clinical_patient_transfer(orm.Model):
         if the movement takes place as this is technically equivalent to
         an admission into the new Ward.
 
+        The movement is created with its patient, location and POS, and
+        its
+        :meth:`update_activity<activity.nh_activity_data.update_activity>`
+        and the spell's are deferred and applied at once (with any
+        activity the caller deferred) before the policy is triggered.
+
         :returns: ``True``
         :rtype: bool
         """
@@ -781,20 +837,32 @@ class nh_clinical_patient_transfer(orm.Model):
         if not location_pool.is_child_of(
                 cr, uid, transfer.origin_loc_id.id, transfer.location_id.code,
                 context=context):
+            plan_context = dict(context or {})
+            deferred = plan_context.setdefault(DEFERRED_UPDATES,
+                                               OrderedDict())
+            spell_activity = activity.parent_id
             move_pool = self.pool['nh.clinical.patient.move']
             move_activity_id = move_pool.create_activity(cr, SUPERUSER_ID, {
-                'parent_id': activity.parent_id.id,
-                'creator_id': activity_id
+                'parent_id': spell_activity.id,
+                'creator_id': activity_id,
+                'patient_id': transfer.patient_id.id,
+                'location_id': transfer.location_id.id,
+                'pos_id': spell_activity.pos_id.id
             }, {
                 'patient_id': transfer.patient_id.id,
                 'location_id': transfer.location_id.id
-            }, context=context)
+            }, context=plan_context)
             activity_pool.complete(cr, SUPERUSER_ID, move_activity_id,
-                                   context=context)
+                                   context=plan_context)
+            # the spell moves, so it goes through a full update
+            deferred[move_activity_id] = spell_activity.id
+            activity_pool.flush_activity_updates(cr, uid,
+                                                 context=plan_context)
             # trigger transfer policy activities
+            del plan_context[DEFERRED_UPDATES]
             self.trigger_policy(
                 cr, uid, activity_id, location_id=transfer.location_id.id,
-                case=1, context=context)
+                case=1, context=plan_context)
         return res
 
     def cancel(self, cr, uid, activity_id, context=None):
@@ -934,10 +1002,9 @@ class nh_clinical_patient_follow(orm.Model):
         updates the ``following_ids`` list for the assigned
         :mod:`user<base.res_users>`.
 
-        It will also call
-        :meth:`update activity<activity.nh_activity.update_activity>`
-        for all not ``completed`` or ``cancelled`` activities related to
-        the list of patients.
+        The user is then added to the users of all not ``completed``
+        or ``cancelled`` activities related to the list of patients (see
+        :meth:`add_follower_users<activity.nh_activity.add_follower_users>`).
 
         :returns: ``True``
         :rtype: bool
@@ -966,12 +1033,9 @@ class nh_clinical_patient_follow(orm.Model):
         patient_ids = [
             patient.id for patient in follow_activity.data_ref.patient_ids
         ]
-        update_activity_ids = activity_pool.search(cr, uid, [
-            ['patient_id', 'in', patient_ids],
-            ['state', 'not in', ['completed', 'cancelled']]], context=context)
-        for activity_id in update_activity_ids:
-            activity_pool.update_activity(cr, SUPERUSER_ID, activity_id,
-                                          context=context)
+        activity_pool.add_follower_users(
+            cr, SUPERUSER_ID, patient_ids,
+            user_ids=[follow_activity.user_id.id], context=context)
         return res
 
 
@@ -993,7 +1057,9 @@ class nh_clinical_patient_unfollow(orm.Model):
     def complete(self, cr, uid, activity_id, context=None):
         """
         Calls :meth:`complete<activity.nh_activity.complete>` and then
-        removes the ``follower_ids`` list for the selected patients.
+        removes the ``follower_ids`` list for the selected patients and
+        their visibility of the patients' open activities (see
+        :meth:`remove_follower_users<activity.nh_activity.remove_follower_users>`).
 
         It will also :meth:`cancel<activity.nh_activity.cancel>`
         any number of open (not ``completed`` or ``cancelled``)
@@ -1007,33 +1073,30 @@ class nh_clinical_patient_unfollow(orm.Model):
             cr, uid, activity_id, context)
         activity_pool = self.pool['nh.activity']
         patient_pool = self.pool['nh.clinical.patient']
-        follow_pool = self.pool['nh.clinical.patient.follow']
         unfollow_activity = activity_pool.browse(cr, uid, activity_id,
                                                  context=context)
         patient_ids = [p.id for p in unfollow_activity.data_ref.patient_ids]
+        cr.execute("""
+            select distinct user_id from user_patient_rel
+            where patient_id in %s
+        """, (tuple(patient_ids) or (None,),))
+        follower_ids = [row[0] for row in cr.fetchall()]
         res = patient_pool.write(cr, uid, patient_ids,
                                  {'follower_ids': [[5]]}, context=context)
-        update_activity_ids = activity_pool.search(cr, uid, [
-            ['patient_id', 'in', patient_ids],
-            ['state', 'not in', ['completed', 'cancelled']]], context=context)
-
-        for activity_id in update_activity_ids:
-            activity_pool.update_activity(cr, SUPERUSER_ID, activity_id,
-                                          context=context)
+        activity_pool.remove_follower_users(
+            cr, SUPERUSER_ID, patient_ids, follower_ids, context=context)
         # CANCEL PATIENT FOLLOW ACTIVITIES THAT CONTAIN ANY OF THE
         # UNFOLLOWED PATIENTS
-        follow_ids = []
-        for patient_id in patient_ids:
-            follow_ids += follow_pool.search(cr, uid, [
-                ['activity_id.create_uid', '=', uid],
-                ['patient_ids', 'in', [patient_id]],
-                ['activity_id.state', 'not in', ['completed', 'cancelled']]
-            ])
-        follow_ids = list(set(follow_ids))
-        follow_activity_ids = [
-            f.activity_id.id for f in follow_pool.browse(
-                cr, uid, follow_ids, context=context)
-        ]
+        cr.execute("""
+            select distinct activity.id
+            from nh_clinical_patient_follow follow
+            inner join follow_patient_rel rel on rel.follow_id = follow.id
+            inner join nh_activity activity
+                on activity.id = follow.activity_id
+            where rel.patient_id in %s and activity.create_uid = %s
+                and activity.state not in ('completed', 'cancelled')
+        """, (tuple(patient_ids) or (None,), uid))
+        follow_activity_ids = [row[0] for row in cr.fetchall()]
         for activity_id in follow_activity_ids:
             activity_pool.cancel(cr, uid, activity_id, context=context)
         return res
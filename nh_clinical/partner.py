@@ -46,6 +46,24 @@ class res_partner(orm.Model):
             context=dict(context or {}, mail_create_nosubscribe=True)
         )
 
+    def write(self, cr, uid, ids, vals, context=None):
+        """
+        Extends Odoo's `write()` to invalidate the user context cache
+        when the time zone of the partner of a user changes.
+        """
+
+        res = super(res_partner, self).write(cr, uid, ids, vals,
+                                             context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if 'tz' in vals and ids:
+            cr.execute("select 1 from res_users where partner_id in %s "
+                       "limit 1", (tuple(ids),))
+            if cr.fetchone():
+                self.pool['res.users'].invalidate_user_context_cache(
+                    cr, uid, context=context)
+        return res
+
 
 class res_partner_category_extension(orm.Model):
     """
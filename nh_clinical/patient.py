@@ -1,14 +1,120 @@
 # Part of NHClinical. See LICENSE file for full copyright and licensing details
 # -*- coding: utf-8 -*-
+import csv
 import logging
 
 import re
+from datetime import datetime as dt
 from dateutil.parser import parse
+
+import psycopg2
 from openerp.osv import fields, osv
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT as DTF
 
+from .activity_extension import STARTED_SPELL_PATIENT_INDEX
+from .tracing import traced
+
 _logger = logging.getLogger(__name__)
 
+#: Patient fields shown in the ward bed boards
+WARD_SNAPSHOT_FIELDS = ['family_name', 'given_name', 'middle_names',
+                        'other_identifier', 'patient_identifier']
+#: Identifier characters removed when importing patients
+NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+#: Imported fields normalised by :meth:`nh_clinical_patient.format_data`
+IMPORT_FORMATTED_FIELDS = ['other_identifier', 'patient_identifier', 'dob']
+#: Default number of rows inserted at once by
+#: :meth:`nh_clinical_patient.import_patients`
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_IDENTIFIER_NAMES = {
+    'other_identifier': 'Hospital Number',
+    'patient_identifier': 'NHS Number'
+}
+#: Patient fields that change what :meth:`resolve_patient` returns
+PATIENT_MEMO_FIELDS = ['other_identifier', 'patient_identifier', 'active']
+
+
+#: Stored copy of each identifier without separators, only set for
+#: active patients and backed by a unique index (see
+#: :meth:`nh_clinical_patient.init`)
+NORMALISED_IDENTIFIERS = {
+    'other_identifier': 'other_identifier_normalised',
+    'patient_identifier': 'patient_identifier_normalised'
+}
+
+#: Store triggers of the normalised identifier fields
+NORMALISED_IDENTIFIERS_STORE = {
+    'nh.clinical.patient': (lambda s, cr, uid, ids, c: ids,
+                            PATIENT_MEMO_FIELDS, 10),
+    'res.partner': (lambda s, cr, uid, ids, c: s.pool[
+        'nh.clinical.patient'].search(cr, uid, [['partner_id', 'in', ids]],
+                                      context={'active_test': False}),
+                    ['active'], 10)
+}
+
+#: Sets the normalised identifiers of the patients matching ``where``
+#: in bulk, the same way :meth:`nh_clinical_patient._get_normalised`
+#: does
+NORMALISE_IDENTIFIERS_SQL = """
+    update nh_clinical_patient patient
+    set other_identifier_normalised = case when partner.active then
+            nullif(regexp_replace(patient.other_identifier, %(pattern)s, '',
+                                  'g'), '') end,
+        patient_identifier_normalised = case when partner.active then
+            nullif(regexp_replace(patient.patient_identifier, %(pattern)s,
+                                  '', 'g'), '') end
+    from res_partner partner
+    where partner.id = patient.partner_id {where}
+"""
+
+#: Tables referencing patients that :meth:`nh_clinical_patient.merge`
+#: does not re-point because they are rebuilt once the rows are moved
+MERGE_DERIVED_TABLES = ['nh_clinical_spell_open']
+
+#: Fields the patient fullname is computed from
+PATIENT_NAME_FIELDS = ['family_name', 'given_name', 'middle_names']
+
+#: Store triggers of the ``full_name`` and ``display_name`` fields
+PATIENT_NAME_STORE = {
+    'nh.clinical.patient': (lambda s, cr, uid, ids, c: ids,
+                            PATIENT_NAME_FIELDS, 10)
+}
+
+#: Trigram index backing ``ilike`` searches on ``full_name``
+FULL_NAME_INDEX = 'nh_clinical_patient_full_name_trgm_idx'
+
+
+def normalise_identifier(identifier):
+    """
+    Removes every non alphanumeric character from a hospital or NHS
+    number, so ``'943 476 5919'`` and ``'943-476-5919'`` are the same
+    identifier.
+
+    :returns: normalised identifier or ``False`` if empty
+    :rtype: str
+    """
+    if not identifier:
+        return False
+    return NON_ALPHANUMERIC.sub('', identifier) or False
+
+
+def identifier_index(field):
+    """
+    :returns: name of the unique index on the normalised ``field``
+    :rtype: str
+    """
+    return 'nh_clinical_patient_%s_uniq' % NORMALISED_IDENTIFIERS[field]
+
+
+#: Subquery matching the started spells of the ``patient`` row, backed
+#: by the ``nh_activity_started_spell_patient_idx`` partial index
+ADMITTED_PATIENT_SQL = """
+    select 1 from nh_activity spell_activity
+    where spell_activity.patient_id = patient.id
+        and spell_activity.data_model = 'nh.clinical.spell'
+        and spell_activity.state = 'started'
+"""
+
 
 class nh_clinical_patient(osv.Model):
     """
@@ -17,8 +123,15 @@ class nh_clinical_patient(osv.Model):
     _name = 'nh.clinical.patient'
     _description = "A Patient"
 
+    _inherit = ['nh.keyset.pagination']
     _inherits = {'res.partner': 'partner_id'}
 
+    _keyset_orders = {
+        'id': ('asc', ['{alias}id']),
+        'id desc': ('desc', ['{alias}id']),
+        'full_name': ('asc', ["coalesce({alias}full_name, '')", '{alias}id'])
+    }
+
     _gender = [['BOTH', 'Both'], ['F', 'Female'], ['I', 'Intermediate'],
                ['M', 'Male'], ['NSP', 'Not Specified'], ['U', 'Unknown']]
     _ethnicity = [
@@ -66,8 +179,9 @@ class nh_clinical_patient(osv.Model):
 
     def _get_name(self, cr, uid, ids, fn, args, context=None):
         """
-        Used by function field ``full_name`` to fetch the fullname for
-        each patient given by patient id.
+        Used by the stored function fields ``full_name`` and
+        ``display_name`` to compute the fullname of the patients with
+        one read. Patients without family or given name get ``False``.
 
         :param ids: patient ids
         :type ids: list
@@ -76,28 +190,74 @@ class nh_clinical_patient(osv.Model):
         """
 
         result = dict.fromkeys(ids, False)
-        for r in self.read(cr, uid, ids,
-                           ['family_name', 'given_name', 'middle_names'],
+        for r in self.read(cr, uid, ids, PATIENT_NAME_FIELDS,
+                           context=context):
+            if r['family_name'] and r['given_name']:
+                # TODO This needs to be manipulable depending on locale
+                result[r['id']] = self._get_fullname(r)
+        return result
+
+    def _get_normalised(self, cr, uid, ids, fields, args, context=None):
+        """
+        Used by the stored function fields ``other_identifier_normalised``
+        and ``patient_identifier_normalised``. Inactive patients get
+        ``False`` so they are left out of the unique indexes.
+
+        :returns: normalised identifiers of patients
+        :rtype: dict
+        """
+
+        result = {}
+        for r in self.read(cr, uid, ids, PATIENT_MEMO_FIELDS,
                            context=context):
-            # TODO This needs to be manipulable depending on locale
-            result[r['id']] = self._get_fullname(r)
+            result[r['id']] = dict(
+                (column, r['active'] and normalise_identifier(r[field]))
+                for field, column in NORMALISED_IDENTIFIERS.items())
         return result
 
+    def _search_identifier(self, cr, uid, field, identifier, context=None):
+        """
+        Searches active patients by the normalised ``field`` identifier.
+
+        :param field: ``other_identifier`` or ``patient_identifier``
+        :type field: str
+        :returns: patient ids
+        :rtype: list
+        """
+        identifier = normalise_identifier(identifier)
+        if not identifier:
+            return []
+        return self.search(
+            cr, uid, [[NORMALISED_IDENTIFIERS[field], '=', identifier]],
+            context=context)
+
     def name_get(self, cr, uid, ids, context=None):
         """
         Override name_get method so we return the patient's fullname
-        instead of the default name field
+        instead of the default name field. Reads the stored
+        ``full_name`` of all the patients at once.
         """
         if not ids:
             return [(0, '')]
-        if isinstance(ids, list):
-            ids = ids[0]
-        names = self.read(cr, uid, ids, [
-            'family_name',
-            'given_name',
-            'middle_names'
-        ], context=context)
-        return [(ids, self._get_fullname(names))]
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        return [(r['id'], r['full_name'] or self._get_fullname(r))
+                for r in self.read(cr, uid, ids,
+                                   ['full_name'] + PATIENT_NAME_FIELDS,
+                                   context=context)]
+
+    def name_search(self, cr, uid, name='', args=None, operator='ilike',
+                    context=None, limit=100):
+        """
+        Searches patients by their stored ``full_name``, which has a
+        trigram index (see :meth:`init`) so ``ilike`` searches do not
+        scan the whole table.
+        """
+        args = list(args or [])
+        if name:
+            args.append(('full_name', operator, name))
+        ids = self.search(cr, uid, args, limit=limit, context=context)
+        return self.name_get(cr, uid, ids, context=context)
 
     def check_hospital_number(self, cr, uid, hospital_number, exception=False,
                               context=None):
@@ -114,11 +274,8 @@ class nh_clinical_patient(osv.Model):
             ``exception`` is ``True`` and  if the patient exists or if
             the patient does not
         """
-        if not hospital_number:
-            result = False
-        else:
-            domain = [['other_identifier', '=', hospital_number]]
-            result = bool(self.search(cr, uid, domain, context=context))
+        result = bool(self._search_identifier(
+            cr, uid, 'other_identifier', hospital_number, context=context))
         if exception:
             if result and eval(exception):
                 raise osv.except_osv(
@@ -148,11 +305,8 @@ class nh_clinical_patient(osv.Model):
             the patient does not
         """
 
-        if not nhs_number:
-            result = False
-        else:
-            domain = [['patient_identifier', '=', nhs_number]]
-            result = bool(self.search(cr, uid, domain, context=context))
+        result = bool(self._search_identifier(
+            cr, uid, 'patient_identifier', nhs_number, context=context))
         if exception:
             if result and eval(exception):
                 raise osv.except_osv(
@@ -166,6 +320,144 @@ class nh_clinical_patient(osv.Model):
                     % nhs_number)
         return result
 
+    @traced()
+    def resolve_patient(self, cr, uid, hospital_number=None, nhs_number=None,
+                        context=None):
+        """
+        Finds an active patient by `hospital number` and/or `NHS number`
+        with a single query on the normalised identifiers, preferring a
+        hospital number match.
+
+        Matches are memoised in ``context['nh_patient_memo']`` when the
+        caller provides one (see
+        :meth:`get_patient_memo_context`), so the same identifier is
+        only looked up once while an ADT message is processed. The memo
+        is cleared whenever a patient identifier or active flag is
+        written with that context.
+
+        :param hospital_number: patient's hospital number
+        :type hospital_number: str
+        :param nhs_number: patient's NHS number
+        :type nhs_number: str
+        :returns: patient id and how it was matched:
+            ``'hospital_number'`` or ``'nhs_number'``. ``(False, False)``
+            if no patient is found.
+        :rtype: tuple
+        """
+
+        hospital_number = normalise_identifier(hospital_number)
+        nhs_number = normalise_identifier(nhs_number)
+        if not hospital_number and not nhs_number:
+            return False, False
+        memo = context.get('nh_patient_memo') \
+            if isinstance(context, dict) else None
+        if memo is not None:
+            if hospital_number and \
+                    ('hospital_number', hospital_number) in memo:
+                return memo[('hospital_number', hospital_number)], \
+                    'hospital_number'
+            if nhs_number and not hospital_number and \
+                    ('nhs_number', nhs_number) in memo:
+                return memo[('nhs_number', nhs_number)], 'nhs_number'
+        cr.execute("""
+            select patient.id, coalesce(
+                patient.other_identifier_normalised = %(hospital_number)s,
+                false) as by_hospital
+            from nh_clinical_patient patient
+            where patient.other_identifier_normalised = %(hospital_number)s
+                or patient.patient_identifier_normalised = %(nhs_number)s
+            order by by_hospital desc, patient.id
+            limit 1
+        """, {'hospital_number': hospital_number or None,
+              'nhs_number': nhs_number or None})
+        row = cr.fetchone()
+        if not row:
+            return False, False
+        patient_id = row[0]
+        match = 'hospital_number' if row[1] else 'nhs_number'
+        if memo is not None:
+            identifier = hospital_number if row[1] else nhs_number
+            memo[(match, identifier)] = patient_id
+        return patient_id, match
+
+    def get_patient_memo_context(self, cr, uid, context=None):
+        """
+        Returns a copy of ``context`` with an identifier memo for
+        :meth:`resolve_patient`, keeping the existing one if any.
+
+        :rtype: dict
+        """
+        context = dict(context or {})
+        context.setdefault('nh_patient_memo', {})
+        return context
+
+    @traced()
+    def get_patient_id(self, cr, uid, hospital_number=None, nhs_number=None,
+                       patient_id=None, context=None):
+        """
+        Gets the id of the patient an ADT message refers to, raising the
+        same errors as :meth:`check_hospital_number` and
+        :meth:`check_nhs_number`. The NHS number is only used when no
+        hospital number is provided.
+
+        :param patient_id: patient id already resolved by the caller,
+            returned as it is
+        :type patient_id: int
+        :returns: patient id
+        :rtype: int
+        :raises: :class:`except_orm<openerp.osv.osv.except_orm>` if
+            the patient does not exist
+        """
+
+        if patient_id:
+            return patient_id
+        if hospital_number:
+            patient_id, match = self.resolve_patient(
+                cr, uid, hospital_number=hospital_number, context=context)
+            if not patient_id:
+                raise osv.except_osv(
+                    'Patient Not Found!',
+                    'There is no patient with Hospital Number %s'
+                    % hospital_number)
+        else:
+            patient_id, match = self.resolve_patient(
+                cr, uid, nhs_number=nhs_number, context=context)
+            if not patient_id:
+                raise osv.except_osv(
+                    'Patient Not Found!',
+                    'There is no patient with NHS Number %s' % nhs_number)
+        return patient_id
+
+    def check_identifiers(self, cr, uid, hospital_number=None,
+                          nhs_number=None, context=None):
+        """
+        Checks no patient already uses the identifiers with a single
+        :meth:`resolve_patient` query.
+
+        :returns: ``True``
+        :rtype: bool
+        :raises: :class:`except_orm<openerp.osv.osv.except_orm>` if
+            a patient with either identifier exists
+        """
+
+        patient_id, match = self.resolve_patient(
+            cr, uid, hospital_number=hospital_number, nhs_number=nhs_number,
+            context=context)
+        if match == 'hospital_number':
+            raise osv.except_osv(
+                'Integrity Error!',
+                'Patient with Hospital Number %s already exists!'
+                % hospital_number)
+        if match == 'nhs_number':
+            raise osv.except_osv(
+                'Integrity Error!',
+                'Patient with NHS Number %s already exists!' % nhs_number)
+        return True
+
+    def _clear_patient_memo(self, context):
+        if isinstance(context, dict) and context.get('nh_patient_memo'):
+            context['nh_patient_memo'].clear()
+
     def update(self, cr, uid, identifier, data, selection='other_identifier',
                context=None):
         """
@@ -184,40 +476,47 @@ class nh_clinical_patient(osv.Model):
         :rtype: bool
         """
 
-        patient_id = self.search(cr, uid, [[selection, '=', identifier]],
-                                 context=context)
+        patient_id = self._search_identifier(cr, uid, selection, identifier,
+                                             context=context)
         return self.write(cr, uid, patient_id, data, context=context)
 
     def _not_admitted(self, cr, uid, ids, fields, args, context=None):
-        patient_ids_no_spell = self.get_not_admitted_patient_ids(
-            cr, uid, context)
-        result = {}
-        for i in ids:
-            result[i] = i in patient_ids_no_spell
+        result = {patient_id: True for patient_id in ids}
+        if not ids:
+            return result
+        cr.execute("""
+            select patient.id from nh_clinical_patient patient
+            where patient.id in %s and exists ({admitted})
+        """.format(admitted=ADMITTED_PATIENT_SQL), (tuple(ids),))
+        for row in cr.fetchall():
+            result[row[0]] = False
         return result
 
     def _not_admitted_search(self, cr, uid, obj, name, args, domain=None,
                              context=None):
-        """Function field method used by 'not_admitted' field."""
-        patient_ids = []
+        """
+        Function field method used by 'not_admitted' field.
+
+        The search is pushed down to PostgreSQL as an (anti-)join
+        against the started spells, so no patient ids are loaded.
+        """
+        values = set()
         for condition in args:
-            admitted_value = bool(condition[2])
             if condition[1] not in ['=', '!=']:
                 continue
-
-            all_patient_ids = self.search(cr, uid, [], context=context)
-            patient_dict = self._not_admitted(
-                cr, uid, all_patient_ids, 'not_admitted', None,
-                context=context)
-
-            if condition[1] == '=':
-                patient_ids += [k for k, v in patient_dict.items()
-                                if v == admitted_value]
-            else:
-                patient_ids += [k for k, v in patient_dict.items()
-                                if v != admitted_value]
-
-        return [('id', 'in', patient_ids)]
+            admitted_value = bool(condition[2])
+            values.add(admitted_value if condition[1] == '=' else
+                       not admitted_value)
+        if not values:
+            return [('id', 'in', [])]
+        if len(values) > 1:
+            return [('id', 'inselect', (
+                "select id from nh_clinical_patient", []))]
+        operator = 'not exists' if values.pop() else 'exists'
+        return [('id', 'inselect', ("""
+            select patient.id from nh_clinical_patient patient
+            where {operator} ({admitted})
+        """.format(operator=operator, admitted=ADMITTED_PATIENT_SQL), []))]
 
     _columns = {
         'current_location_id': fields.many2one('nh.clinical.location',
@@ -237,7 +536,8 @@ class nh_clinical_patient(osv.Model):
         'middle_names': fields.char('Middle Name(s)', size=200),
         'family_name': fields.char('Family Name', size=200, select=True),
         'full_name': fields.function(_get_name, type='text',
-                                     string="Full Name"),
+                                     string="Full Name",
+                                     store=PATIENT_NAME_STORE),
         'follower_ids': fields.many2many('res.users',
                                          'user_patient_rel',
                                          'patient_id',
@@ -247,7 +547,17 @@ class nh_clinical_patient(osv.Model):
                                         string='Not Admitted?',
                                         fnct_search=_not_admitted_search),
         'display_name':  fields.function(_get_name, type='text',
-                                         string="Display Name")
+                                         string="Display Name",
+                                         store=PATIENT_NAME_STORE),
+        'other_identifier_normalised': fields.function(
+            _get_normalised, type='char', size=100,
+            string='Normalised Hospital Number',
+            multi='normalised_identifiers',
+            store=NORMALISED_IDENTIFIERS_STORE),
+        'patient_identifier_normalised': fields.function(
+            _get_normalised, type='char', size=100,
+            string='Normalised NHS Number', multi='normalised_identifiers',
+            store=NORMALISED_IDENTIFIERS_STORE)
     }
 
     _defaults = {
@@ -263,34 +573,420 @@ class nh_clinical_patient(osv.Model):
             cr, uid, fields, data, context=context)
 
     def format_data(self, fields, data, context=None):
+        """
+        Normalises the identifiers (non alphanumeric characters removed)
+        and dates of birth of the rows to be imported, one column at a
+        time.
+
+        :param fields: field names of the columns
+        :type fields: list
+        :param data: rows (tuples), updated in place
+        :type data: list
+        """
         if not context:
             context = dict()
-        for index, field in enumerate(fields):
-            if field == 'other_identifier' or field == 'patient_identifier':
-                non_alphanumeric = re.compile(r'[\W_]+')
-                for i, d in enumerate(data):
-                    lst = list(d)
-                    lst[index] = non_alphanumeric.sub('', lst[index])
-                    data[i] = tuple(lst)
-            if field == 'dob':
-                if context.get('dateformat'):
-                    yfirst = context['dateformat'] == 'YMD'
-                    dfirst = context['dateformat'] == 'DMY'
-                else:
-                    yfirst = False
-                    dfirst = False
-                for i, d in enumerate(data):
-                    lst = list(d)
-                    lst[index] = parse(
-                        lst[index], yearfirst=yfirst, dayfirst=dfirst
-                    ).strftime(DTF)
-                    data[i] = tuple(lst)
+        indexes = [index for index, field in enumerate(fields)
+                   if field in IMPORT_FORMATTED_FIELDS]
+        if not indexes or not data:
+            return
+        rows = [list(d) for d in data]
+        for index in indexes:
+            values = self._format_column(
+                fields[index], [row[index] for row in rows], context=context)
+            for row, value in zip(rows, values):
+                row[index] = value
+        data[:] = [tuple(row) for row in rows]
+
+    def _format_column(self, field, values, errors=None, context=None):
+        """
+        Formats the values of an imported column, see
+        :meth:`format_data`. Dates of birth are parsed once per distinct
+        value.
+
+        :param errors: if given, values that can't be formatted are
+            replaced by ``None`` and their error stored in it by
+            position. Otherwise the error is raised.
+        :type errors: dict
+        :returns: formatted values
+        :rtype: list
+        """
+        if field in ('other_identifier', 'patient_identifier'):
+            return [normalise_identifier(v) for v in values]
+        if field != 'dob':
+            return values
+        context = context or {}
+        yfirst = context.get('dateformat') == 'YMD'
+        dfirst = context.get('dateformat') == 'DMY'
+        parsed = {}
+        res = []
+        for position, value in enumerate(values):
+            if value not in parsed:
+                try:
+                    parsed[value] = parse(
+                        value, yearfirst=yfirst, dayfirst=dfirst
+                    ).strftime(DTF) if value else False
+                except (ValueError, TypeError, OverflowError) as e:
+                    if errors is None:
+                        raise
+                    parsed[value] = e
+            if isinstance(parsed[value], Exception):
+                errors[position] = 'Invalid date of birth %s: %s' % (
+                    value, parsed[value])
+                res.append(None)
+            else:
+                res.append(parsed[value])
+        return res
+
+    def import_patients(self, cr, uid, csv_file, chunk_size=None,
+                        context=None):
+        """
+        Streams patients from a CSV file straight into the database,
+        for initial migrations of large patient bases.
+
+        Rows are read and inserted in chunks of ``chunk_size`` rows.
+        For every chunk the identifiers and dates are normalised column
+        by column (see :meth:`format_data`), duplicates are checked
+        against the existing patients with one query and the partners
+        and patients are inserted with one multi-row ``INSERT`` each.
+
+        Rows with errors (missing names or identifiers, invalid dates,
+        duplicated identifiers or values rejected by the database) are
+        reported and skipped without aborting the rest of their chunk.
+
+        The header row must name the columns with patient or partner
+        fields. ``title`` columns may hold the title name.
+
+        :param csv_file: file-like object or iterable of CSV lines
+        :param chunk_size: rows per chunk. Default is
+            :data:`IMPORT_CHUNK_SIZE`
+        :type chunk_size: int
+        :returns: number of patients ``created`` and ``errors`` as a
+            list of (line number, message) tuples
+        :rtype: dict
+        :raises: :class:`except_orm<openerp.osv.osv.except_orm>` if
+            a column is not a field that can be imported
+        """
+
+        self.check_access_rights(cr, uid, 'create')
+        chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+        result = {'created': 0, 'errors': []}
+        reader = csv.reader(csv_file)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return result
+        field_names = [f.strip() for f in header]
+        importer = self._get_importer(cr, uid, field_names, context=context)
+        chunk = []
+        for line, row in enumerate(reader, 2):
+            if not any(row):
+                continue
+            chunk.append((line, row))
+            if len(chunk) >= chunk_size:
+                self._import_chunk(cr, uid, importer, chunk, result,
+                                   context=context)
+                chunk = []
+        if chunk:
+            self._import_chunk(cr, uid, importer, chunk, result,
+                               context=context)
+        _logger.info("Imported %s patients, %s rows with errors",
+                     result['created'], len(result['errors']))
+        return result
+
+    def _get_importer(self, cr, uid, field_names, context=None):
+        """
+        Resolves once per :meth:`import_patients` call the columns of
+        the partner and patient tables and their default values.
+        """
+        partner_pool = self.pool['res.partner']
+
+        def simple_columns(model):
+            return dict((name, column) for name, column in
+                        model._columns.items()
+                        if not isinstance(column, fields.function) and
+                        column._type not in ('one2many', 'many2many'))
+
+        patient_columns = simple_columns(self)
+        partner_columns = simple_columns(partner_pool)
+        patient_columns.pop('partner_id', None)
+        unknown = [f for f in field_names if f not in patient_columns and
+                   f not in partner_columns]
+        if unknown:
+            raise osv.except_osv(
+                'Import Error!',
+                'Unknown patient fields: %s' % ', '.join(unknown))
+        defaults = self.default_get(
+            cr, uid, patient_columns.keys() + partner_columns.keys(),
+            context=context)
+        defaults = dict((k, v) for k, v in defaults.items()
+                        if not isinstance(v, (list, tuple, dict)))
+        return {
+            'field_names': field_names,
+            'patient_columns': patient_columns,
+            'partner_columns': partner_columns,
+            'patient_fields': sorted(
+                (set(defaults) | set(field_names)) & set(patient_columns)),
+            'partner_fields': sorted(
+                ((set(defaults) | set(field_names)) & set(partner_columns) -
+                 set(patient_columns)) | set(['name'])),
+            'defaults': defaults,
+            'titles': {}
+        }
+
+    def _import_chunk(self, cr, uid, importer, chunk, result, context=None):
+        field_names = importer['field_names']
+        errors = {}
+        rows = []
+        for position, (line, row) in enumerate(chunk):
+            if len(row) != len(field_names):
+                errors[position] = 'Expected %s columns, found %s' % (
+                    len(field_names), len(row))
+                row = [''] * len(field_names)
+            rows.append([v.decode('utf-8').strip() or False for v in row])
+        for index, field in enumerate(field_names):
+            if field in IMPORT_FORMATTED_FIELDS:
+                values = self._format_column(
+                    field, [row[index] for row in rows], errors=errors,
+                    context=context)
+                for row, value in zip(rows, values):
+                    row[index] = value
+        records = [dict(zip(field_names, row)) for row in rows]
+
+        hospital_numbers = set(r.get('other_identifier') for r in records
+                               if r.get('other_identifier'))
+        nhs_numbers = set(r.get('patient_identifier') for r in records
+                          if r.get('patient_identifier'))
+        existing = set()
+        if hospital_numbers or nhs_numbers:
+            cr.execute("""
+                select other_identifier_normalised,
+                    patient_identifier_normalised
+                from nh_clinical_patient
+                where other_identifier_normalised in %s
+                    or patient_identifier_normalised in %s
+            """, (tuple(hospital_numbers) or (None,),
+                  tuple(nhs_numbers) or (None,)))
+            for hospital_number, nhs_number in cr.fetchall():
+                existing.add(('other_identifier', hospital_number))
+                existing.add(('patient_identifier', nhs_number))
+
+        title_pool = self.pool['res.partner.title']
+        valid = []
+        for position, record in enumerate(records):
+            if position in errors:
+                continue
+            if not record.get('other_identifier') and \
+                    not record.get('patient_identifier'):
+                errors[position] = 'Either the Hospital Number or the NHS ' \
+                                   'Number is required'
+                continue
+            if not record.get('family_name') or not record.get('given_name'):
+                errors[position] = 'Patient must have a full name'
+                continue
+            duplicates = [k for k in ('other_identifier', 'patient_identifier')
+                          if record.get(k) and (k, record[k]) in existing]
+            if duplicates:
+                errors[position] = 'Patient with %s %s already exists' % (
+                    IMPORT_IDENTIFIER_NAMES[duplicates[0]],
+                    record[duplicates[0]])
+                continue
+            for k in ('other_identifier', 'patient_identifier'):
+                if record.get(k):
+                    existing.add((k, record[k]))
+            title = record.get('title')
+            if title:
+                if title not in importer['titles']:
+                    importer['titles'][title] = title_pool.get_title_by_name(
+                        cr, uid, title, context=context)
+                record['title'] = importer['titles'][title]
+            if not record.get('name'):
+                record['name'] = self._get_fullname(record)
+            valid.append((position, record))
+
+        if valid:
+            cr.execute("savepoint nh_patient_import")
+            try:
+                self._insert_patients(cr, uid, importer,
+                                      [r for p, r in valid])
+                result['created'] += len(valid)
+            except psycopg2.Error:
+                cr.execute("rollback to savepoint nh_patient_import")
+                for position, record in valid:
+                    cr.execute("savepoint nh_patient_import_row")
+                    try:
+                        self._insert_patients(cr, uid, importer, [record])
+                        result['created'] += 1
+                    except psycopg2.Error as e:
+                        cr.execute(
+                            "rollback to savepoint nh_patient_import_row")
+                        errors[position] = str(e).strip()
+                    cr.execute("release savepoint nh_patient_import_row")
+            cr.execute("release savepoint nh_patient_import")
+        result['errors'].extend(
+            (chunk[position][0], errors[position]) for position in
+            sorted(errors))
+        return True
+
+    def _insert_patients(self, cr, uid, importer, records):
+        """
+        Inserts the partners and patients of :meth:`import_patients`
+        records with one multi-row ``INSERT`` per table.
+
+        :returns: patient ids
+        :rtype: list
+        """
+        now = dt.utcnow().strftime(DTF)
+        defaults = importer['defaults']
+
+        def insert(table, columns, field_names, rows):
+            # ids are taken from the sequence first and assigned in the
+            # order of the rows, RETURNING gives no order guarantee
+            cr.execute("select nextval(%s) from generate_series(1, %s)",
+                       ('%s_id_seq' % table, len(rows)))
+            ids = sorted(r[0] for r in cr.fetchall())
+            values = []
+            for row_id, row in zip(ids, rows):
+                row_values = []
+                for field in field_names:
+                    value = row.get(field)
+                    if value is None or value is False:
+                        value = defaults.get(field, False)
+                    if columns[field]._type == 'boolean':
+                        value = bool(value) and value not in (
+                            'False', 'false', '0')
+                    elif value is False:
+                        value = None
+                    row_values.append(value)
+                values.append(cr.mogrify(
+                    '(' + ', '.join(['%s'] * (len(field_names) + 5)) + ')',
+                    [row_id] + row_values + [uid, now, uid, now]))
+            cr.execute("""
+                insert into {table}
+                    (id, {columns}, create_uid, create_date, write_uid,
+                     write_date)
+                values {values}
+            """.format(table=table, columns=', '.join(
+                '"%s"' % f for f in field_names), values=', '.join(values)))
+            return ids
+
+        partner_ids = insert('res_partner', importer['partner_columns'],
+                             importer['partner_fields'], records)
+        cr.execute("""
+            update res_partner
+            set display_name = name, commercial_partner_id = id
+            where id in %s
+        """, (tuple(partner_ids),))
+        patient_rows = []
+        for record, partner_id in zip(records, partner_ids):
+            full_name = self._get_fullname(record)
+            patient_rows.append(dict(record, partner_id=partner_id,
+                                     full_name=full_name,
+                                     display_name=full_name))
+        name_fields = ['partner_id', 'full_name', 'display_name']
+        patient_columns = dict(importer['patient_columns'], **dict(
+            (f, self._columns[f]) for f in name_fields))
+        patient_ids = insert('nh_clinical_patient', patient_columns,
+                             importer['patient_fields'] + name_fields,
+                             patient_rows)
+        self._normalise_identifiers(cr, patient_ids)
+        return patient_ids
+
+    def _normalise_identifiers(self, cr, ids=None):
+        """
+        Sets the normalised identifiers of the patients with a single
+        ``UPDATE``, for rows inserted without the ORM. All the patients
+        if ``ids`` is ``None``.
+        """
+        where, params = '', {'pattern': NON_ALPHANUMERIC.pattern}
+        if ids is not None:
+            if not ids:
+                return True
+            where, params['ids'] = 'and patient.id in %(ids)s', tuple(ids)
+        cr.execute(NORMALISE_IDENTIFIERS_SQL.format(where=where), params)
+        return True
+
+    def init(self, cr):
+        super(nh_clinical_patient, self).init(cr)
+        self._init_identifier_indexes(cr)
+        cr.execute("select 1 from pg_indexes where indexname = %s",
+                   (FULL_NAME_INDEX,))
+        if cr.fetchone():
+            return
+        cr.execute("savepoint nh_clinical_patient_full_name_index")
+        try:
+            cr.execute("create extension if not exists pg_trgm")
+            cr.execute("""
+                create index {index} on nh_clinical_patient
+                using gin (full_name gin_trgm_ops)
+            """.format(index=FULL_NAME_INDEX))
+        except psycopg2.Error:
+            cr.execute(
+                "rollback to savepoint nh_clinical_patient_full_name_index")
+            _logger.warning(
+                "The pg_trgm extension is not available, patient name "
+                "searches will scan the whole patients table.")
+        cr.execute("release savepoint nh_clinical_patient_full_name_index")
+
+    def _init_identifier_indexes(self, cr):
+        """
+        Creates the partial unique indexes on the normalised identifiers
+        of active patients, filling the normalised columns first as they
+        are new on upgrade. If active patients already share an
+        identifier a plain index is created instead, until the
+        duplicates are merged.
+        """
+        missing = []
+        for field in sorted(NORMALISED_IDENTIFIERS):
+            cr.execute("select 1 from pg_indexes where indexname = %s",
+                       (identifier_index(field),))
+            if not cr.fetchone():
+                missing.append(field)
+        if not missing:
+            return
+        self._normalise_identifiers(cr)
+        for field in missing:
+            index = identifier_index(field)
+            column = NORMALISED_IDENTIFIERS[field]
+            cr.execute("savepoint nh_patient_identifier_index")
+            try:
+                cr.execute("""
+                    create unique index {index} on nh_clinical_patient
+                    ({column}) where {column} is not null
+                """.format(index=index, column=column))
+            except psycopg2.IntegrityError:
+                cr.execute("rollback to savepoint nh_patient_identifier_index")
+                _logger.warning(
+                    "Active patients share the same %s, %s is not unique "
+                    "until they are merged.",
+                    IMPORT_IDENTIFIER_NAMES[field], column)
+                cr.execute("""
+                    create index {index} on nh_clinical_patient
+                    ({column}) where {column} is not null
+                """.format(index=index, column=column))
+            cr.execute("release savepoint nh_patient_identifier_index")
+
+    def _raise_duplicate_identifier(self, error, vals):
+        """
+        Turns a violation of the unique indexes on the normalised
+        identifiers into the error :meth:`check_identifiers` raises.
+        Other integrity errors are raised as they are.
+        """
+        message = error.pgerror or str(error)
+        for field in NORMALISED_IDENTIFIERS:
+            if identifier_index(field) in message:
+                raise osv.except_osv(
+                    'Integrity Error!',
+                    'Patient with %s already exists!' % ' '.join(filter(
+                        None, [IMPORT_IDENTIFIER_NAMES[field],
+                               vals.get(field)])))
+        raise error
 
     def create(self, cr, uid, vals, context=None):
         """
         Extends Odoo's :meth:`create()<openerp.models.Model.create>`
         to write ``name``, ``other_identifier`` and
-        ``patient_identifier`` upon creation.
+        ``patient_identifier`` upon creation. Duplicate identifiers are
+        rejected by the unique indexes on the normalised identifiers.
 
         :returns: ``True`` if created
         :rtype: bool
@@ -303,15 +999,16 @@ class nh_clinical_patient(osv.Model):
                 'to register/update a patient.')
         if not vals.get('name'):
             vals.update({'name': self._get_fullname(vals)})
-        if vals.get('other_identifier'):
-            self.check_hospital_number(cr, uid, vals.get('other_identifier'),
-                                       exception='True', context=context)
-        if vals.get('patient_identifier'):
-            self.check_nhs_number(cr, uid, vals.get('patient_identifier'),
-                                  exception='True', context=context)
-        return super(nh_clinical_patient, self).create(
-            cr, uid, vals,
-            context=dict(context or {}, mail_create_nosubscribe=True))
+        cr.execute("savepoint nh_clinical_patient_create")
+        try:
+            res = super(nh_clinical_patient, self).create(
+                cr, uid, vals,
+                context=dict(context or {}, mail_create_nosubscribe=True))
+        except psycopg2.IntegrityError as e:
+            cr.execute("rollback to savepoint nh_clinical_patient_create")
+            self._raise_duplicate_identifier(e, vals)
+        cr.execute("release savepoint nh_clinical_patient_create")
+        return res
 
     def write(self, cr, uid, ids, vals, context=None):
         """
@@ -327,8 +1024,43 @@ class nh_clinical_patient(osv.Model):
                 vals['title'] = title_pool.get_title_by_name(cr, uid,
                                                              vals['title'],
                                                              context=context)
-        return super(nh_clinical_patient, self).write(cr, uid, ids, vals,
-                                                      context=context)
+        if not any(k in vals for k in PATIENT_MEMO_FIELDS):
+            res = super(nh_clinical_patient, self).write(cr, uid, ids, vals,
+                                                         context=context)
+        else:
+            cr.execute("savepoint nh_clinical_patient_write")
+            try:
+                res = super(nh_clinical_patient, self).write(
+                    cr, uid, ids, vals, context=context)
+            except psycopg2.IntegrityError as e:
+                cr.execute("rollback to savepoint nh_clinical_patient_write")
+                self._raise_duplicate_identifier(e, vals)
+            cr.execute("release savepoint nh_clinical_patient_write")
+        if any(k in vals for k in PATIENT_MEMO_FIELDS):
+            self._clear_patient_memo(context)
+        if any(k in vals for k in WARD_SNAPSHOT_FIELDS):
+            self._bump_ward_versions(cr, uid, ids, context=context)
+        return res
+
+    def _bump_ward_versions(self, cr, uid, ids, context=None):
+        """
+        Bumps the version of the wards the patients are in, as their
+        details are shown in the ward bed boards (see
+        :meth:`get_ward_snapshot<base.nh_clinical_location.get_ward_snapshot>`).
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return True
+        cr.execute("""
+            select distinct current_location_id from nh_clinical_patient
+            where id in %s and current_location_id is not null
+        """, (tuple(ids),))
+        location_ids = [row[0] for row in cr.fetchall()]
+        if location_ids:
+            self.pool['nh.clinical.location'].bump_ward_versions(
+                cr, uid, location_ids, context=context)
+        return True
 
     def unlink(self, cr, uid, ids, context=None):
         """
@@ -342,6 +1074,7 @@ class nh_clinical_patient(osv.Model):
         :rtype: bool
         """
 
+        self._clear_patient_memo(context)
         return super(nh_clinical_patient, self).write(cr, uid, ids,
                                                       {'active': False},
                                                       context=context)
@@ -385,26 +1118,17 @@ class nh_clinical_patient(osv.Model):
                 'Either the Hospital Number or the NHS Number is required to '
                 'register/update a patient.')
         if create:
-            if data.get('other_identifier'):
-                self.check_hospital_number(cr, uid, data['other_identifier'],
-                                           exception='True', context=context)
-            if data.get('patient_identifier'):
-                self.check_nhs_number(cr, uid, data['patient_identifier'],
-                                      exception='True', context=context)
+            self.check_identifiers(
+                cr, uid, hospital_number=data.get('other_identifier'),
+                nhs_number=data.get('patient_identifier'), context=context)
         else:
-            if data.get('other_identifier') and data.get('patient_identifier'):
-                domain = [
-                    '|',
-                    ['other_identifier', '=', data['other_identifier']],
-                    ['patient_identifier', '=', data['patient_identifier']]
-                ]
-            elif data.get('other_identifier'):
-                domain = [['other_identifier', '=', data['other_identifier']]]
-            else:
-                domain = [
-                    ['patient_identifier', '=', data['patient_identifier']]
-                ]
-            patient_id = self.search(cr, uid, domain, context=context)
+            patient_id = sorted(set(
+                self._search_identifier(
+                    cr, uid, 'other_identifier',
+                    data.get('other_identifier'), context=context) +
+                self._search_identifier(
+                    cr, uid, 'patient_identifier',
+                    data.get('patient_identifier'), context=context)))
             if not patient_id:
                 if exception:
                     raise osv.except_osv(
@@ -429,11 +1153,162 @@ class nh_clinical_patient(osv.Model):
 
     def get_not_admitted_patient_ids(self, cr, uid, context=None):
         """Returns patients ids for patients with no open spell."""
+        return self.search(cr, uid, [('not_admitted', '=', True)],
+                           context=context)
+
+    def _get_merge_references(self, cr):
+        """
+        Discovers from the catalogue the columns with a foreign key to
+        the patients table, together with the other columns of every
+        primary key or unique constraint they are part of. Computed once
+        per registry.
+
+        :returns: list of (table, column, unique column lists) tuples
+        :rtype: list
+        """
+        references = getattr(self, '_merge_references', None)
+        if references is not None:
+            return references
+        cr.execute("""
+            select fk_table.oid, fk_table.relname, fk_column.attname,
+                fk_column.attnum
+            from pg_constraint fk
+            inner join pg_class fk_table on fk_table.oid = fk.conrelid
+            inner join pg_attribute fk_column
+                on fk_column.attrelid = fk.conrelid
+                and fk_column.attnum = fk.conkey[1]
+            where fk.contype = 'f' and array_length(fk.conkey, 1) = 1
+                and fk.confrelid = %s::regclass
+            order by fk_table.relname, fk_column.attname
+        """, (self._table,))
+        references = []
+        for table_oid, table, column, attnum in cr.fetchall():
+            cr.execute("""
+                select array_agg(other.attname::text)
+                from pg_constraint uniq
+                left join pg_attribute other
+                    on other.attrelid = uniq.conrelid
+                    and other.attnum = any(uniq.conkey)
+                    and other.attnum != %s
+                where uniq.conrelid = %s and uniq.contype in ('p', 'u')
+                    and %s = any(uniq.conkey)
+                group by uniq.oid
+            """, (attnum, table_oid, attnum))
+            unique = [[c for c in row[0] if c] for row in cr.fetchall()]
+            references.append((table, column, unique))
+        self._merge_references = references
+        return references
+
+    def merge(self, cr, uid, from_id, into_id, exclude_tables=None,
+              context=None):
+        """
+        Merges the patient ``from_id`` into the patient ``into_id``.
+
+        Every column with a foreign key to the patients table is
+        re-pointed with a single ``UPDATE`` per table, bypassing the ORM.
+        Rows that would duplicate a row of the destination patient in a
+        unique constraint (e.g. followers) are dropped and logged. The
+        data derived from the moved rows (open spells, ward bed boards
+        and follower access to the activities) is refreshed in bulk
+        afterwards.
+
+        Then every field the source patient has and the destination
+        patient lacks is copied into the destination patient and the
+        source patient is deactivated.
+
+        :param from_id: id of the source patient
+        :type from_id: int
+        :param into_id: id of the destination patient
+        :type into_id: int
+        :param exclude_tables: tables not to re-point (e.g. the merge
+            records themselves)
+        :type exclude_tables: list
+        :returns: ``rows_moved`` (number of rows re-pointed per
+            ``table.column``), ``rows_dropped`` (number of duplicate rows
+            dropped per ``table.column``), ``merge_into_update`` and
+            ``merge_from_deactivate``
+        :rtype: dict
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if both
+            patients have a started spell
+        """
+        exclude_tables = set(MERGE_DERIVED_TABLES + (exclude_tables or []))
+        activity_pool = self.pool['nh.activity']
         spell_pool = self.pool['nh.clinical.spell']
-        spell_ids = spell_pool.search(
-            cr, uid, [('state', '=', 'started')])
-        spells = spell_pool.read(cr, uid, spell_ids, ['patient_id'])
-        spell_patient_ids = set(spell['patient_id'][0] for spell in spells)
-        all_patient_ids = set(self.search(cr, uid, []))
-        all_patient_ids.difference_update(spell_patient_ids)
-        return list(all_patient_ids)
+        cr.execute("select id from nh_activity where patient_id = %s",
+                   (from_id,))
+        activity_ids = [row[0] for row in cr.fetchall()]
+        rows_moved, rows_dropped = {}, {}
+        params = {'from_id': from_id, 'into_id': into_id}
+        cr.execute("savepoint nh_clinical_patient_merge")
+        try:
+            for table, column, unique in self._get_merge_references(cr):
+                if table in exclude_tables:
+                    continue
+                duplicates = ''.join("""
+                    and not exists (
+                        select 1 from {table} dest
+                        where dest.{column} = %(into_id)s {same})
+                """.format(table=table, column=column, same=''.join(
+                    ' and dest.{0} = src.{0}'.format(c) for c in columns))
+                    for columns in unique)
+                cr.execute("""
+                    update {table} src set {column} = %(into_id)s
+                    where src.{column} = %(from_id)s {duplicates}
+                """.format(table=table, column=column,
+                           duplicates=duplicates), params)
+                if cr.rowcount:
+                    rows_moved['%s.%s' % (table, column)] = cr.rowcount
+                if unique:
+                    cr.execute("delete from {table} where {column} = %s"
+                               .format(table=table, column=column),
+                               (from_id,))
+                    if cr.rowcount:
+                        rows_dropped['%s.%s' % (table, column)] = \
+                            cr.rowcount
+        except psycopg2.IntegrityError as error:
+            cr.execute("rollback to savepoint nh_clinical_patient_merge")
+            if getattr(error.diag, 'constraint_name', None) != \
+                    STARTED_SPELL_PATIENT_INDEX:
+                raise
+            raise osv.except_osv(
+                'Patient Merge Error!',
+                'Both patients have a started spell!')
+        cr.execute("release savepoint nh_clinical_patient_merge")
+        _logger.info("Patient %s merged into patient %s, rows moved: %s",
+                     from_id, into_id, rows_moved)
+        if rows_dropped:
+            _logger.warning(
+                "Patient %s merged into patient %s, rows dropped as "
+                "duplicates of the destination patient's: %s",
+                from_id, into_id, rows_dropped)
+
+        self.invalidate_cache(cr, uid, context=context)
+        spell_pool.sync_open_spells(cr, uid, activity_ids=activity_ids,
+                                    context=context)
+        activity_pool._bump_ward_versions(cr, uid, activity_ids,
+                                          context=context)
+        activity_pool.add_follower_users(cr, uid, [into_id],
+                                         context=context)
+
+        merge_fields = [
+            name for name, column in self._columns.items()
+            if column._classic_write and not isinstance(column,
+                                                        fields.function)
+            and name not in ('partner_id', 'active')]
+        records = dict((r['id'], r) for r in self.read(
+            cr, uid, [from_id, into_id], merge_fields, context=context))
+        vals_into = {}
+        for key, value in records[from_id].iteritems():
+            if key == 'id' or not value or records[into_id][key]:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = value[0]
+            vals_into[key] = value
+        res = {'rows_moved': rows_moved, 'rows_dropped': rows_dropped}
+        # Deactivate first so the source identifiers leave the unique
+        # indexes before they are copied
+        res['merge_from_deactivate'] = self.write(
+            cr, uid, from_id, {'active': False}, context=context)
+        res['merge_into_update'] = self.write(cr, uid, into_id, vals_into,
+                                              context=context)
+        return res
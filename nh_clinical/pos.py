@@ -36,6 +36,45 @@ class nh_clinical_pos(orm.Model):
          'The code for a location must be unique!')
     ]
 
+    def create(self, cr, uid, vals, context=None):
+        """
+        Extends Odoo's :meth:`create()<openerp.models.Model.create>` to
+        invalidate the location resolution cache, as the POS of the
+        locations below the POS location changes.
+        """
+        res = super(nh_clinical_pos, self).create(cr, uid, vals,
+                                                  context=context)
+        self.pool['nh.clinical.location'].invalidate_location_cache(
+            cr, uid, context=context)
+        return res
+
+    def write(self, cr, uid, ids, vals, context=None):
+        """
+        Extends Odoo's :meth:`write()<openerp.models.Model.write>` to
+        invalidate the location resolution and user context caches when
+        the POS location changes.
+        """
+        res = super(nh_clinical_pos, self).write(cr, uid, ids, vals,
+                                                 context=context)
+        if 'location_id' in vals:
+            self.pool['nh.clinical.location'].invalidate_location_cache(
+                cr, uid, context=context)
+            self.pool['res.users'].invalidate_user_context_cache(
+                cr, uid, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        """
+        Extends Odoo's :meth:`unlink()<openerp.models.Model.unlink>` to
+        invalidate the user context cache, as the POS is removed from its
+        users.
+        """
+        res = super(nh_clinical_pos, self).unlink(cr, uid, ids,
+                                                  context=context)
+        self.pool['res.users'].invalidate_user_context_cache(
+            cr, uid, context=context)
+        return res
+
 
 class res_company(orm.Model):
     """
@@ -6,12 +6,31 @@ Defines the Spell class.
 import logging
 from datetime import datetime as dt
 
-from openerp import api
+import psycopg2
+from openerp import api, models
 from openerp.osv import orm, fields, osv
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT as DTF
 
+from .location import MAX_LOCATION_DEPTH
+from .tracing import traced
+
 _logger = logging.getLogger(__name__)
 
+#: How long staff keep access to the patients they transferred out
+TRANSFERRED_ACCESS_PERIOD = '1 day'
+
+#: Activity columns returned by :meth:`nh_clinical_spell.get_timeline`
+TIMELINE_ACTIVITY_FIELDS = [
+    'id', 'summary', 'data_model', 'state', 'sequence', 'parent_id',
+    'creator_id', 'user_id', 'terminate_uid', 'patient_id', 'location_id',
+    'create_date', 'date_scheduled', 'date_started', 'date_terminated',
+    'date_deadline'
+]
+
+#: Default number of activities per chunk of
+#: :meth:`nh_clinical_spell.iter_timeline`
+TIMELINE_CHUNK_SIZE = 500
+
 
 class nh_clinical_spell(orm.Model):
     """
@@ -29,68 +48,17 @@ class nh_clinical_spell(orm.Model):
     def _get_transferred_user_ids(self, cr, uid, ids, field, arg,
                                   context=None):
         res = {spell_id: False for spell_id in ids}
-        sql = """
-            with
-                recursive route(level, path, parent_id, id) as (
-                        select 0, id::text, parent_id, id
-                        from nh_clinical_location
-                        where parent_id is null
-                    union
-                        select level + 1, path||','||location.id,
-                            location.parent_id, location.id
-                        from nh_clinical_location location
-                        join route on location.parent_id = route.id
-                ),
-                parent_location as (
-                    select
-                        id as location_id,
-                        ('{'||path||'}')::int[] as ids
-                    from route
-                    order by path
-                ),
-                spell_transferred_locations as(
-                    select
-                        spell.id as spell_id,
-                        spell_activity.id as activity_id,
-                        array_agg(move.from_location_id) as location_ids
-                    from nh_clinical_patient_move move
-                    inner join nh_activity move_activity
-                        on move.activity_id = move_activity.id
-                        and move.from_location_id is not null
-                        and move_activity.state = 'completed'
-                    inner join nh_activity spell_activity
-                        on move_activity.parent_id = spell_activity.id
-                    inner join nh_activity transfer_activity
-                        on move_activity.creator_id = transfer_activity.id
-                        and transfer_activity.data_model =
-                        'nh.clinical.patient.transfer'
-                    inner join nh_clinical_spell spell
-                        on spell.activity_id = spell_activity.id
-                    where now() at time zone 'UTC' -
-                    move_activity.date_terminated < interval '1d'
-                        and spell_activity.state = 'started'
-                    group by spell_id, spell_activity.id
-                ),
-                user_locations as (
-                    select
-                        user_id,
-                        array_agg(location_id) as location_ids
-                    from user_location_rel
-                    group by user_id
-                )
-            select
-                stl.activity_id,
-                stl.spell_id,
-                array_agg(ul.user_id) as user_ids
-            from spell_transferred_locations stl
-            inner join parent_location
-                on stl.location_ids && parent_location.ids
-            left join user_locations ul
-                on ul.location_ids && parent_location.ids
-            where stl.spell_id in (%s)
-            group by activity_id, stl.spell_id
-        """ % ",".join(map(str, ids))
-        cr.execute(sql)
+        if not ids:
+            return res
+        cr.execute("""
+            select access.spell_id, array_agg(access.user_id) as user_ids
+            from nh_clinical_spell_transferred_access access
+            inner join nh_clinical_spell_open open_spell
+                on open_spell.spell_id = access.spell_id
+            where access.spell_id in %s
+                and access.expires_at > now() at time zone 'UTC'
+            group by access.spell_id
+        """, (tuple(ids),))
         rows = cr.dictfetchall()
         [res.update(
             {row['spell_id']: list(set(row['user_ids']))}) for row in rows]
@@ -100,13 +68,17 @@ class nh_clinical_spell(orm.Model):
                                      domain=None, context=None):
         arg1, op, arg2 = args[0]
         arg2 = arg2 if isinstance(arg2, (list, tuple)) else [arg2]
-        all_ids = self.search(cr, uid, [])
-        spell_user_map = self._get_transferred_user_ids(
-            cr, uid, all_ids, 'transferred_user_ids', None)
-        spell_ids = [k for k, v in spell_user_map.items()
-                     if set(v or []) & set(arg2 or [])]
-
-        return [('id', 'in', spell_ids)]
+        user_ids = [user_id for user_id in arg2 or [] if user_id]
+        if not user_ids:
+            return [('id', 'in', [])]
+        return [('id', 'inselect', ("""
+            select access.spell_id
+            from nh_clinical_spell_transferred_access access
+            inner join nh_clinical_spell_open open_spell
+                on open_spell.spell_id = access.spell_id
+            where access.user_id in %s
+                and access.expires_at > now() at time zone 'UTC'
+        """, (tuple(user_ids),)))]
 
     _columns = {
         'patient_id': fields.many2one('nh.clinical.patient', 'Patient',
@@ -143,13 +115,12 @@ class nh_clinical_spell(orm.Model):
         :returns: :mod:`spell<spell.nh_clinical_spell>` id
         :rtype: int
         """
-        current_spell_id = self.search(
-            cr, uid, [['patient_id', '=', vals['patient_id']],
-                      ['state', '=', 'started']], context=context)
+        current_spell_id = self.get_by_patient_id(
+            cr, uid, vals['patient_id'], context=context)
         if current_spell_id:
-            res = current_spell_id[0]
+            res = current_spell_id
             _logger.warn("Started spell already exists! "
-                         "Current spell ID=%s returned.", current_spell_id[0])
+                         "Current spell ID=%s returned.", current_spell_id)
         else:
             res = super(nh_clinical_spell, self).create(cr, uid, vals, context)
         return res
@@ -164,9 +135,13 @@ class nh_clinical_spell(orm.Model):
         """
         if 'location_id' in vals:
             vals['move_date'] = dt.now().strftime(DTF)
-        return super(nh_clinical_spell, self).write(
+        res = super(nh_clinical_spell, self).write(
             cr, uid, ids, vals, context=context)
+        if 'patient_id' in vals:
+            self.sync_open_spells(cr, uid, spell_ids=ids, context=context)
+        return res
 
+    @traced()
     def get_activity_user_ids(self, cr, uid, activity_id, context=None):
         """
         Returns a list of user ids that would have visibility or
@@ -241,9 +216,8 @@ class nh_clinical_spell(orm.Model):
         :returns: :mod:`spell<spell.nh_clinical_spell>` id
         :rtype: int
         """
-        domain = [['patient_id', '=', patient_id],
-                  ['activity_id.state', '=', 'started']]
-        spell_id = self.search(cr, uid, domain, context=context)
+        spell_id = self.get_open_spell(cr, uid, patient_id,
+                                       context=context)[0]
         if exception:
             if spell_id and eval(exception):
                 raise osv.except_osv(
@@ -255,7 +229,245 @@ class nh_clinical_spell(orm.Model):
                     'Spell Not Found!',
                     'There is no started spell for patient with id %s'
                     % patient_id)
-        return spell_id[0] if spell_id else False
+        return spell_id
+
+    def get_open_spell(self, cr, uid, patient_id, context=None):
+        """
+        Gets the started spell of a patient with a primary key lookup on
+        the ``nh_clinical_spell_open`` mapping, which is kept up to date
+        whenever spells start, complete or are cancelled (see
+        :meth:`sync_open_spells`).
+
+        :param patient_id: :mod:`patient<base.nh_clinical_patient>` id
+        :type patient_id: int
+        :returns: :mod:`spell<spell.nh_clinical_spell>` id and spell
+            :mod:`activity<activity.nh_activity>` id. ``(False, False)``
+            if the patient has no started spell.
+        :rtype: tuple
+        """
+        if not patient_id:
+            return False, False
+        cr.execute("""
+            select spell_id, spell_activity_id from nh_clinical_spell_open
+            where patient_id = %s
+        """, (patient_id,))
+        row = cr.fetchone()
+        return (row[0], row[1]) if row else (False, False)
+
+    def sync_open_spells(self, cr, uid, activity_ids=None, spell_ids=None,
+                         context=None):
+        """
+        Updates the patient to started spell mapping for the given spell
+        activities or spells after their state or patient changed. A
+        patient can only have one started spell.
+
+        :param activity_ids: spell :mod:`activity<activity.nh_activity>`
+            ids
+        :type activity_ids: list
+        :param spell_ids: :mod:`spell<spell.nh_clinical_spell>` ids
+        :type spell_ids: list
+        :returns: ``True``
+        :rtype: bool
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if a
+            patient would have more than one started spell
+        """
+        if activity_ids:
+            column, ids = 'spell_activity_id', activity_ids
+            condition = 'activity.id in %s'
+        elif spell_ids:
+            column, ids = 'spell_id', spell_ids
+            condition = 'spell.id in %s'
+        else:
+            return True
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        cr.execute("delete from nh_clinical_spell_open where {0} in %s"
+                   .format(column), (tuple(ids),))
+        cr.execute("savepoint nh_clinical_spell_open")
+        try:
+            cr.execute("""
+                insert into nh_clinical_spell_open
+                    (patient_id, spell_id, spell_activity_id)
+                select spell.patient_id, spell.id, activity.id
+                from nh_clinical_spell spell
+                inner join nh_activity activity
+                    on activity.id = spell.activity_id
+                where activity.state = 'started' and {condition}
+            """.format(condition=condition), (tuple(ids),))
+        except psycopg2.IntegrityError:
+            cr.execute("rollback to savepoint nh_clinical_spell_open")
+            raise osv.except_osv(
+                'Integrity Error!',
+                'The patient already has a started spell!')
+        cr.execute("release savepoint nh_clinical_spell_open")
+        return True
+
+    def refresh_transferred_access(self, cr, uid, spell_ids=None,
+                                   user_ids=None, location_ids=None,
+                                   context=None):
+        """
+        Recomputes the recently transferred access of the given spells,
+        users and/or transfer origins (all of them if none are given).
+
+        Users allocated to the location a patient was transferred out of
+        (or to any of its ancestors or descendants) keep access to the
+        patient's spell for :data:`TRANSFERRED_ACCESS_PERIOD` after the
+        transfer move was completed. The access is kept in
+        ``nh_clinical_spell_transferred_access`` so reading and searching
+        ``transferred_user_ids`` are indexed lookups. Expired rows are
+        removed by :meth:`prune_transferred_access`.
+
+        :param spell_ids: :mod:`spell<spell.nh_clinical_spell>` ids
+        :type spell_ids: list
+        :param user_ids: :class:`user<base.res_users>` ids
+        :type user_ids: list
+        :param location_ids: only refresh the spells transferred out of
+            these :mod:`locations<location.nh_clinical_location>`
+        :type location_ids: list
+        :returns: ``True``
+        :rtype: bool
+        """
+        if isinstance(spell_ids, (int, long)):
+            spell_ids = [spell_ids]
+        if isinstance(user_ids, (int, long)):
+            user_ids = [user_ids]
+        if location_ids is not None:
+            transferred_ids = self._get_transferred_spell_ids(
+                cr, location_ids)
+            spell_ids = transferred_ids if spell_ids is None else \
+                list(set(spell_ids) & set(transferred_ids))
+        if spell_ids is not None and not spell_ids or \
+                user_ids is not None and not user_ids:
+            return True
+        where = []
+        spell_filter, user_filter = '', ''
+        params = {
+            'period': TRANSFERRED_ACCESS_PERIOD,
+            'depth': MAX_LOCATION_DEPTH,
+            'spell_ids': tuple(spell_ids or []),
+            'user_ids': tuple(user_ids or [])
+        }
+        if spell_ids:
+            where.append('spell_id in %(spell_ids)s')
+            spell_filter = 'and spell.id in %(spell_ids)s'
+        if user_ids:
+            where.append('user_id in %(user_ids)s')
+            user_filter = 'where rel.user_id in %(user_ids)s'
+        where_clause = 'where ' + ' and '.join(where) if where else ''
+        cr.execute("""
+            delete from nh_clinical_spell_transferred_access {where}
+        """.format(where=where_clause), params)
+        cr.execute("""
+            with
+                recursive transfer_move as (
+                    select
+                        spell.id as spell_id,
+                        move.from_location_id as location_id,
+                        move_activity.date_terminated +
+                            interval %(period)s as expires_at
+                    from nh_clinical_patient_move move
+                    inner join nh_activity move_activity
+                        on move.activity_id = move_activity.id
+                    inner join nh_activity transfer_activity
+                        on move_activity.creator_id = transfer_activity.id
+                        and transfer_activity.data_model =
+                        'nh.clinical.patient.transfer'
+                    inner join nh_clinical_spell spell
+                        on spell.activity_id = move_activity.parent_id
+                    where move.from_location_id is not null
+                        and move_activity.state = 'completed'
+                        and move_activity.date_terminated >
+                        now() at time zone 'UTC' - interval %(period)s
+                        {spell_filter}
+                ),
+                subtree(spell_id, location_id, expires_at, depth) as (
+                        select spell_id, location_id, expires_at, 0
+                        from transfer_move
+                    union
+                        select subtree.spell_id, child.id,
+                            subtree.expires_at, subtree.depth + 1
+                        from nh_clinical_location child
+                        inner join subtree
+                            on child.parent_id = subtree.location_id
+                        where subtree.depth < %(depth)s
+                ),
+                ancestor(spell_id, location_id, expires_at, depth) as (
+                        select spell_id, location_id, expires_at, 0
+                        from transfer_move
+                    union
+                        select ancestor.spell_id, location.parent_id,
+                            ancestor.expires_at, ancestor.depth + 1
+                        from nh_clinical_location location
+                        inner join ancestor
+                            on location.id = ancestor.location_id
+                        where location.parent_id is not null
+                            and ancestor.depth < %(depth)s
+                ),
+                access_location as (
+                        select spell_id, location_id, expires_at
+                        from subtree
+                    union
+                        select spell_id, location_id, expires_at
+                        from ancestor
+                )
+            insert into nh_clinical_spell_transferred_access
+                (spell_id, user_id, expires_at)
+            select access_location.spell_id, rel.user_id,
+                max(access_location.expires_at)
+            from access_location
+            inner join user_location_rel rel
+                on rel.location_id = access_location.location_id
+            {user_filter}
+            group by access_location.spell_id, rel.user_id
+        """.format(spell_filter=spell_filter,
+                   user_filter=user_filter), params)
+        return True
+
+    def _get_transferred_spell_ids(self, cr, location_ids):
+        """
+        Gets the spells with a transfer move out of the locations
+        completed within :data:`TRANSFERRED_ACCESS_PERIOD`.
+
+        :returns: :mod:`spell<spell.nh_clinical_spell>` ids
+        :rtype: list
+        """
+        if isinstance(location_ids, (int, long)):
+            location_ids = [location_ids]
+        if not location_ids:
+            return []
+        cr.execute("""
+            select distinct spell.id
+            from nh_clinical_patient_move move
+            inner join nh_activity move_activity
+                on move.activity_id = move_activity.id
+            inner join nh_activity transfer_activity
+                on move_activity.creator_id = transfer_activity.id
+                and transfer_activity.data_model =
+                'nh.clinical.patient.transfer'
+            inner join nh_clinical_spell spell
+                on spell.activity_id = move_activity.parent_id
+            where move.from_location_id in %s
+                and move_activity.state = 'completed'
+                and move_activity.date_terminated >
+                now() at time zone 'UTC' - interval %s
+        """, (tuple(set(location_ids)), TRANSFERRED_ACCESS_PERIOD))
+        return [row[0] for row in cr.fetchall()]
+
+    def prune_transferred_access(self, cr, uid, context=None):
+        """
+        Removes the expired recently transferred access. Called by the
+        ``ir_cron_prune_transferred_access`` scheduled action.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        cr.execute("""
+            delete from nh_clinical_spell_transferred_access
+            where expires_at <= now() at time zone 'UTC'
+        """)
+        _logger.debug("%s expired transferred access rows removed.",
+                      cr.rowcount)
+        return True
 
     @api.model
     def get_spell_activity_by_patient_id(self, patient_id):
@@ -267,17 +479,204 @@ class nh_clinical_spell(orm.Model):
         :return: spell if it exists, otherwise None
         :rtype: 'nh.clinical.spell' record
         """
-        domain = [
-            ('data_model', '=', 'nh.clinical.spell'),
-            ('state', 'not in', ['completed', 'cancelled']),
-            ('patient_id', '=', patient_id)
-        ]
         activity_model = self.env['nh.activity']
-        spell_activity = activity_model.search(domain)
+        patient_id = patient_id.id \
+            if isinstance(patient_id, models.BaseModel) else patient_id
+        spell_activity_id = self.get_open_spell(patient_id)[1]
+        if spell_activity_id:
+            spell_activity = activity_model.browse(spell_activity_id)
+        else:
+            # Spells that are not started yet are not in the mapping
+            domain = [
+                ('data_model', '=', 'nh.clinical.spell'),
+                ('state', 'not in', ['completed', 'cancelled']),
+                ('patient_id', '=', patient_id)
+            ]
+            spell_activity = activity_model.search(domain)
         spell_activity.ensure_one()
         return spell_activity
 
+    def get_timeline(self, cr, uid, spell_activity_id, since_sequence=None,
+                     data_models=None, limit=None, since_id=None,
+                     context=None):
+        """
+        Gets the activities of a spell (the spell activity, its children
+        and every activity recorded during the spell) with their data
+        records, ordered by ``sequence`` and ``id``.
+
+        The activities are fetched with one query, filtered by the
+        record rules of the user, and the data records are read once per
+        data model. Only stored fields of the data records are read.
+
+        Pass the returned ``sequence`` as ``since_sequence`` to get only
+        the activities that changed state since the previous call.
+        Activities that never changed state have no sequence and are
+        only returned when ``since_sequence`` is not given. To get the
+        next chunk of a timeline cut short by ``limit``, pass the
+        returned ``sequence`` and ``id`` as ``since_sequence`` and
+        ``since_id``.
+
+        :param spell_activity_id: spell :mod:`activity<activity.nh_activity>`
+            id
+        :type spell_activity_id: int
+        :param since_sequence: only return activities with a greater
+            ``sequence``
+        :type since_sequence: int
+        :param data_models: only return activities of these data models
+        :type data_models: list
+        :param limit: maximum number of activities
+        :type limit: int
+        :param since_id: only return activities after
+            (``since_sequence``, ``since_id``)
+        :type since_id: int
+        :returns: ``activities`` (list of dicts, each with its ``data``
+            record), ``sequence`` and ``id`` (the watermark for the next
+            call) and ``more`` (``True`` if ``limit`` cut the timeline
+            short)
+        :rtype: dict
+        """
+        activity_pool = self.pool['nh.activity']
+        activity_pool.check_access_rights(cr, uid, 'read')
+        query = activity_pool._where_calc(cr, uid, [], context=context)
+        activity_pool._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, params = query.get_sql()
+        alias = '"%s".' % activity_pool._table
+        where = [where_clause] if where_clause else []
+        where.append('({alias}id = %s or {alias}spell_activity_id = %s '
+                     'or {alias}parent_id = %s)'.format(alias=alias))
+        params = params + [spell_activity_id] * 3
+        if since_id:
+            where.append('(coalesce({alias}sequence, 0), {alias}id) > '
+                         '(%s, %s)'.format(alias=alias))
+            params += [since_sequence or 0, since_id]
+        elif since_sequence is not None:
+            where.append('coalesce({alias}sequence, 0) > %s'.format(
+                alias=alias))
+            params.append(since_sequence)
+        if data_models:
+            where.append('{alias}data_model in %s'.format(alias=alias))
+            params.append(tuple(data_models))
+        if limit:
+            params.append(limit)
+        cr.execute("""
+            select {columns}, {alias}data_ref
+            from {from_clause}
+            where {where}
+            order by coalesce({alias}sequence, 0), {alias}id
+            {limit}
+        """.format(columns=', '.join(alias + f
+                                     for f in TIMELINE_ACTIVITY_FIELDS),
+                   alias=alias, from_clause=from_clause,
+                   where=' and '.join(where),
+                   limit='limit %s' if limit else ''), params)
+        activities = cr.dictfetchall()
+        more = bool(limit) and len(activities) >= limit
+
+        data_ids = {}
+        for activity in activities:
+            data_ref = activity.pop('data_ref')
+            if data_ref:
+                model, data_id = data_ref.split(',')
+                activity['data_id'] = int(data_id)
+                data_ids.setdefault(model, []).append(int(data_id))
+            else:
+                activity['data_id'] = False
+        records = {}
+        for model, ids in data_ids.items():
+            pool = self.pool.get(model)
+            if pool is None:
+                continue
+            stored_fields = [
+                name for name, column in pool._columns.items()
+                if not isinstance(column, fields.function) or column.store]
+            for record in pool.read(cr, uid, ids, stored_fields,
+                                    context=context):
+                records[(model, record['id'])] = record
+        for activity in activities:
+            activity['data'] = records.get(
+                (activity['data_model'], activity['data_id']), False)
+
+        sequence, last_id = since_sequence or 0, since_id or False
+        if activities:
+            sequence = activities[-1]['sequence'] or 0
+            last_id = activities[-1]['id']
+        return {'activities': activities, 'sequence': sequence,
+                'id': last_id, 'more': more}
+
+    def iter_timeline(self, cr, uid, spell_activity_id, since_sequence=None,
+                      data_models=None, chunk_size=None, context=None):
+        """
+        Generator version of :meth:`get_timeline` for very long spells.
+        Yields the timeline in chunks of about ``chunk_size`` activities
+        so it is never held in memory at once.
+
+        :returns: lists of activities as returned by :meth:`get_timeline`
+        :rtype: generator
+        """
+        chunk_size = chunk_size or TIMELINE_CHUNK_SIZE
+        since_id = None
+        more = True
+        while more:
+            timeline = self.get_timeline(
+                cr, uid, spell_activity_id, since_sequence=since_sequence,
+                data_models=data_models, limit=chunk_size, since_id=since_id,
+                context=context)
+            if timeline['activities']:
+                yield timeline['activities']
+            more = timeline['more']
+            since_sequence = timeline['sequence']
+            since_id = timeline['id']
+
     def get_spell_start_date(self, cr, uid, patient_id, context=None):
         spell_id = self.get_by_patient_id(cr, uid, patient_id, context=context)
         spell_started = self.read(cr, uid, spell_id, ['date_started'])
         return dt.strptime(spell_started.get('date_started'), DTF)
+
+    def init(self, cr):
+        cr.execute("""
+            select 1 from information_schema.tables
+            where table_name = 'nh_clinical_spell_open'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                create table nh_clinical_spell_open (
+                    patient_id integer primary key
+                        references nh_clinical_patient on delete cascade,
+                    spell_id integer not null unique
+                        references nh_clinical_spell on delete cascade,
+                    spell_activity_id integer not null unique
+                        references nh_activity on delete cascade
+                )
+            """)
+        # Rebuild the mapping, keeping the latest spell of patients that
+        # have more than one started spell from before it existed
+        cr.execute("""
+            delete from nh_clinical_spell_open;
+            insert into nh_clinical_spell_open
+                (patient_id, spell_id, spell_activity_id)
+            select distinct on (spell.patient_id)
+                spell.patient_id, spell.id, activity.id
+            from nh_clinical_spell spell
+            inner join nh_activity activity
+                on activity.id = spell.activity_id
+            where activity.state = 'started'
+            order by spell.patient_id, activity.id desc
+        """)
+        cr.execute("""
+            select 1 from information_schema.tables
+            where table_name = 'nh_clinical_spell_transferred_access'
+        """)
+        if not cr.fetchone():
+            cr.execute("""
+                create table nh_clinical_spell_transferred_access (
+                    spell_id integer not null
+                        references nh_clinical_spell on delete cascade,
+                    user_id integer not null
+                        references res_users on delete cascade,
+                    expires_at timestamp not null,
+                    primary key (spell_id, user_id)
+                );
+                create index nh_clinical_spell_transferred_access_user_idx
+                    on nh_clinical_spell_transferred_access
+                    (user_id, expires_at)
+            """)
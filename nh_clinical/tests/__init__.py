@@ -4,9 +4,23 @@
 # Base level tests
 from .nh_activity import *
 from . import test_api_demo
+from . import test_api_batch
+from . import test_api_idempotency
+from . import test_adt_inbox
+from . import test_admission_plan
+from . import test_adt_tracing
+from . import test_spell_update_changes
+from . import test_transfer_pipeline
 from . import test_base_extensions
 from . import test_location
+from . import test_location_cache
+from . import test_user_context
+from . import test_location_full_name
+from . import test_evaluate_doctors
+from . import test_ward_snapshot
+from . import test_location_bulk_import
 from . import test_operations
+from . import test_patient_follow_users
 from . import test_patient_placement_wizard
 from . import test_responsibility_allocation_wizard
 from . import test_users
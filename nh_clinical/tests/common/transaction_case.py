@@ -0,0 +1,31 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.tests.common import TransactionCase
+
+
+class LocationTransactionCase(TransactionCase):
+    """
+    Test case creating the test locations with `nh.clinical.test_utils`
+    and copying them (and the patient records, if any) to the test case.
+
+    Set `admit_and_place_patient` to also admit a patient and place them
+    in `bed`, with a nurse allocated to the bed.
+    """
+
+    admit_and_place_patient = False
+
+    def setUp(self):
+        super(LocationTransactionCase, self).setUp()
+        self.test_utils = self.env['nh.clinical.test_utils']
+        if self.admit_and_place_patient:
+            self.test_utils.admit_and_place_patient()
+            self.nurse = self.test_utils.nurse
+        else:
+            self.test_utils.create_locations()
+        self.test_utils.copy_instance_variables(self)
+        self.hospital = self.test_utils.hospital
+        self.pos = self.test_utils.pos
+        self.ward = self.test_utils.ward
+        self.bed = self.test_utils.bed
+        self.other_ward = self.test_utils.other_ward
+        self.other_bed = self.test_utils.other_bed
@@ -1,3 +1,7 @@
 # -*- coding: utf-8 -*-
 from . import test_patient
-from . import test_name_get
\ No newline at end of file
+from . import test_name_get
+from . import test_resolve_patient
+from . import test_import_patients
+from . import test_patient_full_name
+from . import test_patient_identifiers
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from cStringIO import StringIO
+
+from openerp.tests.common import TransactionCase
+
+
+class TestImportPatients(TransactionCase):
+    """
+    Test the streaming CSV patient import.
+    """
+
+    def setUp(self):
+        super(TestImportPatients, self).setUp()
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.patient_pool.create(self.cr, self.uid, {
+            'other_identifier': 'TESTIMP00', 'given_name': 'John',
+            'family_name': 'Smith'})
+
+    def import_patients(self, lines, chunk_size=2):
+        data = StringIO('\n'.join(lines) + '\n')
+        return self.patient_pool.import_patients(
+            self.cr, self.uid, data, chunk_size=chunk_size,
+            context={'dateformat': 'DMY'})
+
+    def test_imports_and_normalises_patients(self):
+        res = self.import_patients([
+            'other_identifier,patient_identifier,family_name,given_name,dob',
+            'TEST-IMP-01,123 456 7890,Smith,Jane,03/02/1980',
+            'TESTIMP02,,Jones,Tom,',
+            'TESTIMP03,,Brown,Ann,1990-05-06'
+        ])
+        self.assertEqual(res, {'created': 3, 'errors': []})
+        patient_id = self.patient_pool.search(
+            self.cr, self.uid, [('other_identifier', '=', 'TESTIMP01')])
+        patient = self.patient_pool.browse(self.cr, self.uid, patient_id[0])
+        self.assertEqual(patient.patient_identifier, '1234567890')
+        self.assertEqual(patient.dob, '1980-02-03 00:00:00')
+        self.assertEqual(patient.name, 'Smith, Jane')
+        self.assertEqual(patient.gender, 'NSP')
+        self.assertTrue(patient.active)
+
+    def test_reports_row_errors_without_aborting_chunk(self):
+        res = self.import_patients([
+            'other_identifier,family_name,given_name,dob',
+            'TESTIMP00,Smith,John,',
+            'TESTIMP04,Smith,Jane,notadate',
+            'TESTIMP05,,Jane,',
+            'TESTIMP06,Green,Jane,',
+            'TESTIMP06,Green,Jim,'
+        ])
+        self.assertEqual(res['created'], 1)
+        self.assertEqual([e[0] for e in res['errors']], [2, 3, 4, 6])
+        self.assertTrue(self.patient_pool.search(
+            self.cr, self.uid, [('other_identifier', '=', 'TESTIMP06')]))
+
+    def test_format_data_normalises_columns(self):
+        data = [('TEST-01', '01/02/2000'), ('TEST_02', '2000-03-04')]
+        self.patient_pool.format_data(['other_identifier', 'dob'], data)
+        self.assertEqual(data, [('TEST01', '2000-01-02 00:00:00'),
+                                ('TEST02', '2000-03-04 00:00:00')])
@@ -292,4 +292,18 @@ class TestClinicalPatient(common.SingleTransactionCase):
             cr, uid, None, None, args)
 
         self.assertEqual(type(domain), list)
-        self.assertTrue(patient_id in domain[0][2])
+        self.assertEqual(domain[0][1], 'inselect')
+        self.assertTrue(patient_id in self.patient_pool.search(cr, uid, domain))
+
+    def test_not_admitted_search_excludes_admitted_patients(self):
+        cr, uid = self.cr, self.uid
+        test_utils = self.env['nh.clinical.test_utils']
+        test_utils.admit_and_place_patient()
+        patient_id = test_utils.patient.id
+
+        self.assertNotIn(patient_id, self.patient_pool.search(
+            cr, uid, [('not_admitted', '=', True)]))
+        self.assertIn(patient_id, self.patient_pool.search(
+            cr, uid, [('not_admitted', '=', False)]))
+        self.assertEqual(self.patient_pool._not_admitted(
+            cr, uid, [patient_id], None, None), {patient_id: False})
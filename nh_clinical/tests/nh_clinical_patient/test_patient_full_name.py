@@ -0,0 +1,48 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.tests.common import TransactionCase
+
+
+class TestPatientFullName(TransactionCase):
+    """
+    Test the stored ``full_name`` of patients and the batch name_get and
+    name_search using it.
+    """
+
+    def setUp(self):
+        super(TestPatientFullName, self).setUp()
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.patient_ids = [
+            self.patient_pool.create(self.cr, self.uid, {
+                'family_name': 'Wren', 'given_name': 'Colin',
+                'other_identifier': 'HOSPTESTNAME1'}),
+            self.patient_pool.create(self.cr, self.uid, {
+                'family_name': 'Finch', 'given_name': 'Ada',
+                'middle_names': 'May', 'other_identifier': 'HOSPTESTNAME2'})
+        ]
+
+    def test_name_get_handles_batches(self):
+        self.assertEqual(
+            self.patient_pool.name_get(self.cr, self.uid, self.patient_ids),
+            [(self.patient_ids[0], 'Wren, Colin'),
+             (self.patient_ids[1], 'Finch, Ada May')])
+
+    def test_full_name_is_stored_on_write(self):
+        self.patient_pool.write(self.cr, self.uid, self.patient_ids[0],
+                                {'middle_names': 'Frank'})
+        self.cr.execute("select full_name, display_name "
+                        "from nh_clinical_patient where id = %s",
+                        (self.patient_ids[0],))
+        self.assertEqual(self.cr.fetchone(),
+                         ('Wren, Colin Frank', 'Wren, Colin Frank'))
+
+    def test_patient_without_names_has_no_full_name(self):
+        patient_id = self.patient_pool.create(
+            self.cr, self.uid, {'other_identifier': 'HOSPTESTNAME3'})
+        patient = self.patient_pool.read(self.cr, self.uid, patient_id,
+                                         ['full_name'])
+        self.assertFalse(patient['full_name'])
+
+    def test_name_search_matches_full_name(self):
+        res = self.patient_pool.name_search(self.cr, self.uid, 'finch, ada')
+        self.assertEqual(res, [(self.patient_ids[1], 'Finch, Ada May')])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from openerp.osv import osv
+from openerp.tests.common import TransactionCase
+
+
+class TestPatientIdentifiers(TransactionCase):
+    """
+    Test patient identifiers are looked up and kept unique through their
+    normalised copies.
+    """
+
+    def setUp(self):
+        super(TestPatientIdentifiers, self).setUp()
+        cr, uid = self.cr, self.uid
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.patient_id = self.patient_pool.create(cr, uid, {
+            'other_identifier': 'TESTHN-001',
+            'patient_identifier': '943 476 5919',
+            'given_name': 'John', 'family_name': 'Smith'})
+
+    def read_normalised(self):
+        return self.patient_pool.read(
+            self.cr, self.uid, self.patient_id,
+            ['other_identifier_normalised', 'patient_identifier_normalised'])
+
+    def test_identifiers_are_normalised(self):
+        patient = self.read_normalised()
+        self.assertEqual(patient['other_identifier_normalised'], 'TESTHN001')
+        self.assertEqual(patient['patient_identifier_normalised'],
+                         '9434765919')
+
+    def test_lookups_ignore_separators(self):
+        cr, uid = self.cr, self.uid
+        self.assertTrue(self.patient_pool.check_hospital_number(
+            cr, uid, 'TESTHN 001'))
+        self.assertTrue(self.patient_pool.check_nhs_number(
+            cr, uid, '943-476-5919'))
+        self.assertEqual(self.patient_pool.resolve_patient(
+            cr, uid, nhs_number='9434765919'), (self.patient_id, 'nhs_number'))
+        data = {'patient_identifier': '9434765919'}
+        self.patient_pool.check_data(cr, uid, data, create=False)
+        self.assertEqual(data['patient_id'], self.patient_id)
+
+    def test_update_by_normalised_identifier(self):
+        self.patient_pool.update(self.cr, self.uid, 'TESTHN001',
+                                 {'given_name': 'Jack'})
+        self.assertEqual(self.patient_pool.read(
+            self.cr, self.uid, self.patient_id, ['given_name'])['given_name'],
+            'Jack')
+
+    def test_duplicate_identifiers_are_rejected(self):
+        with self.assertRaises(osv.except_osv):
+            self.patient_pool.create(self.cr, self.uid, {
+                'other_identifier': 'TESTHN001', 'given_name': 'Jane',
+                'family_name': 'Smith'})
+        other_id = self.patient_pool.create(self.cr, self.uid, {
+            'other_identifier': 'TESTHN002', 'given_name': 'Jane',
+            'family_name': 'Smith'})
+        with self.assertRaises(osv.except_osv):
+            self.patient_pool.write(self.cr, self.uid, other_id,
+                                    {'patient_identifier': '9434765919'})
+
+    def test_inactive_patients_release_their_identifiers(self):
+        self.patient_pool.unlink(self.cr, self.uid, self.patient_id)
+        patient = self.read_normalised()
+        self.assertFalse(patient['other_identifier_normalised'])
+        self.assertFalse(self.patient_pool.check_hospital_number(
+            self.cr, self.uid, 'TESTHN001'))
+        self.assertTrue(self.patient_pool.create(self.cr, self.uid, {
+            'other_identifier': 'TESTHN001', 'given_name': 'Jane',
+            'family_name': 'Smith'}))
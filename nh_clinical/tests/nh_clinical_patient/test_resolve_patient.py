@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from openerp.osv import osv
+from openerp.tests.common import TransactionCase
+
+
+class TestResolvePatient(TransactionCase):
+    """
+    Test the one query patient resolution used by the ADT API.
+    """
+
+    def setUp(self):
+        super(TestResolvePatient, self).setUp()
+        cr, uid = self.cr, self.uid
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.patient_id = self.patient_pool.create(cr, uid, {
+            'other_identifier': 'TESTHNR01', 'patient_identifier': 'TESTNHR01',
+            'given_name': 'John', 'family_name': 'Smith'})
+        self.other_patient_id = self.patient_pool.create(cr, uid, {
+            'other_identifier': 'TESTHNR02', 'patient_identifier': 'TESTNHR02',
+            'given_name': 'Jane', 'family_name': 'Smith'})
+
+    def test_resolves_by_hospital_number(self):
+        self.assertEqual(self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTHNR01'),
+            (self.patient_id, 'hospital_number'))
+
+    def test_resolves_by_nhs_number(self):
+        self.assertEqual(self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTHNR99',
+            nhs_number='TESTNHR01'), (self.patient_id, 'nhs_number'))
+
+    def test_hospital_number_match_is_preferred(self):
+        self.assertEqual(self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTHNR02',
+            nhs_number='TESTNHR01'), (self.other_patient_id,
+                                      'hospital_number'))
+
+    def test_no_match(self):
+        self.assertEqual(self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTHNR99'), (False, False))
+
+    def test_inactive_patient_is_not_resolved(self):
+        self.patient_pool.unlink(self.cr, self.uid, self.patient_id)
+        self.assertEqual(self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTHNR01'), (False, False))
+
+    def test_match_is_memoised_until_identifiers_change(self):
+        cr, uid = self.cr, self.uid
+        context = self.patient_pool.get_patient_memo_context(cr, uid)
+        self.patient_pool.resolve_patient(
+            cr, uid, hospital_number='TESTHNR01', context=context)
+        self.assertEqual(
+            context['nh_patient_memo'],
+            {('hospital_number', 'TESTHNR01'): self.patient_id})
+        self.patient_pool.write(cr, uid, self.patient_id,
+                                {'other_identifier': 'TESTHNR03'},
+                                context=context)
+        self.assertEqual(context['nh_patient_memo'], {})
+        self.assertEqual(self.patient_pool.resolve_patient(
+            cr, uid, hospital_number='TESTHNR01', context=context),
+            (False, False))
+
+    def test_get_patient_id_raises_if_not_found(self):
+        with self.assertRaises(osv.except_osv):
+            self.patient_pool.get_patient_id(self.cr, self.uid,
+                                             hospital_number='TESTHNR99')
+
+    def test_check_identifiers_raises_on_duplicate(self):
+        with self.assertRaises(osv.except_osv):
+            self.patient_pool.check_identifiers(
+                self.cr, self.uid, hospital_number='TESTHNR99',
+                nhs_number='TESTNHR01')
@@ -1,2 +1,5 @@
 # from . import test_spell
 from . import test_get_spell_activity_by_patient_id
+from . import test_open_spell
+from . import test_transferred_access
+from . import test_spell_timeline
@@ -0,0 +1,61 @@
+from mock import patch
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestOpenSpell(LocationTransactionCase):
+    """
+    Test the patient to started spell mapping used by get_by_patient_id.
+    """
+
+    admit_and_place_patient = True
+
+    def setUp(self):
+        super(TestOpenSpell, self).setUp()
+        self.spell_pool = self.registry('nh.clinical.spell')
+
+    def get_open_spell(self):
+        return self.spell_pool.get_open_spell(self.cr, self.uid,
+                                              self.patient.id)
+
+    def test_started_spell_is_mapped(self):
+        self.assertEqual(self.get_open_spell(),
+                         (self.spell.id, self.spell_activity.id))
+        self.assertEqual(self.spell_pool.get_by_patient_id(
+            self.cr, self.uid, self.patient.id), self.spell.id)
+
+    def test_discharge_removes_mapping(self):
+        self.test_utils.discharge_patient()
+        self.assertEqual(self.get_open_spell(), (False, False))
+        self.assertFalse(self.spell_pool.get_by_patient_id(
+            self.cr, self.uid, self.patient.id))
+
+    def test_readmission_maps_new_spell(self):
+        self.test_utils.discharge_patient()
+        self.test_utils.admit_patient()
+        spell_id, spell_activity_id = self.get_open_spell()
+        self.assertTrue(spell_id)
+        self.assertNotEqual(spell_id, self.spell.id)
+        spell = self.env['nh.clinical.spell'].browse(spell_id)
+        self.assertEqual(spell.activity_id.id, spell_activity_id)
+        self.assertEqual(spell.activity_id.state, 'started')
+
+    def test_create_returns_started_spell(self):
+        spell_id = self.spell_pool.create(self.cr, self.uid, {
+            'patient_id': self.patient.id,
+            'pos_id': self.spell.pos_id.id})
+        self.assertEqual(spell_id, self.spell.id)
+
+    def test_only_spell_activities_are_synced(self):
+        activity_pool = self.registry('nh.activity')
+        placement_id = activity_pool.search(self.cr, self.uid, [
+            ['data_model', '=', 'nh.clinical.patient.placement'],
+            ['patient_id', '=', self.patient.id]])[0]
+        with patch.object(type(self.spell_pool), 'sync_open_spells') as sync:
+            activity_pool.write(self.cr, self.uid, placement_id,
+                                {'state': 'completed'})
+            self.assertFalse(sync.called)
+            activity_pool.write(self.cr, self.uid, self.spell_activity.id,
+                                {'state': 'started'})
+            self.assertEqual(sync.call_args[1]['activity_ids'],
+                             [self.spell_activity.id])
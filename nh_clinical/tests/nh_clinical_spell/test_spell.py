@@ -96,15 +96,19 @@ class TestClinicalSpell(common.SingleTransactionCase):
 
     def test_03_transferred_user_ids_search_with_multiple_user_ids(self):
         cr, uid = self.cr, self.uid
-        args = [('user_id', 'in', [3, 4, 5])]
-        return_value = {1: [3, 4, 5], 2: [2, 5], 3: [6, 7]}
-        self.spell_pool._get_transferred_user_ids = MagicMock(
-            return_value=return_value)
-
-        result = self.spell_pool._transferred_user_ids_search(cr, uid, None,
-                                                              None, args)
-        self.assertEquals([('id', 'in', [1, 2])], result)
-        del self.spell_pool._get_transferred_user_ids
+        spell_id = self.spell_pool.get_by_patient_id(cr, uid, self.patient_id)
+        cr.execute("""
+            insert into nh_clinical_spell_transferred_access
+                (spell_id, user_id, expires_at)
+            values (%s, %s, now() at time zone 'UTC' + interval '1 hour')
+        """, (spell_id, self.userpos_id))
+
+        result = self.spell_pool.search(
+            cr, uid, [('transferred_user_ids', 'in', [self.userpos_id, uid])])
+        self.assertIn(spell_id, result)
+        result = self.spell_pool.search(
+            cr, uid, [('transferred_user_ids', 'in', [uid])])
+        self.assertNotIn(spell_id, result)
 
     def test_04_test_create_when_patients_is_started_spell(self):
         cr, uid = self.cr, self.uid
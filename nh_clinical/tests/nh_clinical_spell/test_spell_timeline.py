@@ -0,0 +1,84 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestSpellTimeline(LocationTransactionCase):
+    """
+    Test getting the activity tree of a spell with its data records.
+    """
+
+    admit_and_place_patient = True
+
+    def setUp(self):
+        super(TestSpellTimeline, self).setUp()
+        self.spell_pool = self.registry('nh.clinical.spell')
+
+    def get_timeline(self, **kwargs):
+        return self.spell_pool.get_timeline(
+            self.cr, self.uid, self.spell_activity.id, **kwargs)
+
+    def test_timeline_contains_spell_and_placement(self):
+        activities = self.get_timeline()['activities']
+        by_model = {a['data_model']: a for a in activities}
+        self.assertIn('nh.clinical.spell', by_model)
+        self.assertIn('nh.clinical.patient.placement', by_model)
+        self.assertEqual(by_model['nh.clinical.spell']['data']['id'],
+                         self.spell.id)
+        self.assertEqual(
+            by_model['nh.clinical.spell']['data']['patient_id'][0],
+            self.patient.id)
+
+    def test_timeline_is_ordered_by_sequence(self):
+        sequences = [a['sequence'] or 0
+                     for a in self.get_timeline()['activities']]
+        self.assertEqual(sequences, sorted(sequences))
+
+    def test_timeline_filters_models(self):
+        activities = self.get_timeline(
+            data_models=['nh.clinical.patient.placement'])['activities']
+        self.assertTrue(activities)
+        self.assertEqual(set(a['data_model'] for a in activities),
+                         {'nh.clinical.patient.placement'})
+
+    def test_polling_returns_only_changes(self):
+        sequence = self.get_timeline()['sequence']
+        self.assertFalse(
+            self.get_timeline(since_sequence=sequence)['activities'])
+        self.test_utils.discharge_patient()
+        changed = self.get_timeline(since_sequence=sequence)['activities']
+        self.assertIn(self.spell_activity.id, [a['id'] for a in changed])
+
+    def test_iter_timeline_yields_every_activity(self):
+        activities = self.get_timeline()['activities']
+        chunks = list(self.spell_pool.iter_timeline(
+            self.cr, self.uid, self.spell_activity.id, chunk_size=1))
+        self.assertEqual(
+            sorted(a['id'] for chunk in chunks for a in chunk),
+            sorted(a['id'] for a in activities))
+
+    def test_chunks_continue_after_the_last_key(self):
+        activities = self.get_timeline()['activities']
+        first = self.get_timeline(limit=1)
+        self.assertTrue(first['more'])
+        rest = self.get_timeline(since_sequence=first['sequence'],
+                                 since_id=first['id'])['activities']
+        self.assertEqual(
+            [a['id'] for a in first['activities'] + rest],
+            [a['id'] for a in activities])
+
+    def test_timeline_applies_record_rules(self):
+        self.env['ir.rule'].create({
+            'name': 'Test Timeline Hide Placements',
+            'model_id': self.env['ir.model'].search(
+                [('model', '=', 'nh.activity')]).id,
+            'domain_force':
+                "[('data_model', '!=', 'nh.clinical.patient.placement')]"
+        })
+        activities = self.spell_pool.get_timeline(
+            self.cr, self.test_utils.nurse.id,
+            self.spell_activity.id)['activities']
+        data_models = set(a['data_model'] for a in activities)
+        self.assertIn('nh.clinical.spell', data_models)
+        self.assertNotIn('nh.clinical.patient.placement', data_models)
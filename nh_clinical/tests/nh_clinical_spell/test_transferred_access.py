@@ -0,0 +1,83 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestTransferredAccess(LocationTransactionCase):
+    """
+    Test the recently transferred access kept for the staff of the
+    location a patient was transferred out of.
+    """
+
+    admit_and_place_patient = True
+
+    def setUp(self):
+        super(TestTransferredAccess, self).setUp()
+        self.spell_model = self.env['nh.clinical.spell']
+        self.spell_pool = self.registry('nh.clinical.spell')
+        self.test_utils.transfer_patient(self.test_utils.other_ward.code)
+        self.spell.invalidate_cache()
+
+    def search_spells(self, user_id):
+        return self.spell_model.search(
+            [('transferred_user_ids', 'in', [user_id])])
+
+    def test_origin_staff_keep_access(self):
+        self.assertIn(self.nurse, self.spell.transferred_user_ids)
+        self.assertIn(self.spell, self.search_spells(self.nurse.id))
+
+    def test_origin_ward_staff_keep_access(self):
+        shift_coordinator = self.test_utils.create_shift_coordinator(
+            self.ward.id)
+        self.spell.invalidate_cache()
+        self.assertIn(shift_coordinator, self.spell.transferred_user_ids)
+        self.assertIn(self.spell, self.search_spells(shift_coordinator.id))
+
+    def test_reparented_origin_changes_ward_staff_access(self):
+        shift_coordinator = self.test_utils.create_shift_coordinator(
+            self.ward.id)
+        new_ward = self.test_utils.create_location(
+            'ward', self.test_utils.hospital.id)
+        new_shift_coordinator = self.test_utils.create_shift_coordinator(
+            new_ward.id)
+        self.bed.write({'parent_id': new_ward.id})
+        self.spell.invalidate_cache()
+        self.assertNotIn(shift_coordinator, self.spell.transferred_user_ids)
+        self.assertIn(new_shift_coordinator,
+                      self.spell.transferred_user_ids)
+
+    def test_unallocated_staff_lose_access(self):
+        self.nurse.write({'location_ids': [[6, 0, []]]})
+        self.spell.invalidate_cache()
+        self.assertNotIn(self.nurse, self.spell.transferred_user_ids)
+        self.assertNotIn(self.spell, self.search_spells(self.nurse.id))
+
+    def test_staff_allocated_from_the_location_keep_access(self):
+        nurse = self.test_utils.create_nurse(self.other_bed.id)
+        self.bed.write({'user_ids': [[4, nurse.id]]})
+        self.spell.invalidate_cache()
+        self.assertIn(nurse, self.spell.transferred_user_ids)
+        self.bed.write({'user_ids': [[3, nurse.id]]})
+        self.spell.invalidate_cache()
+        self.assertNotIn(nurse, self.spell.transferred_user_ids)
+
+    def test_expired_access_is_pruned(self):
+        self.cr.execute("""
+            update nh_clinical_spell_transferred_access
+            set expires_at = now() at time zone 'UTC' - interval '1 hour'
+            where spell_id = %s
+        """, (self.spell.id,))
+        self.assertNotIn(self.spell, self.search_spells(self.nurse.id))
+        self.spell_pool.prune_transferred_access(self.cr, self.uid)
+        self.cr.execute("""
+            select count(*) from nh_clinical_spell_transferred_access
+            where spell_id = %s
+        """, (self.spell.id,))
+        self.assertEqual(self.cr.fetchone()[0], 0)
+
+    def test_discharged_spell_is_not_accessible(self):
+        self.test_utils.discharge_patient()
+        self.spell.invalidate_cache()
+        self.assertFalse(self.spell.transferred_user_ids)
+        self.assertNotIn(self.spell, self.search_spells(self.nurse.id))
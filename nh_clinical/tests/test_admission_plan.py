@@ -0,0 +1,83 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestAdmissionPlan(LocationTransactionCase):
+    """
+    Test the ADT admit chain applies the updates of the activities it
+    creates once, as they would have been applied one by one.
+    """
+
+    def setUp(self):
+        super(TestAdmissionPlan, self).setUp()
+        self.api_pool = self.registry('nh.clinical.api')
+        self.activity_pool = self.registry('nh.activity')
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.api_pool.register(self.cr, self.uid, 'TESTPLAN01', {
+            'family_name': 'Smith', 'given_name': 'John'})
+        self.api_pool.admit(self.cr, self.uid, 'TESTPLAN01', {
+            'location': self.ward.code})
+        self.patient_id = self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTPLAN01')[0]
+        activity_ids = self.activity_pool.search(self.cr, self.uid, [
+            ['patient_id', '=', self.patient_id],
+            ['data_model', 'in', ['nh.clinical.adt.patient.admit',
+                                  'nh.clinical.patient.admission',
+                                  'nh.clinical.spell',
+                                  'nh.clinical.patient.move']]])
+        self.activities = {
+            activity.data_model: activity
+            for activity in self.activity_pool.browse(
+                self.cr, self.uid, activity_ids)}
+
+    def test_admit_chain_relationships(self):
+        admit = self.activities['nh.clinical.adt.patient.admit']
+        admission = self.activities['nh.clinical.patient.admission']
+        spell = self.activities['nh.clinical.spell']
+        move = self.activities['nh.clinical.patient.move']
+        self.assertEqual(admit.state, 'completed')
+        self.assertEqual(admission.state, 'completed')
+        self.assertEqual(spell.state, 'started')
+        self.assertEqual(move.state, 'completed')
+        self.assertEqual(admission.creator_id, admit)
+        self.assertEqual(spell.creator_id, admission)
+        self.assertEqual(move.creator_id, admission)
+        for activity in [admit, admission, move]:
+            self.assertEqual(activity.parent_id, spell)
+
+    def test_planned_activity_values(self):
+        spell = self.activities['nh.clinical.spell']
+        expected_spell = {
+            'nh.clinical.adt.patient.admit': False,
+            'nh.clinical.patient.admission': False,
+            'nh.clinical.spell': spell.id,
+            'nh.clinical.patient.move': spell.id
+        }
+        for data_model, activity in self.activities.items():
+            self.assertEqual(activity.patient_id.id, self.patient_id)
+            self.assertEqual(activity.location_id, self.ward)
+            self.assertEqual(activity.pos_id, self.ward.pos_id)
+            self.assertEqual(activity.spell_activity_id.id,
+                             expected_spell[data_model])
+
+    def test_planned_activity_users(self):
+        for data_model, activity in self.activities.items():
+            user_ids = self.registry(data_model).get_activity_user_ids(
+                self.cr, self.uid, activity.id)
+            self.assertEqual(sorted(u.id for u in activity.user_ids),
+                             sorted(user_ids))
+
+    def test_flush_runs_unplanned_updates(self):
+        move = self.activities['nh.clinical.patient.move']
+        self.activity_pool.write(self.cr, self.uid, move.id,
+                                 {'spell_activity_id': False})
+        deferred = OrderedDict([(move.id, None)])
+        self.activity_pool.flush_activity_updates(
+            self.cr, self.uid, context={'nh_deferred_updates': deferred})
+        self.assertFalse(deferred)
+        move.invalidate_cache()
+        self.assertEqual(move.spell_activity_id,
+                         self.activities['nh.clinical.spell'])
@@ -0,0 +1,113 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.adt_inbox import INBOX_MAX_ATTEMPTS, \
+    LOCK_SQL
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+from openerp.osv.orm import except_orm
+
+
+class TestAdtInbox(LocationTransactionCase):
+    """
+    Test ADT inbox messages are claimed one per patient at a time,
+    retried and dead-lettered.
+    """
+
+    def setUp(self):
+        super(TestAdtInbox, self).setUp()
+        self.inbox_pool = self.registry('nh.clinical.adt.inbox')
+        self.patient_pool = self.registry('nh.clinical.patient')
+
+    def enqueue(self, messages):
+        return self.inbox_pool.enqueue(self.cr, self.uid, messages)
+
+    def process(self):
+        return self.inbox_pool.process_pending(self.cr, self.uid)
+
+    def read_inbox(self, inbox_id):
+        self.inbox_pool.invalidate_cache(self.cr, self.uid)
+        return self.inbox_pool.read(self.cr, self.uid, inbox_id,
+                                    ['state', 'attempts', 'last_error'])
+
+    def test_ids_follow_the_messages(self):
+        messages = [{'type': 'register', 'data': {},
+                     'hospital_number': 'TESTINBOX%02d' % i}
+                    for i in range(5)]
+        inbox_ids = self.enqueue(messages)
+        self.assertEqual(inbox_ids, sorted(inbox_ids))
+        for inbox_id, message in zip(inbox_ids, messages):
+            self.assertEqual(
+                self.inbox_pool.read(self.cr, self.uid, inbox_id,
+                                     ['hospital_number'])['hospital_number'],
+                message['hospital_number'])
+
+    def test_messages_of_a_patient_are_applied_in_order(self):
+        register_id, admit_id, other_id = self.enqueue([
+            {'type': 'register', 'hospital_number': 'TESTINBOX01',
+             'data': {'family_name': 'Smith', 'given_name': 'John'}},
+            {'type': 'admit', 'hospital_number': 'TESTINBOX01',
+             'data': {'location': self.ward.code}},
+            {'type': 'register', 'hospital_number': 'TESTINBOX02',
+             'data': {'family_name': 'Smith', 'given_name': 'Jane'}}
+        ])
+        counts = self.process()
+        self.assertEqual(counts['claimed'], 2)
+        self.assertEqual(self.read_inbox(register_id)['state'], 'done')
+        self.assertEqual(self.read_inbox(admit_id)['state'], 'pending')
+        self.assertEqual(self.read_inbox(other_id)['state'], 'done')
+        self.assertEqual(self.process()['done'], 1)
+        self.assertEqual(self.read_inbox(admit_id)['state'], 'done')
+        self.assertEqual(self.process()['claimed'], 0)
+
+    def test_failed_message_holds_back_the_patient(self):
+        failing_id, next_id = self.enqueue([
+            {'type': 'cancel_admit', 'hospital_number': 'TESTINBOX03'},
+            {'type': 'register', 'hospital_number': 'TESTINBOX03',
+             'data': {'family_name': 'Smith', 'given_name': 'John'}}
+        ])
+        self.assertEqual(self.process()['retried'], 1)
+        failing = self.read_inbox(failing_id)
+        self.assertEqual(failing['state'], 'pending')
+        self.assertEqual(failing['attempts'], 1)
+        self.assertIn('TESTINBOX03', failing['last_error'])
+        self.assertEqual(self.process()['claimed'], 0)
+        self.assertEqual(self.read_inbox(next_id)['state'], 'pending')
+
+    def test_poison_message_is_dead_lettered(self):
+        failing_id, next_id = self.enqueue([
+            {'type': 'cancel_admit', 'hospital_number': 'TESTINBOX04'},
+            {'type': 'register', 'hospital_number': 'TESTINBOX04',
+             'data': {'family_name': 'Smith', 'given_name': 'John'}}
+        ])
+        for attempt in range(INBOX_MAX_ATTEMPTS):
+            self.cr.execute("""
+                update nh_clinical_adt_inbox
+                set next_attempt = now() at time zone 'UTC' - interval '1s'
+                where id = %s
+            """, (failing_id,))
+            self.process()
+        self.assertEqual(self.read_inbox(failing_id)['state'], 'dead')
+        self.assertEqual(self.process()['done'], 1)
+        self.assertEqual(self.read_inbox(next_id)['state'], 'done')
+        self.inbox_pool.requeue(self.cr, self.uid, [failing_id])
+        self.assertEqual(self.read_inbox(failing_id)['state'], 'pending')
+
+    def test_patient_locked_by_another_worker_is_skipped(self):
+        inbox_id = self.enqueue([
+            {'type': 'register', 'hospital_number': 'TESTINBOX05',
+             'data': {'family_name': 'Smith', 'given_name': 'John'}}])[0]
+        worker_cr = self.registry.cursor()
+        try:
+            worker_cr.execute(LOCK_SQL, (['TESTINBOX05'],))
+            self.process()
+            self.assertEqual(self.read_inbox(inbox_id)['state'], 'pending')
+        finally:
+            worker_cr.rollback()
+            worker_cr.close()
+        self.process()
+        self.assertEqual(self.read_inbox(inbox_id)['state'], 'done')
+
+    def test_message_without_hospital_number_is_rejected(self):
+        with self.assertRaises(except_orm):
+            self.enqueue([{'type': 'register',
+                           'data': {'family_name': 'Smith'}}])
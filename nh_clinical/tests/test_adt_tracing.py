@@ -0,0 +1,72 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+import json
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestAdtTracing(LocationTransactionCase):
+    """
+    Test ADT messages are traced when tracing is enabled.
+    """
+
+    def setUp(self):
+        super(TestAdtTracing, self).setUp()
+        self.api_pool = self.registry('nh.clinical.api')
+        self.trace_pool = self.registry('nh.clinical.adt.trace')
+        self.api_pool.register(self.cr, self.uid, 'TESTTRACE01', {
+            'family_name': 'Smith', 'given_name': 'John'})
+
+    def get_traces(self, correlation_id):
+        trace_ids = self.trace_pool.search(self.cr, self.uid, [
+            ['correlation_id', '=', correlation_id]])
+        return self.trace_pool.browse(self.cr, self.uid, trace_ids)
+
+    def test_tracing_is_disabled_by_default(self):
+        self.api_pool.admit(self.cr, self.uid, 'TESTTRACE01', {
+            'location': self.ward.code}, context={'nh_trace_id': 'TRACE1'})
+        self.assertFalse(self.get_traces('TRACE1'))
+
+    def test_admit_span_tree(self):
+        self.api_pool.admit(self.cr, self.uid, 'TESTTRACE01', {
+            'location': self.ward.code}, context={
+            'nh_adt_tracing': 'table', 'nh_trace_id': 'TRACE2'})
+        trace = self.get_traces('TRACE2')
+        self.assertEqual(len(trace), 1)
+        self.assertEqual(trace.name, 'nh.clinical.api.admit')
+        self.assertGreater(trace.sql_count, 0)
+        spans = json.loads(trace.spans)
+        self.assertEqual(spans['correlation_id'], 'TRACE2')
+        self.assertEqual(spans['sql_count'], trace.sql_count)
+        names = set()
+
+        def walk(span):
+            names.add(span['name'])
+            self.assertGreaterEqual(span['sql_count'], sum(
+                child['sql_count'] for child in span.get('children', [])))
+            for child in span.get('children', []):
+                walk(child)
+        walk(spans)
+        self.assertIn('nh.clinical.adt.patient.admit.submit', names)
+        self.assertIn('nh.clinical.adt.patient.admit.complete', names)
+        self.assertIn('nh.clinical.location.get_by_code', names)
+        self.assertIn('nh.clinical.patient.get_patient_id', names)
+
+    def test_message_id_is_the_correlation_id(self):
+        self.api_pool.admit(self.cr, self.uid, 'TESTTRACE01', {
+            'location': self.ward.code}, message_id='TRACEMSG1',
+            context={'nh_adt_tracing': 'table'})
+        self.assertEqual(len(self.get_traces('TRACEMSG1')), 1)
+
+    def test_positional_context_is_used(self):
+        self.api_pool.admit(self.cr, self.uid, 'TESTTRACE01', {
+            'location': self.ward.code}, {
+            'nh_adt_tracing': 'table', 'nh_trace_id': 'TRACE4'})
+        self.assertEqual(len(self.get_traces('TRACE4')), 1)
+
+    def test_failed_call_is_not_stored(self):
+        with self.assertRaises(Exception):
+            self.api_pool.admit(self.cr, self.uid, 'TESTTRACE01', {},
+                                context={'nh_adt_tracing': 'table',
+                                         'nh_trace_id': 'TRACE3'})
+        self.assertFalse(self.get_traces('TRACE3'))
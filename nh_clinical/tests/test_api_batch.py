@@ -0,0 +1,63 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestApiBatch(LocationTransactionCase):
+    """
+    Test ADT messages applied in batches, each one in its own savepoint.
+    """
+
+    def setUp(self):
+        super(TestApiBatch, self).setUp()
+        self.api_pool = self.registry('nh.clinical.api')
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.spell_pool = self.registry('nh.clinical.spell')
+
+    def process(self, messages):
+        return self.api_pool.process_batch(self.cr, self.uid, messages)
+
+    def test_messages_are_applied_in_order(self):
+        outcomes = self.process([
+            {'type': 'register', 'hospital_number': 'TESTBATCH01',
+             'data': {'family_name': 'Smith', 'given_name': 'John'},
+             'message_id': 'MSG1'},
+            {'type': 'admit', 'hospital_number': 'TESTBATCH01',
+             'data': {'location': self.ward.code}},
+            {'type': 'update', 'hospital_number': 'TESTBATCH01',
+             'data': {'given_name': 'Jack'}}
+        ])
+        self.assertEqual([o['status'] for o in outcomes],
+                         ['done', 'done', 'done'])
+        self.assertEqual(outcomes[0]['message_id'], 'MSG1')
+        patient_id = self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTBATCH01')[0]
+        self.assertTrue(self.spell_pool.get_open_spell(
+            self.cr, self.uid, patient_id)[0])
+        self.assertEqual(self.patient_pool.read(
+            self.cr, self.uid, patient_id, ['given_name'])['given_name'],
+            'Jack')
+
+    def test_failed_message_does_not_abort_the_batch(self):
+        outcomes = self.process([
+            {'type': 'register', 'hospital_number': 'TESTBATCH02',
+             'data': {'family_name': 'Smith', 'given_name': 'Jane'}},
+            {'type': 'cancel_admit', 'hospital_number': 'TESTBATCH99'},
+            {'type': 'unknown', 'hospital_number': 'TESTBATCH02'},
+            {'type': 'admit', 'hospital_number': 'TESTBATCH02',
+             'data': {'location': self.ward.code}}
+        ])
+        self.assertEqual([o['status'] for o in outcomes],
+                         ['done', 'error', 'error', 'done'])
+        self.assertIn('TESTBATCH99', outcomes[1]['error'])
+        self.assertEqual(outcomes[2]['index'], 2)
+
+    def test_failed_message_is_rolled_back(self):
+        outcomes = self.process([
+            {'type': 'register', 'hospital_number': 'TESTBATCH03',
+             'data': {'family_name': 'Smith'}},
+        ])
+        self.assertEqual(outcomes[0]['status'], 'error')
+        self.assertFalse(self.patient_pool.search(
+            self.cr, self.uid, [['other_identifier', '=', 'TESTBATCH03']]))
@@ -0,0 +1,86 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestApiIdempotency(LocationTransactionCase):
+    """
+    Test ADT messages resent with the same message id are only applied
+    once.
+    """
+
+    def setUp(self):
+        super(TestApiIdempotency, self).setUp()
+        self.api_pool = self.registry('nh.clinical.api')
+        self.activity_pool = self.registry('nh.activity')
+
+    def admit(self, message_id):
+        return self.api_pool.admit(
+            self.cr, self.uid, 'TESTIDEM01',
+            {'location': self.ward.code, 'family_name': 'Smith',
+             'given_name': 'John'}, message_id=message_id)
+
+    def count_admissions(self):
+        return self.activity_pool.search(self.cr, self.uid, [
+            ['data_model', '=', 'nh.clinical.adt.patient.admit']],
+            count=True)
+
+    def test_resent_message_is_skipped(self):
+        admissions = self.count_admissions()
+        self.assertTrue(self.admit('MSGIDEM01'))
+        self.assertTrue(self.admit('MSGIDEM01'))
+        self.assertEqual(self.count_admissions(), admissions + 1)
+
+    def test_message_without_id_is_not_recorded(self):
+        self.admit(None)
+        self.cr.execute("select count(*) from nh_clinical_adt_message_ledger "
+                        "where method = 'admit'")
+        self.assertEqual(self.cr.fetchone()[0], 0)
+
+    def test_batch_skips_resent_messages(self):
+        message = {'type': 'register', 'hospital_number': 'TESTIDEM02',
+                   'message_id': 'MSGIDEM02',
+                   'data': {'family_name': 'Smith', 'given_name': 'Jane'}}
+        outcomes = self.api_pool.process_batch(
+            self.cr, self.uid, [message, message])
+        self.assertEqual([o['status'] for o in outcomes], ['done', 'done'])
+        self.assertEqual(outcomes[0]['result'], outcomes[1]['result'])
+
+    def test_old_message_ids_are_pruned(self):
+        self.admit('MSGIDEM03')
+        self.cr.execute("""
+            update nh_clinical_adt_message_ledger
+            set processed_at = processed_at - interval '1 year'
+            where message_id = 'MSGIDEM03'
+        """)
+        self.api_pool.prune_message_ledger(self.cr, self.uid)
+        self.cr.execute("select 1 from nh_clinical_adt_message_ledger "
+                        "where message_id = 'MSGIDEM03'")
+        self.assertFalse(self.cr.fetchone())
+
+    def test_message_committed_by_concurrent_delivery_is_skipped(self):
+        message_id = 'MSGIDEM04'
+        delivery_cr = self.registry.cursor()
+        try:
+            delivery_cr.execute("""
+                select pg_advisory_xact_lock(hashtext(%s));
+                insert into nh_clinical_adt_message_ledger
+                    (message_id, method, result, processed_at)
+                values (%s, 'register', '42', now() at time zone 'UTC')
+            """, (message_id, message_id))
+            delivery_cr.commit()
+            # Our snapshot was taken before the delivery committed
+            result = self.api_pool.register(
+                self.cr, self.uid, 'TESTIDEM04',
+                {'family_name': 'Smith', 'given_name': 'John'},
+                message_id=message_id)
+            self.assertEqual(result, 42)
+            patient_ids = self.registry('nh.clinical.patient').search(
+                self.cr, self.uid, [['other_identifier', '=', 'TESTIDEM04']])
+            self.assertFalse(patient_ids)
+        finally:
+            delivery_cr.execute("delete from nh_clinical_adt_message_ledger "
+                                "where message_id = %s", (message_id,))
+            delivery_cr.commit()
+            delivery_cr.close()
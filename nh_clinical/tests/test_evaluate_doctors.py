@@ -0,0 +1,71 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.tests.common import TransactionCase
+
+
+class TestEvaluateDoctors(TransactionCase):
+    """
+    Test the doctors of ADT messages are parsed safely and resolved by
+    code in bulk.
+    """
+
+    def setUp(self):
+        super(TestEvaluateDoctors, self).setUp()
+        self.doctor_pool = self.registry('nh.clinical.doctor')
+        self.existing_id = self.doctor_pool.create(
+            self.cr, self.uid, {'name': 'Existing Doctor',
+                                'code': 'TESTDOC00'})
+        self.doctors = [{
+            'type': 'c', 'code': 'TESTDOC01', 'title': 'Dr.',
+            'given_name': 'Consulting', 'family_name': 'Doctor',
+            'gender': 'F'
+        }, {
+            'type': 'r', 'code': 'TESTDOC02', 'title': 'Dr',
+            'given_name': 'Referring', 'family_name': 'Doctor'
+        }, {
+            'type': 'c', 'code': 'TESTDOC00'
+        }]
+
+    def evaluate(self, doctors, context=None):
+        data = {'doctors': doctors}
+        res = self.doctor_pool.evaluate_doctors_dict(
+            self.cr, self.uid, data, context=context)
+        return res, data
+
+    def test_missing_doctors_are_created(self):
+        res, data = self.evaluate(self.doctors)
+        self.assertTrue(res)
+        con_ids = data['con_doctor_ids'][0][2]
+        ref_ids = data['ref_doctor_ids'][0][2]
+        self.assertEqual(con_ids[1], self.existing_id)
+        doctors = self.doctor_pool.browse(self.cr, self.uid,
+                                          [con_ids[0], ref_ids[0]])
+        self.assertEqual([d.code for d in doctors],
+                         ['TESTDOC01', 'TESTDOC02'])
+        self.assertEqual(doctors[0].name, 'Doctor, Consulting')
+        self.assertEqual(doctors[0].gender, 'F')
+        self.assertEqual(doctors[1].gender, 'U')
+        self.assertEqual(doctors[0].title, doctors[1].title)
+        self.assertTrue(doctors[0].active)
+        partner = doctors[0].partner_id
+        self.assertEqual(partner.display_name, 'Doctor, Consulting')
+        self.assertEqual(partner.commercial_partner_id, partner)
+
+    def test_existing_doctors_are_reused(self):
+        first = self.evaluate(self.doctors)[1]
+        second = self.evaluate(str(self.doctors))[1]
+        self.assertEqual(first['con_doctor_ids'], second['con_doctor_ids'])
+        self.assertEqual(first['ref_doctor_ids'], second['ref_doctor_ids'])
+
+    def test_memo_is_used(self):
+        context = {'nh_doctor_memo': {}}
+        self.evaluate(self.doctors, context=context)
+        self.assertEqual(context['nh_doctor_memo']['TESTDOC00'],
+                         self.existing_id)
+
+    def test_invalid_doctors_are_not_evaluated(self):
+        self.assertFalse(self.evaluate("[(//yy3)]")[0])
+        self.assertFalse(self.evaluate("__import__('os').getcwd()")[0])
+        self.assertFalse(self.evaluate([{'type': 'c'}])[0])
+        self.assertFalse(self.evaluate([{'type': 'c',
+                                         'code': 'TESTDOC03'}])[0])
@@ -716,14 +716,17 @@ class TestLocation(common.SingleTransactionCase):
         result = self.location_pool._is_available_search(
             cr, uid, obj='nh.clinical.location', name='Location',
             args=[['is_available', '=', False]])
-        self.assertTrue(location_id in result[0][2],
+        self.assertEqual(result[0][1], 'inselect')
+        self.assertTrue(location_id in self.location_pool.search(cr, uid,
+                                                                 result),
                         msg="Location not found in unavailable locations")
 
         # Scenario 2: Search for available locations
         result = self.location_pool._is_available_search(
             cr, uid, obj='nh.clinical.location', name='Location',
             args=[['is_available', '!=', False]])
-        self.assertFalse(location_id in result[0][2],
+        self.assertFalse(location_id in self.location_pool.search(cr, uid,
+                                                                  result),
                          msg="Location found in available locations")
 
         # Scenario 3: Search for availability with not allowed operators
@@ -0,0 +1,84 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+from openerp.osv import osv
+
+
+ESTATE_CSV = """code,name,parent_code,usage,type,contexts
+TESTBULKW,Test Bulk Ward,{hospital},ward,poc,eobs
+TESTBULKBAY,Test Bulk Bay,TESTBULKW,bay,structural,eobs
+TESTBULKB1,Test Bulk Bed 1,TESTBULKBAY,bed,poc,eobs
+TESTBULKB2,Test Bulk Bed 2,TESTBULKBAY,bed,poc,eobs
+"""
+
+
+class TestLocationBulkImport(LocationTransactionCase):
+    """
+    Test the bulk estate import and re-parenting of locations.
+    """
+
+    def setUp(self):
+        super(TestLocationBulkImport, self).setUp()
+        self.location_pool = self.registry('nh.clinical.location')
+        self.location_model = self.env['nh.clinical.location']
+
+    def load_estate(self):
+        return self.location_pool.load_estate(
+            self.cr, self.uid,
+            ESTATE_CSV.format(hospital=self.hospital.code))
+
+    def test_load_estate_creates_tree(self):
+        code_ids = self.load_estate()
+        self.assertEqual(len(code_ids), 4)
+        bed = self.location_model.browse(code_ids['TESTBULKB1'])
+        self.assertEqual(bed.parent_id.code, 'TESTBULKBAY')
+        self.assertEqual(bed.parent_id.parent_id.code, 'TESTBULKW')
+        self.assertEqual(bed.full_name, 'Test Bulk Bed 1 [Test Bulk Ward]')
+        self.assertEqual(bed.pos_id, self.hospital.pos_id)
+        self.assertEqual(bed.context_ids.mapped('name'), ['eobs'])
+        self.assertTrue(bed.active)
+
+    def test_imported_locations_are_resolved_by_code(self):
+        code_ids = self.load_estate()
+        location = self.location_pool.get_cached_location(
+            self.cr, self.uid, code='TESTBULKB2')
+        self.assertEqual(location['id'], code_ids['TESTBULKB2'])
+        self.assertEqual(location['ward_id'], code_ids['TESTBULKW'])
+
+    def test_rows_in_any_order(self):
+        code_ids = self.location_pool.bulk_create(self.cr, self.uid, [
+            {'code': 'TESTBULKB1', 'parent_code': 'TESTBULKW',
+             'usage': 'bed'},
+            {'code': 'TESTBULKW', 'parent_id': self.hospital.id,
+             'usage': 'ward'}
+        ])
+        bed = self.location_model.browse(code_ids['TESTBULKB1'])
+        self.assertEqual(bed.parent_id.id, code_ids['TESTBULKW'])
+
+    def test_duplicated_code_raises(self):
+        with self.assertRaises(osv.except_osv):
+            self.location_pool.bulk_create(self.cr, self.uid, [
+                {'code': self.ward.code, 'usage': 'ward'}])
+
+    def test_missing_parent_raises(self):
+        with self.assertRaises(osv.except_osv):
+            self.location_pool.bulk_create(self.cr, self.uid, [
+                {'code': 'TESTBULKB1', 'parent_code': 'TESTBULKMISSING'}])
+
+    def test_bulk_reparent(self):
+        code_ids = self.load_estate()
+        bay_id = code_ids['TESTBULKBAY']
+        self.location_pool.bulk_reparent(self.cr, self.uid, [bay_id],
+                                         self.other_ward.id)
+        bed = self.location_model.browse(code_ids['TESTBULKB1'])
+        self.assertEqual(bed.parent_id.parent_id, self.other_ward)
+        self.assertEqual(bed.full_name, u'Test Bulk Bed 1 [{0}]'.format(
+            self.other_ward.name))
+
+    def test_bulk_reparent_under_descendant_raises(self):
+        code_ids = self.load_estate()
+        with self.assertRaises(osv.except_osv):
+            self.location_pool.bulk_reparent(
+                self.cr, self.uid, [code_ids['TESTBULKW']],
+                code_ids['TESTBULKB1'])
@@ -0,0 +1,111 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.location import LOCATION_CACHE
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+from openerp.addons.nh_clinical.versioned_cache import get_cache
+
+
+class TestLocationCache(LocationTransactionCase):
+    """
+    Test the location code/id resolution cache used by the ADT hot paths.
+    """
+
+    def setUp(self):
+        super(TestLocationCache, self).setUp()
+        self.location_pool = self.registry('nh.clinical.location')
+
+    def get_stats(self):
+        return self.location_pool.get_location_cache_stats(self.cr, self.uid)
+
+    def test_returns_location_info_by_code(self):
+        location = self.location_pool.get_cached_location(
+            self.cr, self.uid, code=self.bed.code)
+        self.assertEqual(location['id'], self.bed.id)
+        self.assertEqual(location['usage'], 'bed')
+        self.assertEqual(location['ward_id'], self.ward.id)
+        self.assertEqual(location['pos_id'], self.bed.pos_id.id)
+        self.assertEqual(location['path_ids'][:2], (self.bed.id, self.ward.id))
+
+    def test_ward_is_its_own_ward(self):
+        location = self.location_pool.get_cached_location(
+            self.cr, self.uid, location_id=self.ward.id)
+        self.assertEqual(location['ward_id'], self.ward.id)
+
+    def commit_versions(self):
+        # as if the changes of this transaction were committed
+        get_cache(self.cr, LOCATION_CACHE).pending.clear()
+
+    def test_second_lookup_is_a_hit(self):
+        self.commit_versions()
+        self.location_pool.get_by_code(self.cr, self.uid, self.ward.code)
+        hits = self.get_stats()['hits']
+        self.assertEqual(
+            self.location_pool.get_by_code(self.cr, self.uid, self.ward.code),
+            self.ward.id)
+        self.assertEqual(self.get_stats()['hits'], hits + 1)
+
+    def test_write_invalidates_cache(self):
+        old_code = self.bed.code
+        self.location_pool.get_by_code(self.cr, self.uid, old_code)
+        self.bed.write({'code': 'TESTCACHEBED'})
+        self.assertFalse(
+            self.location_pool.get_by_code(self.cr, self.uid, old_code))
+        self.assertEqual(
+            self.location_pool.get_by_code(self.cr, self.uid, 'TESTCACHEBED'),
+            self.bed.id)
+
+    def test_reparenting_updates_is_child_of(self):
+        self.assertTrue(self.location_pool.is_child_of(
+            self.cr, self.uid, self.bed.id, self.ward.code))
+        self.bed.write({'parent_id': self.other_ward.id})
+        self.assertFalse(self.location_pool.is_child_of(
+            self.cr, self.uid, self.bed.id, self.ward.code))
+        self.assertTrue(self.location_pool.is_child_of(
+            self.cr, self.uid, self.bed.id, self.other_ward.code))
+
+    def test_inactive_location_is_not_resolved(self):
+        self.bed.write({'active': False})
+        self.assertFalse(
+            self.location_pool.get_by_code(self.cr, self.uid, self.bed.code))
+
+    def test_is_child_of_unknown_code(self):
+        self.assertFalse(self.location_pool.is_child_of(
+            self.cr, self.uid, self.bed.id, 'TESTCACHEUNKNOWN'))
+
+    def test_uncommitted_change_is_not_cached(self):
+        self.commit_versions()
+        self.location_pool.get_by_code(self.cr, self.uid, self.ward.code)
+        location = self.test_utils.create_location('bed', self.ward.id)
+        stats = self.get_stats()
+        for _ in range(2):
+            self.assertEqual(self.location_pool.get_by_code(
+                self.cr, self.uid, location.code), location.id)
+        self.assertEqual(self.get_stats()['hits'], stats['hits'])
+        self.assertEqual(self.get_stats()['size'], 0)
+
+    def test_concurrent_invalidations_do_not_conflict(self):
+        cache = get_cache(self.cr, LOCATION_CACHE)
+        first_cr = self.registry.cursor()
+        second_cr = self.registry.cursor()
+        try:
+            for cr in (first_cr, second_cr):
+                cache.validate(cr)
+            cache.invalidate(first_cr)
+            cache.invalidate(second_cr)
+            first_cr.commit()
+            second_cr.commit()
+        finally:
+            first_cr.close()
+            second_cr.close()
+
+    def test_cursor_caches_after_its_own_commit(self):
+        cache = get_cache(self.cr, LOCATION_CACHE)
+        cr = self.registry.cursor()
+        try:
+            cache.invalidate(cr)
+            self.assertIsNone(cache.validate(cr))
+            cr.commit()
+            self.assertIsNotNone(cache.validate(cr))
+        finally:
+            cr.close()
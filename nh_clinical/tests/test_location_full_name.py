@@ -0,0 +1,59 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestLocationFullName(LocationTransactionCase):
+    """
+    Test the stored ``full_name`` and ``pos_id`` of locations and the
+    stored ``location_name`` of the activities at those locations.
+    """
+
+    admit_and_place_patient = True
+
+    def setUp(self):
+        super(TestLocationFullName, self).setUp()
+        self.activity_model = self.env['nh.activity']
+        self.location_model = self.env['nh.clinical.location']
+
+    def test_full_name_includes_ward_name(self):
+        self.assertEqual(self.bed.full_name,
+                         u'{0} [{1}]'.format(self.bed.name, self.ward.name))
+        self.assertEqual(self.ward.full_name, self.ward.name)
+
+    def test_renaming_ward_updates_descendants(self):
+        self.ward.write({'name': 'Test Renamed Ward'})
+        self.bed.invalidate_cache()
+        self.assertEqual(self.bed.full_name,
+                         u'{0} [Test Renamed Ward]'.format(self.bed.name))
+
+    def test_renaming_ward_updates_activity_location_name(self):
+        self.ward.write({'name': 'Test Renamed Ward'})
+        spell_activity = self.test_utils.spell_activity
+        spell_activity.invalidate_cache()
+        self.assertEqual(spell_activity.location_name,
+                         spell_activity.location_id.full_name)
+        self.assertIn('Test Renamed Ward', spell_activity.location_name)
+
+    def test_moving_bed_updates_full_name_and_pos(self):
+        self.bed.write({'parent_id': self.other_ward.id})
+        self.bed.invalidate_cache()
+        self.assertEqual(self.bed.full_name, u'{0} [{1}]'.format(
+            self.bed.name, self.other_ward.name))
+        self.assertEqual(self.bed.pos_id, self.other_ward.pos_id)
+
+    def test_location_name_is_searchable_and_sortable(self):
+        spell_activity = self.test_utils.spell_activity
+        activities = self.activity_model.search(
+            [('location_name', '=', spell_activity.location_name)],
+            order='location_name, id')
+        self.assertIn(spell_activity, activities)
+
+    def test_get_subtree_ids(self):
+        location_pool = self.registry('nh.clinical.location')
+        subtree_ids = location_pool.get_subtree_ids(
+            self.cr, self.uid, [self.ward.id])
+        self.assertIn(self.ward.id, subtree_ids)
+        self.assertIn(self.bed.id, subtree_ids)
+        self.assertNotIn(self.other_ward.id, subtree_ids)
@@ -0,0 +1,81 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.osv.orm import except_orm
+from openerp.tests.common import TransactionCase
+
+
+class TestPatientMerge(TransactionCase):
+    """
+    Test merging a patient into another one re-points every record
+    linked to the source patient.
+    """
+
+    def setUp(self):
+        super(TestPatientMerge, self).setUp()
+        self.test_utils = self.env['nh.clinical.test_utils']
+        self.test_utils.admit_and_place_patient()
+        self.test_utils.copy_instance_variables(self)
+        self.nurse = self.test_utils.nurse
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.spell_pool = self.registry('nh.clinical.spell')
+        self.into_patient = self.test_utils.create_and_register_patient()
+        self.into_patient.write({'given_name': False})
+        self.nurse.write({'following_ids': [[4, self.patient.id]]})
+
+    def merge(self):
+        return self.patient_pool.merge(
+            self.cr, self.uid, self.patient.id, self.into_patient.id)
+
+    def test_activities_and_spell_are_moved(self):
+        res = self.merge()
+        self.assertTrue(res['rows_moved']['nh_activity.patient_id'])
+        self.spell.invalidate_cache()
+        self.assertEqual(self.spell.patient_id, self.into_patient)
+        self.assertEqual(self.spell_activity.patient_id, self.into_patient)
+        self.assertEqual(self.spell_pool.get_open_spell(
+            self.cr, self.uid, self.into_patient.id),
+            (self.spell.id, self.spell_activity.id))
+        self.assertEqual(self.spell_pool.get_open_spell(
+            self.cr, self.uid, self.patient.id), (False, False))
+
+    def test_followers_are_moved(self):
+        self.merge()
+        self.into_patient.invalidate_cache()
+        self.assertIn(self.nurse, self.into_patient.follower_ids)
+        self.assertIn(self.nurse, self.spell_activity.user_ids)
+
+    def test_duplicate_followers_are_dropped(self):
+        self.nurse.write({'following_ids': [[4, self.into_patient.id]]})
+        res = self.merge()
+        self.assertTrue(res['rows_dropped'])
+        self.into_patient.invalidate_cache()
+        self.assertIn(self.nurse, self.into_patient.follower_ids)
+
+    def test_both_patients_with_started_spell(self):
+        self.test_utils.admit_patient(
+            hospital_number=self.into_patient.other_identifier,
+            patient_id=self.into_patient.id)
+        with self.assertRaises(except_orm) as error:
+            self.merge()
+        self.assertEqual(error.exception.value,
+                         'Both patients have a started spell!')
+
+    def test_missing_fields_are_copied_and_source_deactivated(self):
+        self.merge()
+        self.into_patient.invalidate_cache()
+        self.patient.invalidate_cache()
+        self.assertEqual(self.into_patient.given_name,
+                         self.patient.given_name)
+        self.assertFalse(self.patient.active)
+
+    def test_merge_records_rows_moved(self):
+        merge_pool = self.registry('nh.clinical.adt.patient.merge')
+        activity_pool = self.registry('nh.activity')
+        activity_id = merge_pool.create_activity(
+            self.cr, self.uid, {}, {
+                'source_patient_id': self.patient.id,
+                'dest_patient_id': self.into_patient.id})
+        activity_pool.complete(self.cr, self.uid, activity_id)
+        merge = activity_pool.browse(self.cr, self.uid, activity_id).data_ref
+        self.assertIn('nh_activity.patient_id', merge.rows_moved)
+        self.assertEqual(merge.source_patient_id.id, self.patient.id)
@@ -0,0 +1,53 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestPatientFollowUsers(LocationTransactionCase):
+    """
+    Test following and unfollowing patients updates the users of their
+    open activities.
+    """
+
+    admit_and_place_patient = True
+
+    def setUp(self):
+        super(TestPatientFollowUsers, self).setUp()
+        self.activity_pool = self.registry('nh.activity')
+        self.follow_pool = self.registry('nh.clinical.patient.follow')
+        self.unfollow_pool = self.registry('nh.clinical.patient.unfollow')
+        self.follower = self.test_utils.create_nurse(
+            location_id=self.test_utils.other_bed.id)
+        move_pool = self.registry('nh.clinical.patient.move')
+        self.move_activity_id = move_pool.create_activity(
+            self.cr, self.uid, {}, {
+                'patient_id': self.patient.id,
+                'location_id': self.test_utils.bed.id})
+
+    def get_user_ids(self, activity_id):
+        self.cr.execute("select user_id from activity_user_rel "
+                        "where activity_id = %s", (activity_id,))
+        return [row[0] for row in self.cr.fetchall()]
+
+    def follow(self):
+        follow_id = self.follow_pool.create_activity(
+            self.cr, self.uid, {'user_id': self.follower.id},
+            {'patient_ids': [[6, 0, [self.patient.id]]]})
+        self.activity_pool.complete(self.cr, self.uid, follow_id)
+
+    def test_follower_sees_open_activities(self):
+        self.follow()
+        self.assertIn(self.follower.id,
+                      self.get_user_ids(self.move_activity_id))
+        self.assertNotIn(self.follower.id,
+                         self.get_user_ids(self.spell_activity.id))
+
+    def test_unfollow_removes_follower(self):
+        self.follow()
+        unfollow_id = self.unfollow_pool.create_activity(
+            self.cr, self.uid, {},
+            {'patient_ids': [[6, 0, [self.patient.id]]]})
+        self.activity_pool.complete(self.cr, self.uid, unfollow_id)
+        self.assertNotIn(self.follower.id,
+                         self.get_user_ids(self.move_activity_id))
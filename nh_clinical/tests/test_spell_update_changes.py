@@ -0,0 +1,126 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+from openerp.osv.orm import except_orm
+
+
+class TestSpellUpdateChanges(LocationTransactionCase):
+    """
+    Test spell updates (A08) that change nothing are not applied.
+    """
+
+    def setUp(self):
+        super(TestSpellUpdateChanges, self).setUp()
+        self.api_pool = self.registry('nh.clinical.api')
+        self.activity_pool = self.registry('nh.activity')
+        self.update_pool = self.registry('nh.clinical.adt.spell.update')
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.data = {
+            'location': self.ward.code,
+            'code': 'TESTSPELLUPD01',
+            'start_date': '2017-01-01 09:00:00',
+            'doctors': [{
+                'type': 'c', 'code': 'TESTUPDDOC01', 'title': 'Dr',
+                'given_name': 'Consulting', 'family_name': 'Doctor'
+            }, {
+                'type': 'r', 'code': 'TESTUPDDOC02', 'title': 'Dr',
+                'given_name': 'Referring', 'family_name': 'Doctor'
+            }]
+        }
+        self.api_pool.register(self.cr, self.uid, 'TESTUPD01', {
+            'family_name': 'Smith', 'given_name': 'John'})
+        self.api_pool.admit(self.cr, self.uid, 'TESTUPD01',
+                            dict(self.data))
+        self.patient_id = self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTUPD01')[0]
+
+    def update(self, changes=None, mode='audit'):
+        data = dict(self.data, **(changes or {}))
+        return self.api_pool.admit_update(
+            self.cr, self.uid, 'TESTUPD01', data,
+            context={'nh_adt_noop_spell_update': mode})
+
+    def count_updates(self):
+        return len(self.activity_pool.search(self.cr, self.uid, [
+            ['data_model', '=', 'nh.clinical.adt.spell.update'],
+            ['patient_id', '=', self.patient_id]]))
+
+    def count_noop_updates(self):
+        self.cr.execute("""
+            select count(*) from nh_clinical_adt_spell_update_noop
+            where patient_id = %s
+        """, (self.patient_id,))
+        return self.cr.fetchone()[0]
+
+    def get_changes(self, changes=None):
+        data = dict(self.data, **(changes or {}))
+        return self.update_pool.get_spell_changes(
+            self.cr, self.uid, self.patient_id, data)[1]
+
+    def test_unchanged_spell(self):
+        self.assertEqual(self.get_changes(), [])
+
+    def test_changed_values(self):
+        self.assertEqual(self.get_changes({'code': 'TESTSPELLUPD02'}),
+                         ['code'])
+        self.assertEqual(
+            self.get_changes({'start_date': '2017-01-02 09:00:00'}),
+            ['start_date'])
+        self.assertEqual(self.get_changes({'doctors': []}), ['doctors'])
+        self.assertEqual(self.get_changes({'doctors': [{
+            'type': 'c', 'code': 'TESTUPDDOC03', 'title': 'Dr',
+            'given_name': 'New', 'family_name': 'Doctor'}]}), ['doctors'])
+
+    def test_doctors_of_a_missing_type_are_kept(self):
+        self.assertEqual(
+            self.get_changes({'doctors': self.data['doctors'][:1]}), [])
+
+    def test_location_changes(self):
+        self.assertEqual(self.get_changes({'location': self.bed.code}),
+                         ['location'])
+        self.assertEqual(
+            self.get_changes({'location': self.other_ward.code}),
+            ['location'])
+
+    def test_noop_update_is_audited(self):
+        counters = self.update_pool.get_update_counters(self.cr, self.uid)
+        self.assertTrue(self.update())
+        self.assertEqual(self.count_updates(), 0)
+        self.assertEqual(self.count_noop_updates(), 1)
+        self.assertEqual(
+            self.update_pool.get_update_counters(
+                self.cr, self.uid)['skipped'], counters['skipped'] + 1)
+
+    def test_noop_update_is_skipped(self):
+        self.update(mode='skip')
+        self.assertEqual(self.count_updates(), 0)
+        self.assertEqual(self.count_noop_updates(), 0)
+
+    def test_noop_update_is_applied(self):
+        self.update(mode='apply')
+        self.assertEqual(self.count_updates(), 1)
+
+    def test_changed_update_is_applied(self):
+        counters = self.update_pool.get_update_counters(self.cr, self.uid)
+        self.update({'code': 'TESTSPELLUPD02'})
+        self.assertEqual(self.count_updates(), 1)
+        self.assertEqual(self.count_noop_updates(), 0)
+        self.assertEqual(
+            self.update_pool.get_update_counters(
+                self.cr, self.uid)['applied'], counters['applied'] + 1)
+
+    def test_noop_update_needs_access_rights(self):
+        user_id = self.registry('res.users').create(self.cr, self.uid, {
+            'name': 'Test Update User', 'login': 'testupduser'})
+        with self.assertRaises(except_orm):
+            self.update_pool.should_apply(
+                self.cr, user_id, self.patient_id, dict(self.data),
+                context={'nh_adt_noop_spell_update': 'skip'})
+
+    def test_noop_update_needs_pos(self):
+        self.registry('res.users').write(self.cr, self.uid, self.uid, {
+            'pos_ids': [[5]]})
+        with self.assertRaises(except_orm):
+            self.update(mode='skip')
+        self.assertEqual(self.count_noop_updates(), 0)
@@ -0,0 +1,72 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestTransferPipeline(LocationTransactionCase):
+    """
+    Test the ADT transfer chain resolves its data once and moves the
+    patient as the activity by activity chain did.
+    """
+
+    def setUp(self):
+        super(TestTransferPipeline, self).setUp()
+        self.api_pool = self.registry('nh.clinical.api')
+        self.activity_pool = self.registry('nh.activity')
+        self.patient_pool = self.registry('nh.clinical.patient')
+        self.spell_pool = self.registry('nh.clinical.spell')
+        self.api_pool.register(self.cr, self.uid, 'TESTTRANS01', {
+            'family_name': 'Smith', 'given_name': 'John'})
+        self.patient_id = self.patient_pool.resolve_patient(
+            self.cr, self.uid, hospital_number='TESTTRANS01')[0]
+
+    def get_activity(self, data_model):
+        activity_ids = self.activity_pool.search(self.cr, self.uid, [
+            ['patient_id', '=', self.patient_id],
+            ['data_model', '=', data_model]], order='id desc', limit=1)
+        return self.activity_pool.browse(self.cr, self.uid, activity_ids[0])
+
+    def transfer(self, data):
+        self.api_pool.transfer(self.cr, self.uid, 'TESTTRANS01', data)
+        spell_id = self.spell_pool.get_open_spell(
+            self.cr, self.uid, self.patient_id)[0]
+        return self.spell_pool.browse(self.cr, self.uid, spell_id)
+
+    def test_transfer_moves_the_patient(self):
+        self.api_pool.admit(self.cr, self.uid, 'TESTTRANS01', {
+            'location': self.ward.code})
+        spell = self.transfer({'location': self.other_ward.code})
+        self.assertEqual(spell.location_id, self.other_ward)
+        self.assertEqual(spell.activity_id.location_id, self.other_ward)
+        transfer = self.get_activity('nh.clinical.patient.transfer')
+        self.assertEqual(transfer.state, 'completed')
+        self.assertEqual(transfer.data_ref.origin_loc_id, self.ward)
+        move = self.get_activity('nh.clinical.patient.move')
+        self.assertEqual(move.state, 'completed')
+        self.assertEqual(move.creator_id, transfer)
+        for activity in [transfer, move]:
+            self.assertEqual(activity.parent_id, spell.activity_id)
+            self.assertEqual(activity.spell_activity_id, spell.activity_id)
+            self.assertEqual(activity.location_id, self.other_ward)
+            self.assertEqual(activity.pos_id, spell.activity_id.pos_id)
+            user_ids = self.registry(
+                activity.data_model).get_activity_user_ids(
+                self.cr, self.uid, activity.id)
+            self.assertEqual(sorted(u.id for u in activity.user_ids),
+                             sorted(user_ids))
+
+    def test_transfer_admits_to_the_origin(self):
+        spell = self.transfer({'location': self.other_ward.code,
+                               'original_location': self.ward.code})
+        self.assertEqual(spell.location_id, self.other_ward)
+        admission = self.get_activity('nh.clinical.patient.admission')
+        self.assertEqual(admission.location_id, self.ward)
+        self.assertEqual(admission.parent_id, spell.activity_id)
+        transfer = self.get_activity('nh.clinical.adt.patient.transfer')
+        self.assertEqual(transfer.parent_id, spell.activity_id)
+        self.assertEqual(transfer.data_ref.origin_location_id, self.ward)
+
+    def test_transfer_without_spell_or_origin(self):
+        with self.assertRaises(Exception):
+            self.transfer({'location': self.other_ward.code})
@@ -0,0 +1,95 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+from openerp.addons.nh_clinical.user import USER_CONTEXT_CACHE
+from openerp.addons.nh_clinical.versioned_cache import get_cache
+from openerp.osv.orm import except_orm
+
+
+class TestUserContext(LocationTransactionCase):
+    """
+    Test the user context cache used by the ADT submit methods.
+    """
+
+    def setUp(self):
+        super(TestUserContext, self).setUp()
+        self.user_pool = self.registry('res.users')
+        self.group_pool = self.registry('res.groups')
+        self.adt_uid = self.user_pool.create(self.cr, self.uid, {
+            'name': 'Test ADT', 'login': 'testusercontext',
+            'pos_id': self.pos.id, 'pos_ids': [[6, 0, [self.pos.id]]],
+            'tz': 'Europe/London'})
+
+    def get_user_context(self):
+        return self.user_pool.get_user_context(self.cr, self.adt_uid)
+
+    def get_stats(self):
+        return self.user_pool.get_user_context_cache_stats(self.cr, self.uid)
+
+    def test_returns_user_context(self):
+        user = self.user_pool.browse(self.cr, self.uid, self.adt_uid)
+        user_context = self.get_user_context()
+        self.assertEqual(user_context['id'], self.adt_uid)
+        self.assertEqual(user_context['login'], 'testusercontext')
+        self.assertEqual(user_context['tz'], 'Europe/London')
+        self.assertEqual(user_context['pos_id'], self.pos.id)
+        self.assertEqual(user_context['pos_ids'], (self.pos.id,))
+        self.assertEqual(user_context['pos_location_ids'],
+                         (self.hospital.id,))
+        self.assertEqual(sorted(user_context['group_ids']),
+                         sorted(g.id for g in user.groups_id))
+
+    def test_unknown_user(self):
+        self.assertFalse(self.user_pool.get_user_context(
+            self.cr, self.uid, user_id=-1))
+
+    def test_second_lookup_is_a_hit(self):
+        # as if the changes of this transaction were committed
+        get_cache(self.cr, USER_CONTEXT_CACHE).pending.clear()
+        self.get_user_context()
+        hits = self.get_stats()['hits']
+        self.get_user_context()
+        self.assertEqual(self.get_stats()['hits'], hits + 1)
+
+    def test_user_write_invalidates_cache(self):
+        self.get_user_context()
+        self.user_pool.write(self.cr, self.uid, self.adt_uid, {
+            'pos_ids': [[5]], 'tz': 'Europe/Paris'})
+        user_context = self.get_user_context()
+        self.assertEqual(user_context['pos_ids'], ())
+        self.assertEqual(user_context['tz'], 'Europe/Paris')
+
+    def test_partner_tz_write_invalidates_cache(self):
+        # as if the changes of this transaction were committed
+        get_cache(self.cr, USER_CONTEXT_CACHE).pending.clear()
+        self.get_user_context()
+        user = self.user_pool.browse(self.cr, self.uid, self.adt_uid)
+        user.partner_id.write({'tz': 'Europe/Paris'})
+        self.assertEqual(self.get_user_context()['tz'], 'Europe/Paris')
+
+    def test_group_write_invalidates_cache(self):
+        group_id = self.group_pool.create(self.cr, self.uid, {
+            'name': 'Test User Context Group'})
+        self.get_user_context()
+        self.group_pool.write(self.cr, self.uid, group_id, {
+            'users': [[4, self.adt_uid]]})
+        self.assertIn(group_id, self.get_user_context()['group_ids'])
+
+    def test_pos_write_invalidates_cache(self):
+        self.get_user_context()
+        ward = self.test_utils.ward
+        self.pos.write({'location_id': ward.id})
+        self.assertEqual(self.get_user_context()['pos_location_ids'],
+                         (ward.id,))
+
+    def test_adt_submit_without_pos(self):
+        self.get_user_context()
+        self.user_pool.write(self.cr, self.uid, self.adt_uid,
+                             {'pos_ids': [[5]]})
+        transfer_pool = self.registry('nh.clinical.adt.patient.transfer')
+        with self.assertRaises(except_orm) as error:
+            transfer_pool.resolve_transfer(self.cr, self.adt_uid, {
+                'location': self.test_utils.ward.code,
+                'other_identifier': 'TESTUSERCTX01'})
+        self.assertEqual(error.exception.name, 'POS Missing Error!')
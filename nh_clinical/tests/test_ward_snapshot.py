@@ -0,0 +1,124 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+from openerp.addons.nh_clinical.tests.common.transaction_case import \
+    LocationTransactionCase
+
+
+class TestWardSnapshot(LocationTransactionCase):
+    """
+    Test the cached ward bed board snapshots.
+    """
+
+    admit_and_place_patient = True
+
+    def setUp(self):
+        super(TestWardSnapshot, self).setUp()
+        self.location_pool = self.registry('nh.clinical.location')
+
+    def get_snapshot(self, ward_id=None):
+        ward_id = ward_id or self.ward.id
+        return self.location_pool.get_ward_snapshot(
+            self.cr, self.uid, [ward_id])[ward_id]
+
+    def get_bed(self, snapshot, bed_id):
+        return [b for b in snapshot['beds'] if b['id'] == bed_id][0]
+
+    def test_snapshot_contains_occupied_bed(self):
+        snapshot = self.get_snapshot()
+        bed = self.get_bed(snapshot, self.bed.id)
+        self.assertFalse(bed['is_available'])
+        self.assertEqual(bed['patient']['id'], self.patient.id)
+        self.assertEqual(bed['spell_activity_id'], self.spell_activity.id)
+        self.assertEqual(snapshot['available_bed_count'],
+                         snapshot['bed_count'] - 1)
+
+    def test_snapshot_contains_allocated_nurse(self):
+        self.test_utils.nurse.write({'location_ids': [[4, self.bed.id]]})
+        snapshot = self.get_snapshot()
+        self.assertIn(self.test_utils.nurse.id, snapshot['nurse_ids'])
+        self.assertIn(self.test_utils.nurse.id,
+                      self.get_bed(snapshot, self.bed.id)['nurse_ids'])
+
+    def test_unchanged_ward_is_served_from_cache(self):
+        self.get_snapshot()
+        hits = self.location_pool.get_ward_snapshot_stats(
+            self.cr, self.uid)['hits']
+        self.get_snapshot()
+        self.assertEqual(
+            self.location_pool.get_ward_snapshot_stats(
+                self.cr, self.uid)['hits'], hits + 1)
+
+    def test_discharge_updates_snapshot(self):
+        version = self.get_snapshot()['version']
+        self.test_utils.discharge_patient()
+        snapshot = self.get_snapshot()
+        self.assertNotEqual(snapshot['version'], version)
+        self.assertTrue(self.get_bed(snapshot, self.bed.id)['is_available'])
+
+    def test_placement_is_listed_as_waiting(self):
+        self.test_utils.discharge_patient()
+        self.test_utils.admit_patient()
+        placement_id = self.test_utils.create_placement()
+        waiting = self.get_snapshot()['waiting_placements']
+        self.assertIn(placement_id, [w['activity_id'] for w in waiting])
+
+    def test_bump_inserts_a_newer_version(self):
+        version = self.get_snapshot()['version']
+        self.location_pool.bump_ward_versions(self.cr, self.uid,
+                                              [self.bed.id])
+        bumped = self.get_snapshot()['version']
+        self.assertGreater(bumped, version)
+        self.location_pool.prune_ward_versions(self.cr, self.uid)
+        self.cr.execute("select max(version), count(*) "
+                        "from nh_clinical_ward_version "
+                        "where ward_id = %s", (self.ward.id,))
+        pruned = self.get_snapshot()['version']
+        self.assertEqual(self.cr.fetchone(), pruned)
+        self.assertNotEqual(pruned, bumped)
+
+    def test_move_bumps_both_wards_once(self):
+        other_ward = self.test_utils.other_ward
+        self.cr.execute("select count(*) from nh_clinical_ward_version "
+                        "where ward_id in %s",
+                        ((self.ward.id, other_ward.id),))
+        count = self.cr.fetchone()[0]
+        versions = [self.get_snapshot(ward_id)['version']
+                    for ward_id in [self.ward.id, other_ward.id]]
+        self.registry('nh.activity').write(
+            self.cr, self.uid, self.spell_activity.id,
+            {'location_id': other_ward.id})
+        self.cr.execute("select count(*) from nh_clinical_ward_version "
+                        "where ward_id in %s",
+                        ((self.ward.id, other_ward.id),))
+        self.assertEqual(self.cr.fetchone()[0], count + 2)
+        for ward_id, version in zip([self.ward.id, other_ward.id],
+                                    versions):
+            self.assertGreater(self.get_snapshot(ward_id)['version'],
+                               version)
+
+    def test_lower_version_committed_last_changes_the_version(self):
+        first_cr = self.registry.cursor()
+        second_cr = self.registry.cursor()
+        reader_cr = self.registry.cursor()
+        ward_id = self.location_pool.create(first_cr, self.uid, {
+            'name': 'Test Version Ward', 'code': 'TESTVERSIONWARD',
+            'usage': 'ward'})
+        first_cr.commit()
+        try:
+            self.location_pool.bump_ward_versions(first_cr, self.uid,
+                                                  [ward_id])
+            self.location_pool.bump_ward_versions(second_cr, self.uid,
+                                                  [ward_id])
+            second_cr.commit()
+            version = self.location_pool.get_ward_snapshot(
+                reader_cr, self.uid, [ward_id])[ward_id]['version']
+            reader_cr.commit()
+            first_cr.commit()
+            self.assertNotEqual(self.location_pool.get_ward_snapshot(
+                reader_cr, self.uid, [ward_id])[ward_id]['version'], version)
+        finally:
+            first_cr.rollback()
+            self.location_pool.unlink(first_cr, self.uid, [ward_id])
+            first_cr.commit()
+            for cr in (first_cr, second_cr, reader_cr):
+                cr.close()
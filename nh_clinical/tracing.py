@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+"""
+``tracing.py`` defines an opt-in tracing facility for ADT messages. A
+trace is a tree of spans, one per traced method call, with the wall
+time and the number and time of the SQL statements of every span.
+
+Tracing is enabled with the ``nh_adt_tracing`` server option or context
+key, set to ``'log'`` to log every trace as JSON or to ``'table'`` to
+store them in :class:`nh_clinical_adt_trace`. Traces of failed calls are
+always logged.
+"""
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+import uuid
+
+from openerp import tools
+from openerp.osv import fields, osv
+
+_logger = logging.getLogger(__name__)
+
+#: Accepted values of the ``nh_adt_tracing`` option
+TRACE_EXPORTS = ('log', 'table')
+#: How long traces are kept in :class:`nh_clinical_adt_trace`
+TRACE_RETENTION = '7 days'
+
+_local = threading.local()
+
+
+class Span(object):
+    """
+    A traced method call. SQL statements are counted on the innermost
+    open span and added up to the parents when the span is exported.
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.children = []
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.error = None
+        self.duration = 0.0
+        self.start = time.time()
+        if parent is not None:
+            parent.children.append(self)
+
+    def close(self, error=None):
+        self.duration = time.time() - self.start
+        self.error = error
+
+    def to_dict(self):
+        children = [child.to_dict() for child in self.children]
+        res = {
+            'name': self.name,
+            'duration_ms': round(self.duration * 1000, 3),
+            'sql_count': self.sql_count + sum(
+                child['sql_count'] for child in children),
+            'sql_ms': round(self.sql_time * 1000 + sum(
+                child['sql_ms'] for child in children), 3)
+        }
+        if self.error:
+            res['error'] = self.error
+        if children:
+            res['children'] = children
+        return res
+
+
+class Trace(object):
+    """
+    Span tree of a traced call, recorded in the current thread. The
+    statements are measured by wrapping ``execute`` on the cursor for
+    the duration of the trace.
+    """
+
+    def __init__(self, cr, name, correlation_id):
+        self.cr = cr
+        self.correlation_id = correlation_id
+        self.root = Span(name)
+        self.stack = [self.root]
+        self._execute = cr.execute
+        cr.execute = self.execute
+
+    def execute(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self._execute(*args, **kwargs)
+        finally:
+            span = self.stack[-1]
+            span.sql_count += 1
+            span.sql_time += time.time() - start
+
+    def call(self, name, method, args, kwargs):
+        span = Span(name, parent=self.stack[-1])
+        self.stack.append(span)
+        try:
+            res = method(*args, **kwargs)
+        except Exception as e:
+            span.close(error=tools.ustr(e))
+            raise
+        finally:
+            self.stack.pop()
+        span.close()
+        return res
+
+    def close(self, error=None):
+        del self.cr.execute
+        self.root.close(error=error)
+
+    def to_dict(self):
+        return dict(self.root.to_dict(), correlation_id=self.correlation_id)
+
+
+def get_call_context(method, args, kwargs):
+    """
+    Gets the context of an old API method call, whether it is passed by
+    keyword or by position. Decorators setting ``__wrapped__`` on their
+    wrapper (as :func:`traced` does) are looked through to find the
+    signature of the method.
+
+    :param args: arguments of the call after ``self``, ``cr`` and ``uid``
+    :type args: tuple
+    :param kwargs: keyword arguments of the call
+    :type kwargs: dict
+    :returns: the context, ``None`` if there is none
+    :rtype: dict
+    """
+    if kwargs.get('context') is not None:
+        return kwargs['context']
+    while hasattr(method, '__wrapped__'):
+        method = method.__wrapped__
+    arg_names = inspect.getargspec(method).args
+    if 'context' not in arg_names:
+        return None
+    index = arg_names.index('context') - 3
+    return args[index] if 0 <= index < len(args) else None
+
+
+def traced(root=False):
+    """
+    Decorator for old API methods recording their calls as spans of the
+    current trace.
+
+    :param root: whether a call can start a trace, when none is being
+        recorded and tracing is enabled. The correlation id of the trace
+        is the ``nh_trace_id`` context key, the ``message_id`` of the
+        call or a new unique id.
+    :type root: bool
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, cr, uid, *args, **kwargs):
+            name = '%s.%s' % (self._name, method.__name__)
+            trace = getattr(_local, 'trace', None)
+            if trace is not None:
+                return trace.call(name, method, (self, cr, uid) + args,
+                                  kwargs)
+            if not root:
+                return method(self, cr, uid, *args, **kwargs)
+            context = get_call_context(method, args, kwargs) or {}
+            export = context.get('nh_adt_tracing',
+                                 tools.config.get('nh_adt_tracing'))
+            if export not in TRACE_EXPORTS:
+                return method(self, cr, uid, *args, **kwargs)
+            correlation_id = context.get('nh_trace_id') or \
+                kwargs.get('message_id') or uuid.uuid4().hex
+            trace = _local.trace = Trace(cr, name, correlation_id)
+            try:
+                res = method(self, cr, uid, *args, **kwargs)
+            except Exception as e:
+                trace.close(error=tools.ustr(e))
+                # the transaction is rolled back or aborted, so failed
+                # calls are always logged
+                export_trace(cr, uid, trace, 'log')
+                raise
+            else:
+                trace.close()
+                export_trace(cr, uid, trace, export)
+            finally:
+                _local.trace = None
+            return res
+        wrapper.__wrapped__ = method
+        return wrapper
+    return decorator
+
+
+def export_trace(cr, uid, trace, export):
+    """
+    Exports a closed trace to the log, as JSON, or to
+    :class:`nh_clinical_adt_trace`.
+    """
+    spans = trace.to_dict()
+    if export == 'log':
+        _logger.info(json.dumps(spans))
+        return
+    cr.execute("""
+        insert into nh_clinical_adt_trace
+            (correlation_id, name, duration_ms, sql_count, sql_ms, error,
+             spans, create_uid, create_date, write_uid, write_date)
+        values (%s, %s, %s, %s, %s, %s, %s, %s, now() at time zone 'UTC',
+                %s, now() at time zone 'UTC')
+    """, (trace.correlation_id, spans['name'], spans['duration_ms'],
+          spans['sql_count'], spans['sql_ms'], spans.get('error'),
+          json.dumps(spans), uid, uid))
+
+
+class nh_clinical_adt_trace(osv.Model):
+    """
+    Trace of an ADT message, stored when the ``nh_adt_tracing`` option
+    is ``'table'``. The totals of the root span are stored in columns
+    and the whole span tree as JSON in ``spans``.
+    """
+
+    _name = 'nh.clinical.adt.trace'
+    _description = 'ADT Message Trace'
+    _order = 'id desc'
+
+    _columns = {
+        'correlation_id': fields.char('Correlation Id', size=100,
+                                      select=True, readonly=True),
+        'name': fields.char('Method', size=256, readonly=True),
+        'duration_ms': fields.float('Duration (ms)', readonly=True),
+        'sql_count': fields.integer('SQL Statements', readonly=True),
+        'sql_ms': fields.float('SQL Time (ms)', readonly=True),
+        'error': fields.text('Error', readonly=True),
+        'spans': fields.text('Spans', readonly=True,
+                             help="JSON encoded span tree"),
+        'create_date': fields.datetime('Create Date', readonly=True,
+                                       select=True)
+    }
+
+    def prune(self, cr, uid, context=None):
+        """
+        Removes the traces older than ``TRACE_RETENTION``. Called by the
+        ``ir_cron_prune_adt_traces`` scheduled action.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        cr.execute("""
+            delete from nh_clinical_adt_trace
+            where create_date < now() at time zone 'UTC' - interval %s
+        """, (TRACE_RETENTION,))
+        _logger.debug("%s ADT traces removed.", cr.rowcount)
+        return True
@@ -3,15 +3,25 @@
 """
 Extends Odoo's res_users.
 """
+import ast
 import logging
 import re
 
 from openerp import SUPERUSER_ID, api
 from openerp.osv import orm, fields, osv
 
+from .tracing import traced
+from .versioned_cache import ensure_version_table, get_cache
 
 _logger = logging.getLogger(__name__)
 
+#: Name of the user context cache, see :meth:`res_users.get_user_context`
+USER_CONTEXT_CACHE = 'nh.clinical.user.context'
+#: User fields that change what the user context cache holds
+USER_CONTEXT_FIELDS = ['login', 'tz', 'pos_id', 'pos_ids', 'groups_id']
+#: Prefixes of the reified group fields of the user form
+REIFIED_GROUP_PREFIXES = ('in_group_', 'sel_groups_')
+
 
 class res_users(orm.Model):
     """
@@ -226,6 +236,9 @@ class res_users(orm.Model):
                 cr, user, vals['doctor_id'], {'user_id': res}, context=context)
         if 'groups_id' in vals:
             self.update_doctor_status(cr, user, res, context=context)
+        if vals.get('location_ids'):
+            self.pool['nh.clinical.spell'].refresh_transferred_access(
+                cr, SUPERUSER_ID, user_ids=[res], context=context)
         return res
 
     def write(self, cr, uid, ids, values, context=None):
@@ -245,14 +258,147 @@ class res_users(orm.Model):
             self.update_group_vals(cr, uid, ids[0], values, context=context)
         elif isinstance(ids, int):
             self.update_group_vals(cr, uid, ids, values, context=context)
+        allocation_change = 'location_ids' in values or 'groups_id' in values
+        location_ids = self._get_allocated_location_ids(cr, ids) \
+            if allocation_change else []
         res = super(res_users, self).write(cr, uid, ids, values, context)
+        if allocation_change:
+            self._bump_ward_versions(cr, uid, ids, location_ids=location_ids,
+                                     context=context)
         if values.get('location_ids') or values.get('groups_id'):
             activity_pool = self.pool['nh.activity']
             activity_pool.update_users(cr, uid, ids)
+        if 'location_ids' in values:
+            self.pool['nh.clinical.spell'].refresh_transferred_access(
+                cr, SUPERUSER_ID, user_ids=ids, context=context)
         if 'groups_id' in values:
             self.update_doctor_status(cr, uid, ids, context=context)
+        if set(values) & set(USER_CONTEXT_FIELDS) or any(
+                key.startswith(REIFIED_GROUP_PREFIXES) for key in values):
+            self.invalidate_user_context_cache(cr, uid, context=context)
         return res
 
+    def init(self, cr):
+        ensure_version_table(cr, USER_CONTEXT_CACHE)
+
+    def get_user_context(self, cr, uid, user_id=None, context=None):
+        """
+        Gets what the ADT and operations code needs to know about a user
+        through a per registry cache shared by all workers (see
+        :mod:`versioned_cache<versioned_cache>`), so the service account
+        sending ADT messages is not read on every message. The cache is
+        invalidated whenever the login, timezone, POS or groups of a
+        user, the users of a group or a POS location change.
+
+        :param user_id: user id. ``uid`` if not provided
+        :type user_id: int
+        :returns: dictionary with the ``id``, ``login``, ``tz``,
+            ``pos_id``, ``pos_ids``, ``pos_location_ids`` (the location
+            of every POS in ``pos_ids``, in the same order) and
+            ``group_ids`` (implied groups included) of the user.
+            ``False`` if there is no such user.
+        :rtype: dict or bool
+        """
+
+        user_id = user_id or uid
+        cache = get_cache(cr, USER_CONTEXT_CACHE)
+        version = cache.validate(cr)
+        user_context = cache.get(version, user_id)
+        if user_context is None:
+            user_context = self._read_user_context(cr, user_id)
+            if user_context:
+                cache.set(version, user_id, user_context)
+        return dict(user_context) if user_context else False
+
+    def _read_user_context(self, cr, user_id):
+        """
+        Reads the user context of a user in one query.
+
+        :returns: see :meth:`get_user_context`
+        :rtype: dict or bool
+        """
+
+        cr.execute("""
+            select users.id, users.login, partner.tz, users.pos_id,
+                array(
+                    select pos.id from user_pos_rel rel
+                    inner join nh_clinical_pos pos on pos.id = rel.pos_id
+                    where rel.user_id = users.id order by pos.id
+                ) as pos_ids,
+                array(
+                    select pos.location_id from user_pos_rel rel
+                    inner join nh_clinical_pos pos on pos.id = rel.pos_id
+                    where rel.user_id = users.id order by pos.id
+                ) as pos_location_ids,
+                array(
+                    select rel.gid from res_groups_users_rel rel
+                    where rel.uid = users.id order by rel.gid
+                ) as group_ids
+            from res_users users
+            inner join res_partner partner on partner.id = users.partner_id
+            where users.id = %s
+        """, (user_id,))
+        row = cr.dictfetchone()
+        if not row:
+            return False
+        return {
+            'id': row['id'],
+            'login': row['login'],
+            'tz': row['tz'] or False,
+            'pos_id': row['pos_id'] or False,
+            'pos_ids': tuple(row['pos_ids']),
+            'pos_location_ids': tuple(row['pos_location_ids']),
+            'group_ids': tuple(row['group_ids'])
+        }
+
+    def get_user_context_cache_stats(self, cr, uid, context=None):
+        """
+        :returns: ``hits``, ``misses``, ``size`` and ``version`` of the
+            user context cache for this registry
+        :rtype: dict
+        """
+        return get_cache(cr, USER_CONTEXT_CACHE).stats()
+
+    def invalidate_user_context_cache(self, cr, uid, context=None):
+        """
+        Invalidates the user context cache for every worker once the
+        current transaction is committed.
+
+        :returns: ``True``
+        :rtype: bool
+        """
+        get_cache(cr, USER_CONTEXT_CACHE).invalidate(cr)
+        return True
+
+    def _get_allocated_location_ids(self, cr, ids):
+        """
+        Gets the locations the users are allocated to.
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return []
+        cr.execute("""
+            select distinct location_id from user_location_rel
+            where user_id in %s
+        """, (tuple(ids),))
+        return [row[0] for row in cr.fetchall()]
+
+    def _bump_ward_versions(self, cr, uid, ids, location_ids=None,
+                            context=None):
+        """
+        Bumps the version of the wards the users are allocated to (and of
+        the wards of ``location_ids``), as allocated staff is shown in the
+        ward bed boards (see
+        :meth:`get_ward_snapshot<base.nh_clinical_location.get_ward_snapshot>`).
+        """
+        location_ids = list(set(
+            self._get_allocated_location_ids(cr, ids) + (location_ids or [])))
+        if location_ids:
+            self.pool['nh.clinical.location'].bump_ward_versions(
+                cr, uid, location_ids, context=context)
+        return True
+
     def name_get(self, cr, uid, ids, context=None):
         """
         Gets the names of users.
@@ -441,11 +587,15 @@ class nh_clinical_doctor(orm.Model):
                 context=context)
         return res
 
+    @traced()
     def evaluate_doctors_dict(self, cr, uid, data, context=None):
         """
         Evaluates doctors, checking for a doctor before creating a new
         doctor if it doesn't exist.
 
+        The doctors are parsed without evaluating any code and resolved
+        by code with a single query (see :meth:`get_doctor_ids`).
+
         :param data: must contain ``doctors`` key. Its value will be a
             list of dictionaries which must contain the keys ``code``,
             ``gender``, ``gmc`` and ``type``. It many contain ``title``.
@@ -459,51 +609,149 @@ class nh_clinical_doctor(orm.Model):
             _logger.warn("Trying to evaluate doctors dictionary without "
                          "doctors data!")
             return False
-        else:
-            try:
-                doctors = eval(str(data['doctors']))
-                patient_pool = self.pool['nh.clinical.patient']
-                ref_doctor_ids = []
-                con_doctor_ids = []
-                for d in doctors:
-                    doctor_id = self.search(
-                        cr, uid, [['code', '=', d.get('code')]],
-                        context=context)
-                    if not doctor_id:
-                        title_id = False
-                        if 'title' in d.keys():
-                            title_pool = self.pool['res.partner.title']
-                            title_id = title_pool.get_title_by_name(
-                                cr, uid, d['title'], context=context)
-                        doctor = {
-                            'name': patient_pool._get_fullname(d),
-                            'title': title_id,
-                            'code': d.get('code'),
-                            'gender': d.get('gender'),
-                            'gmc': d.get('gmc')
-                        }
-                        doctor_id = self.create(
-                            cr, uid, doctor, context=context)
-                    else:
-                        if len(doctor_id) > 1:
-                            _logger.warn("More than one doctor found with "
-                                         "code '%s' passed id=%s" %
-                                         (d.get('code'), doctor_id[0]))
-                        doctor_id = doctor_id[0]
-                    if d['type'] == 'r':
-                        ref_doctor_ids.append(doctor_id)
-                    else:
-                        con_doctor_ids.append(doctor_id)
-                ref_doctor_ids and data.update(
-                    {'ref_doctor_ids': [[6, False, ref_doctor_ids]]})
-                con_doctor_ids and data.update(
-                    {'con_doctor_ids': [[6, False, con_doctor_ids]]})
-            except:
-                _logger.warn("Can't evaluate 'doctors': %s" %
-                             (data['doctors']))
-                return False
+        try:
+            doctors = self._parse_doctors(data['doctors'])
+            doctor_ids = self.get_doctor_ids(cr, uid, doctors,
+                                             context=context)
+        except (ValueError, SyntaxError, osv.except_osv) as e:
+            _logger.warn("Can't evaluate 'doctors': %s (%s)",
+                         data['doctors'], e)
+            return False
+        ref_doctor_ids = [doctor_ids[d['code']] for d in doctors
+                          if d['type'] == 'r']
+        con_doctor_ids = [doctor_ids[d['code']] for d in doctors
+                          if d['type'] != 'r']
+        ref_doctor_ids and data.update(
+            {'ref_doctor_ids': [[6, False, ref_doctor_ids]]})
+        con_doctor_ids and data.update(
+            {'con_doctor_ids': [[6, False, con_doctor_ids]]})
         return True
 
+    def _parse_doctors(self, doctors):
+        """
+        Parses the ``doctors`` of an ADT message, given either as a list
+        or as its string representation.
+
+        :returns: doctors
+        :rtype: list
+        :raises: :class:`ValueError` or :class:`SyntaxError` if the
+            doctors are not a list of dictionaries with a ``code`` and
+            a ``type``
+        """
+        if isinstance(doctors, basestring):
+            doctors = ast.literal_eval(doctors)
+        if not isinstance(doctors, (list, tuple)):
+            raise ValueError("doctors must be a list")
+        for d in doctors:
+            if not isinstance(d, dict) or not d.get('code') or \
+                    'type' not in d:
+                raise ValueError("every doctor needs a code and a type")
+        return list(doctors)
+
+    def get_doctor_ids(self, cr, uid, doctors, context=None):
+        """
+        Resolves the doctors of an ADT message by code with a single
+        query, creating the missing ones at once (see
+        :meth:`_create_doctors`). Resolved codes are memoised in
+        ``context['nh_doctor_memo']`` when the caller provides one, e.g.
+        for a whole :meth:`process_batch<api.nh_clinical_api.process_batch>`.
+
+        :param doctors: doctors as parsed by :meth:`_parse_doctors`
+        :type doctors: list
+        :returns: doctor id by code
+        :rtype: dict
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if a
+            missing doctor has no full name
+        """
+        memo = context.get('nh_doctor_memo') \
+            if isinstance(context, dict) else None
+        if memo is None:
+            memo = {}
+        codes = set(d['code'] for d in doctors) - set(memo)
+        if codes:
+            cr.execute("""
+                select doctor.code, array_agg(doctor.id order by doctor.id)
+                from nh_clinical_doctor doctor
+                inner join res_partner partner
+                    on partner.id = doctor.partner_id
+                where doctor.code in %s and partner.active = true
+                group by doctor.code
+            """, (tuple(codes),))
+            for code, ids in cr.fetchall():
+                if len(ids) > 1:
+                    _logger.warn("More than one doctor found with code '%s' "
+                                 "passed id=%s", code, ids[0])
+                memo[code] = ids[0]
+            missing = []
+            for d in doctors:
+                if d['code'] not in memo and \
+                        d['code'] not in [m['code'] for m in missing]:
+                    missing.append(d)
+            if missing:
+                memo.update(zip([d['code'] for d in missing],
+                                self._create_doctors(cr, uid, missing,
+                                                     context=context)))
+        return dict((d['code'], memo[d['code']]) for d in doctors)
+
+    def _get_title_ids(self, cr, uid, titles, context=None):
+        """
+        Resolves partner titles the way
+        :meth:`get_title_by_name<partner.res_partner_title.get_title_by_name>`
+        does, with one search for all of them. Missing titles are
+        created.
+
+        :returns: title id by title
+        :rtype: dict
+        """
+        title_pool = self.pool['res.partner.title']
+        names = dict((t, t.replace('.', '').replace(' ', '').lower())
+                     for t in titles)
+        if not names:
+            return {}
+        title_ids = title_pool.search(
+            cr, uid, [['name', 'in', list(set(names.values()))]],
+            context=context)
+        by_name = {}
+        for title in title_pool.read(cr, uid, title_ids, ['name'],
+                                     context=context):
+            by_name.setdefault(title['name'], title['id'])
+        for name in sorted(set(names.values()) - set(by_name)):
+            by_name[name] = title_pool.create(cr, uid, {'name': name},
+                                              context=context)
+        return dict((t, by_name[name]) for t, name in names.items())
+
+    def _create_doctors(self, cr, uid, doctors, context=None):
+        """
+        Creates the missing doctors of an ADT message and their partners
+        through the ORM, resolving their titles at once (see
+        :meth:`_get_title_ids`).
+
+        :returns: doctor ids, in the order of ``doctors``
+        :rtype: list
+        :raises: :class:`except_osv<openerp.osv.osv.except_osv>` if a
+            doctor has no full name
+        """
+        patient_pool = self.pool['nh.clinical.patient']
+        title_ids = self._get_title_ids(
+            cr, uid, [d['title'] for d in doctors if d.get('title')],
+            context=context)
+        doctor_ids = []
+        for d in doctors:
+            vals = {
+                'name': patient_pool._get_fullname(d),
+                'title': title_ids.get(d.get('title'), False),
+                'code': d['code'],
+                'gender': d.get('gender'),
+                'gmc': d.get('gmc')
+            }
+            # Missing values are left to the defaults
+            doctor_ids.append(self.create(
+                cr, uid, dict((k, v) for k, v in vals.items() if v),
+                context=context))
+        _logger.info("%s doctors created: %s", len(doctor_ids),
+                     ', '.join(d['code'] for d in doctors))
+        return doctor_ids
+
 
 # FIXME: Here to prevent mail message from complaining when creating a user
 class mail_message(osv.Model):
@@ -0,0 +1,284 @@
+# Part of NHClinical. See LICENSE file for full copyright and licensing details
+# -*- coding: utf-8 -*-
+"""
+Process-local caches shared by every worker of a database.
+
+Each cache is kept in memory per database (registry) and is tagged with
+a version stamp kept in ``nh_clinical_cache_version``. Writers bump the
+stamp inside their own transaction so other workers (and other threads of
+the same worker) discard their entries as soon as the change is
+committed, while a rolled back change simply restores the old stamp.
+
+Every bump inserts a row taken from the ``nh_clinical_cache_version_seq``
+sequence, so concurrent writers never update a shared row and do not
+conflict. As sequence order is not commit order, the stamp is the
+highest version together with the number of rows: it changes whenever
+any bump becomes visible. Superseded rows are removed by
+:func:`prune_versions`, which bumps the stamps it prunes so a stamp is
+never seen twice.
+
+A transaction that bumped a stamp itself neither reads nor stores
+entries until it is over, so entries are never built from uncommitted
+data.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+
+_logger = logging.getLogger(__name__)
+
+_caches = {}
+_caches_lock = threading.RLock()
+
+#: Number of transactions with an uncommitted stamp remembered per
+#: cache, see :meth:`VersionedCache.invalidate`
+MAX_PENDING_VERSIONS = 64
+
+
+def ensure_version_table(cr, name):
+    """
+    Creates the version stamp table if needed and makes sure there is a
+    row for the cache ``name``. Meant to be called from a model's
+    ``init()``.
+
+    :param name: cache name
+    :type name: str
+    """
+    cr.execute("""
+        select 1 from information_schema.tables
+        where table_name = 'nh_clinical_cache_version'
+    """)
+    if not cr.fetchone():
+        cr.execute("""
+            create sequence nh_clinical_cache_version_seq;
+            create table nh_clinical_cache_version (
+                name varchar(128) not null,
+                version bigint not null default 0
+            )
+        """)
+    cr.execute("""
+        alter table nh_clinical_cache_version
+        drop constraint if exists nh_clinical_cache_version_pkey
+    """)
+    cr.execute("select 1 from pg_indexes where indexname = %s",
+               ('nh_clinical_cache_version_idx',))
+    if not cr.fetchone():
+        cr.execute("""
+            create index nh_clinical_cache_version_idx
+            on nh_clinical_cache_version (name, version)
+        """)
+    cr.execute("""
+        insert into nh_clinical_cache_version (name, version)
+        select %s, 0
+        where not exists (
+            select 1 from nh_clinical_cache_version where name = %s)
+    """, (name, name))
+
+
+def prune_versions(cr):
+    """
+    Removes the version rows superseded by a newer one and bumps the
+    stamps of the pruned caches, as removing rows changes their count.
+
+    :returns: number of rows removed
+    :rtype: int
+    """
+    cr.execute("""
+        with pruned as (
+            delete from nh_clinical_cache_version old
+            using nh_clinical_cache_version newer
+            where newer.name = old.name and newer.version > old.version
+            returning old.name
+        )
+        insert into nh_clinical_cache_version (name, version)
+        select name, nextval('nh_clinical_cache_version_seq')
+        from (select distinct name from pruned) pruned_name
+    """)
+    return cr.rowcount
+
+
+def get_cache(cr, name):
+    """
+    Returns the :class:`VersionedCache` named ``name`` for the database
+    ``cr`` is connected to.
+
+    :param name: cache name
+    :type name: str
+    :rtype: :class:`VersionedCache`
+    """
+    key = (cr.dbname, name)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = VersionedCache(name)
+        return _caches[key]
+
+
+class VersionedCache(object):
+    """
+    Dictionary cache validated against a database version stamp.
+
+    Callers must call :meth:`validate` once per lookup and pass the
+    returned version to :meth:`get` and :meth:`set`. Both compare it with
+    the version of the entries under the cache lock, so entries built
+    from data older (or newer, but not committed) than the entries are
+    never served or stored.
+    """
+
+    _missing = object()
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self.version = None
+        self.entries = {}
+        self.pending = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def validate(self, cr):
+        """
+        Reads the current version stamp and clears the entries if they
+        were built against a different one. A transaction that bumped
+        the stamp itself (see :meth:`invalidate`) gets ``None``, which
+        :meth:`get` and :meth:`set` ignore, and leaves the entries
+        untouched.
+
+        :returns: the current version (highest version and number of
+            version rows)
+        :rtype: tuple
+        """
+        cr.execute("""
+            select coalesce(max(version), 0), count(*),
+                txid_snapshot_xmin(txid_current_snapshot())
+            from nh_clinical_cache_version
+            where name = %s
+        """, (self.name,))
+        max_version, count, xmin = cr.fetchone()
+        version = (max_version, count)
+        with self.lock:
+            # transactions older than the snapshot are over
+            for txid in [t for t in self.pending if t < xmin]:
+                del self.pending[txid]
+            maybe_pending = id(cr) in self.pending.values()
+        if maybe_pending:
+            # only assigns a transaction id if the cursor has moved on to
+            # a new transaction since it bumped the stamp
+            cr.execute("select txid_current()")
+            txid = cr.fetchone()[0]
+            with self.lock:
+                if txid in self.pending:
+                    return None
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+        return version
+
+    def get(self, version, key, default=None):
+        with self.lock:
+            value = self.entries.get(key, self._missing) \
+                if version is not None and version == self.version \
+                else self._missing
+            if value is self._missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, version, key, value):
+        with self.lock:
+            if version is not None and version == self.version:
+                self.entries[key] = value
+
+    def invalidate(self, cr):
+        """
+        Bumps the version stamp in the current transaction and clears the
+        local entries. The transaction of ``cr`` is remembered as pending
+        until it is over (see :meth:`validate`).
+        """
+        cr.execute("""
+            insert into nh_clinical_cache_version (name, version)
+            values (%s, nextval('nh_clinical_cache_version_seq'))
+            returning txid_current()
+        """, (self.name,))
+        txid = cr.fetchone()[0]
+        with self.lock:
+            self.pending[txid] = id(cr)
+            while len(self.pending) > MAX_PENDING_VERSIONS:
+                self.pending.popitem(last=False)
+            self.entries.clear()
+            self.version = None
+
+    def stats(self):
+        """
+        :returns: hits, misses, number of entries and current version
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'version': self.version
+            }
+
+
+def get_keyed_cache(cr, name):
+    """
+    Returns the :class:`KeyedVersionCache` named ``name`` for the
+    database ``cr`` is connected to.
+
+    :param name: cache name
+    :type name: str
+    :rtype: :class:`KeyedVersionCache`
+    """
+    key = (cr.dbname, name)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = KeyedVersionCache(name)
+        return _caches[key]
+
+
+class KeyedVersionCache(object):
+    """
+    Dictionary cache where every entry carries its own version, for
+    callers that keep one version number per key in the database (e.g.
+    one per ward) instead of a single stamp.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """
+        :returns: the value stored for ``key`` if it was stored with
+            ``version``. Otherwise ``None``.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (version, value)
+
+    def stats(self):
+        """
+        :returns: hits, misses and number of entries
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries)
+            }
@@ -20,8 +20,15 @@ def utc_timestamp(cr, uid, timestamp, context=None):
         tz_name = context['tz']
     else:
         reg = registry.RegistryManager.get(cr.dbname)
-        tz_name = reg.get('res.users').read(
-            cr, openerp.SUPERUSER_ID, uid, ['tz'])['tz']
+        user_pool = reg.get('res.users')
+        if hasattr(user_pool, 'get_user_context'):
+            # cached per user when nh_clinical is installed
+            user_context = user_pool.get_user_context(
+                cr, openerp.SUPERUSER_ID, user_id=uid)
+            tz_name = user_context and user_context['tz']
+        else:
+            tz_name = user_pool.read(
+                cr, openerp.SUPERUSER_ID, uid, ['tz'])['tz']
 
     if tz_name:
         try: